@@ -1 +1 @@
-__all__ = ["get_enging", "swap_gender_pronouns", "pronoun_transformation_pipeline"]
\ No newline at end of file
+__all__ = ["get_enging", "swap_gender_pronouns", "pronoun_transformation_pipeline", "manifest", "sharding", "instrumentation", "async_pipeline", "scorers", "dedup", "incremental", "attribution", "shared_features", "planner", "export"]
\ No newline at end of file
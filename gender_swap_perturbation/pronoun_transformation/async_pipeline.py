@@ -0,0 +1,286 @@
+import os
+import time
+import asyncio
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from .get_engine import engine_from_config
+from .swap_gender_pronouns import SWAP_DICTIONARY, replace_pronouns, gender_name_to_id
+from .instrumentation import PIPELINE_STAGES, DEFAULT_THROUGHPUT_LOG, StageStats, utilization_report
+from .instrumentation import append_throughput_log
+from .pronoun_transformation_pipeline import create_base_table, derive_table_names, ngram_join_sql
+from .pronoun_transformation_pipeline import create_transformed_ngram_table, create_tranformation_metadata_table
+from .pronoun_transformation_pipeline import dlatk_lexicon_command, compare_transform_scores, swap_result_table
+from .pronoun_transformation_pipeline import top_affected_messages, attach_messages
+from .pronoun_transformation_pipeline import combine_swap_results, store_table, generate_boxplot
+from .export import export_results
+
+
+async def _read_stage(chunks, executor, out_queue, stats):
+    """
+    Pull chunks of the ngram join from the database into `out_queue`, followed by None.
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        done = stats.timer()
+        chunk = await loop.run_in_executor(executor, next, chunks, None)
+        if chunk is None:
+            break
+        done(len(chunk))
+        await out_queue.put(chunk)
+    await out_queue.put(None)
+
+
+def _remap_feats(feats : list, swap_type : str) -> tuple:
+    """
+    CPU executor task: swap the gender terms of a list of distinct features.
+
+    Returns
+    -------
+    A tuple of (transformed features, transformation directions), see `replace_pronouns`
+    """
+    gender_from_ids = list(map(gender_name_to_id, SWAP_DICTIONARY.get(swap_type).get('gender_from_names')))
+    gender_to_id = gender_name_to_id(SWAP_DICTIONARY.get(swap_type).get('gender_to_name'))
+    return tuple(zip(*[replace_pronouns(feat, gender_from_ids, gender_to_id) for feat in feats]))
+
+
+async def _remap_stage(swap_type, executor, in_queue, out_queue, metadata_parts, stats):
+    """
+    Swap the gender terms of every chunk from `in_queue`, keeping the transformation metadata
+    and passing the uploadable ngrams to `out_queue`. Only the features not seen in an earlier
+    chunk are sent to the CPU executor, as a list of strings; the chunks themselves are mapped
+    in this process, so no DataFrame is pickled.
+    """
+    loop = asyncio.get_event_loop()
+    new_feats = {}
+    transformations = {}
+    while True:
+        chunk = await in_queue.get()
+        if chunk is None:
+            break
+        done = stats.timer()
+        unseen = [feat for feat in chunk["feat"].unique() if feat not in new_feats]
+        if unseen:
+            remapped, directions = await loop.run_in_executor(executor, _remap_feats, unseen, swap_type)
+            new_feats.update(zip(unseen, remapped))
+            transformations.update(zip(unseen, directions))
+        transformed_df = chunk.copy()
+        transformed_df["feat"] = chunk["feat"].map(new_feats)
+        transformed_df["transformation"] = chunk["feat"].map(transformations)
+        metadata_parts.append(create_tranformation_metadata_table(transformed_df))
+        upload_df = create_transformed_ngram_table(transformed_df)
+        done(len(upload_df))
+        await out_queue.put(upload_df)
+    await out_queue.put(None)
+
+
+async def _upload_stage(table_name, conn, executor, in_queue, stats):
+    """
+    Write every chunk from `in_queue` to `table_name`, replacing the table with the first one.
+    """
+    loop = asyncio.get_event_loop()
+    if_exists = "replace"
+    while True:
+        chunk = await in_queue.get()
+        if chunk is None:
+            break
+        done = stats.timer()
+        await loop.run_in_executor(executor,
+            lambda df, if_exists: df.to_sql(table_name, conn, index=False, if_exists=if_exists), chunk, if_exists)
+        done(len(chunk))
+        if_exists = "append"
+
+
+async def transform_and_upload_async(ngram_table_name : str, basetable_name : str, swap_type : str,
+    transformed_ngram_table_name : str, stage_stats : dict, cpu_executor, chunksize : int = 100000,
+    queue_size : int = 2, db : str = 'politeness') -> pd.DataFrame:
+    """
+    Read the ngrams of the basetable messages, swap their gender terms, and upload them as the
+    transformed ngram table, chunk by chunk. The three stages run concurrently and are
+    connected by bounded queues, so while chunk N is remapped, chunk N+1 is read and chunk N-1
+    is uploaded. Database calls run on one thread per stage, the gender swaps of distinct
+    features run in `cpu_executor`.
+    The ngrams are streamed from the server, so only the chunks waiting in the queues are held
+    in memory.
+
+    Parameters
+    ----------
+    ngram_table_name
+        The name of the ngram table to be used to perform gender swaps
+    basetable_name
+        The name of the basetable containing ids of messages to be transformed
+    swap_type
+        A key of `SWAP_DICTIONARY`, e.g. 'f2m'
+    transformed_ngram_table_name
+        The name for the gender swapped ngram table to be uploaded to sql
+    stage_stats
+        A dictionary of `StageStats` with 'read', 'remap' and 'upload' keys
+    cpu_executor
+        The executor in which the distinct features are remapped, a `ProcessPoolExecutor` to use
+        several cores
+    chunksize
+        The number of ngram rows per chunk
+    queue_size
+        The number of chunks which can wait between two stages
+    db
+        The name of the db
+
+    Returns
+    -------
+    The transformation metadata DataFrame, see `create_tranformation_metadata_table`
+    """
+    read_queue = asyncio.Queue(maxsize = queue_size)
+    upload_queue = asyncio.Queue(maxsize = queue_size)
+    metadata_parts = []
+
+    loop = asyncio.get_event_loop()
+    engine = engine_from_config(database = db)
+    with ThreadPoolExecutor(max_workers = 1) as read_executor, ThreadPoolExecutor(max_workers = 1) as upload_executor:
+        with engine.connect() as read_conn, engine.connect() as upload_conn:
+            # An unbuffered cursor, so that every chunk is fetched from the server when the read
+            # stage asks for it instead of the whole join being pulled on execute
+            read_conn = read_conn.execution_options(stream_results = True)
+            # pandas executes the query before returning the chunk iterator, so that runs in the
+            # read thread too rather than blocking the event loop
+            chunks = await loop.run_in_executor(read_executor, lambda: pd.read_sql(
+                ngram_join_sql(ngram_table_name, basetable_name), read_conn, chunksize = chunksize))
+            await asyncio.gather(
+                _read_stage(chunks, read_executor, read_queue, stage_stats["read"]),
+                _remap_stage(swap_type, cpu_executor, read_queue, upload_queue, metadata_parts, stage_stats["remap"]),
+                _upload_stage(transformed_ngram_table_name, upload_conn, upload_executor, upload_queue, stage_stats["upload"]),
+            )
+
+    if not metadata_parts:
+        return pd.DataFrame(columns = ['group_id', 'transformation'])
+    return pd.concat(metadata_parts, ignore_index = True).drop_duplicates()
+
+
+async def run_swap_transformation_async(swap_type : str, basetable_name : str, message_table : str,
+    ngram_table_name : str, old_score_table : str, lexicon_table_name : str, weighted_lexicon_flag : bool,
+    stage_stats : dict, cpu_executor, chunksize : int = 100000, queue_size : int = 2,
+    db : str = 'politeness') -> pd.DataFrame:
+    """
+    The asynchronous counterpart of `run_swap_transformation`: transform and upload the ngrams
+    with `transform_and_upload_async`, then run dlatk as a subprocess and compare the scores
+    without blocking the event loop.
+
+    Returns
+    -------
+    A pandas DataFrame with `id`, `original_score` and `<swap_type>_score` columns, for the
+    transformed messages
+    """
+    loop = asyncio.get_event_loop()
+    transformed_ngram_table_name, new_score_table = derive_table_names(message_table, basetable_name,
+                                                                       ngram_table_name, old_score_table)
+
+    print("\nStep 2: Swapping gender terms and uploading the ngram table in chunks of {} rows.\n".format(chunksize))
+    uploaded_before = stage_stats["upload"].rows
+    metadata_df = await transform_and_upload_async(ngram_table_name, basetable_name, swap_type,
+        transformed_ngram_table_name, stage_stats, cpu_executor, chunksize, queue_size, db)
+
+    print("\nStep 3: Re-run lexica-based model to gather updated scores.\n")
+    dlatk_command = dlatk_lexicon_command(transformed_ngram_table_name, basetable_name, lexicon_table_name,
+                                          weighted_lexicon_flag, db)
+    print("Running: ", dlatk_command)
+    done = stage_stats["score"].timer()
+    process = await asyncio.create_subprocess_shell(dlatk_command)
+    output = await process.wait()
+    # dlatk reads the whole transformed ngram table
+    done(stage_stats["upload"].rows - uploaded_before)
+    print("dlatk command returned ", output)
+
+    print("\nStep 4: Calculate score differences.\n")
+    done = stage_stats["compare"].timer()
+    effect_df = await loop.run_in_executor(None, compare_transform_scores, old_score_table, new_score_table, db)
+    done(len(effect_df))
+    print("Messages with the largest change in scores after gender swap:")
+    print(await loop.run_in_executor(None, top_affected_messages, old_score_table, new_score_table, message_table, 10, db))
+
+    return swap_result_table(metadata_df, effect_df, swap_type)
+
+
+async def run_pipeline_async(db,
+                message_table,
+                user_initials,
+                features_used,
+                lexicon_table_name,
+                weighted_lexicon_flag,
+                ngram_table_name,
+                old_score_table,
+                plots_path,
+                category_table,
+                category_col,
+                category_name,
+                chunksize = 100000,
+                queue_size = 2,
+                cpu_workers = None,
+                include_messages = True,
+                throughput_log = DEFAULT_THROUGHPUT_LOG,
+                export_path = None):
+    """
+    Run the gender swap pipeline like `run_pipeline`, overlapping database reads, remapping
+    and uploads within every swap type (see `transform_and_upload_async`). Prints and returns
+    the utilization of every stage.
+
+    Parameters
+    ----------
+    chunksize
+        The number of ngram rows per chunk
+    queue_size
+        The number of chunks which can wait between two stages
+    cpu_workers
+        The number of processes used for remapping, defaults to the number of cores
+    include_messages, throughput_log, export_path
+        See `run_pipeline`
+
+    Returns
+    -------
+    A tuple of (results DataFrame, stage utilization DataFrame)
+    """
+    if not os.path.exists(plots_path):
+        os.mkdir(plots_path)
+
+    loop = asyncio.get_event_loop()
+    stage_stats = {stage: StageStats(stage) for stage in PIPELINE_STAGES}
+    final_tables = []
+    start = time.perf_counter()
+
+    print("Starting Gender Swap Pipeline (async)...\n\n")
+
+    with ProcessPoolExecutor(max_workers = cpu_workers) as cpu_executor:
+        for swap_type in list(SWAP_DICTIONARY.keys()):
+
+            basetable_name = message_table + "_" + user_initials + "_" + swap_type
+            print("\n\nPerforming transformation: {}".format(SWAP_DICTIONARY.get(swap_type).get('transformation_name')))
+
+            print("\nStep 1: Creating Basetable containing Message IDs to be transformed.\n")
+            done = stage_stats["basetable"].timer()
+            await loop.run_in_executor(None, create_base_table, basetable_name, category_table, category_col,
+                                       category_name, db)
+            done()
+
+            final_tables.append(await run_swap_transformation_async(swap_type, basetable_name, message_table,
+                ngram_table_name, old_score_table, lexicon_table_name, weighted_lexicon_flag,
+                stage_stats, cpu_executor, chunksize, queue_size, db))
+
+    print("\nCompiling results from all gender transformations...\n")
+    final_df = combine_swap_results(final_tables)
+    if include_messages:
+        final_df = await loop.run_in_executor(None, attach_messages, final_df, message_table, db)
+    print(final_df.head(10))
+
+    final_table_name = message_table + "_" + user_initials + "_" + lexicon_table_name + "_" +  "gender_swap"
+    await loop.run_in_executor(None, store_table, final_df, final_table_name, db)
+    if export_path is not None:
+        export_results(final_df, export_path, lexicon_table_name)
+    generate_boxplot(final_df, save_path = plots_path + "/" + final_table_name + ".png")
+
+    report_df = utilization_report(list(stage_stats.values()), time.perf_counter() - start)
+    print("\nStage utilization:\n")
+    print(report_df)
+    if throughput_log is not None:
+        append_throughput_log(list(stage_stats.values()), final_table_name, throughput_log)
+
+    print("\nPipeline is complete!\n")
+    print("Your results can be found in the table {}.{}".format(db, final_table_name))
+    print("Your boxplot can be found at {}/{}.png".format(plots_path, final_table_name))
+    return final_df, report_df
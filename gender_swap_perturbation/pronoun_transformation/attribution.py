@@ -0,0 +1,177 @@
+import numpy as np
+import pandas as pd
+from .get_engine import engine_from_config
+
+
+def load_lexicon_weights(lexicon_table_name : str, weighted_lexicon_flag : bool, category : str = None,
+    db : str = 'politeness') -> pd.Series:
+    """
+    Read the term weights of a dlatk lexicon table.
+
+    Parameters
+    ----------
+    lexicon_table_name
+        The name of the lexicon table, with `term`, `category` and `weight` columns
+    weighted_lexicon_flag
+        Whether the lexicon is weighted. Without weights every term counts 1
+    category
+        The lexicon category to use. May be left out for lexica with a single category
+    db
+        The name of the db
+
+    Returns
+    -------
+    A pandas Series of weights indexed by term
+    """
+    engine = engine_from_config(database = db)
+    with engine.connect() as conn:
+        lexicon_df = pd.read_sql("SELECT * FROM {lexicon_table_name};".format(lexicon_table_name = lexicon_table_name), conn)
+
+    if "category" in lexicon_df.columns:
+        categories = lexicon_df["category"].unique()
+        if category is None and len(categories) > 1:
+            raise ValueError("Lexicon {} has categories {}, pick one to attribute".format(lexicon_table_name, list(categories)))
+        if category is not None:
+            lexicon_df = lexicon_df[lexicon_df["category"] == category]
+
+    if not weighted_lexicon_flag or "weight" not in lexicon_df.columns:
+        lexicon_df = lexicon_df.assign(weight = 1.0)
+    return lexicon_df.groupby("term")["weight"].sum()
+
+
+def _pronoun_pair(original_feat : str, transformed_feat : str) -> str:
+    """
+    Name the swapped terms of an ngram, e.g. "her -> him" for "thank her" and "thank him".
+    """
+    original_tokens = original_feat.split(" ")
+    transformed_tokens = transformed_feat.split(" ")
+    if len(original_tokens) != len(transformed_tokens):
+        return "{} -> {}".format(original_feat, transformed_feat)
+    swapped = [(original, transformed) for original, transformed in zip(original_tokens, transformed_tokens)
+               if original != transformed]
+    return ", ".join("{} -> {}".format(original, transformed) for original, transformed in swapped)
+
+
+def ngram_contributions(ngram_df : pd.DataFrame, transformed_df : pd.DataFrame, lexicon_weights : pd.Series,
+    value_col : str = 'group_norm') -> pd.DataFrame:
+    """
+    Decompose every message's score difference into the contributions of its swapped ngrams.
+    A lexicon score is the weighted sum of the ngram values, so an ngram swapped from `a` to `b`
+    contributes `(weight(a) - weight(b)) * value` to `original_score - transformed_score`.
+
+    Parameters
+    ----------
+    ngram_df
+        The original ngrams, see `read_swap_ngrams`
+    transformed_df
+        The output of `remap_swap_type` on `ngram_df`, aligned with it row by row
+    lexicon_weights
+        See `load_lexicon_weights`
+    value_col
+        The column holding the feature values scored by the lexicon
+
+    Returns
+    -------
+    A pandas DataFrame with `group_id`, `original_feat`, `transformed_feat`, `pronoun_pair` and
+    `contribution` columns, one row per swapped ngram
+    """
+    original_feats = ngram_df["feat"].values
+    transformed_feats = transformed_df["feat"].values
+    swapped = original_feats != transformed_feats
+
+    original_feats = original_feats[swapped]
+    transformed_feats = transformed_feats[swapped]
+    original_weights = pd.Series(original_feats).map(lexicon_weights).fillna(0.0).values
+    transformed_weights = pd.Series(transformed_feats).map(lexicon_weights).fillna(0.0).values
+
+    df = pd.DataFrame({
+        "group_id": ngram_df["group_id"].values[swapped],
+        "original_feat": original_feats,
+        "transformed_feat": transformed_feats,
+        "contribution": (original_weights - transformed_weights) * ngram_df[value_col].values[swapped],
+    })
+
+    # Only the distinct swapped ngrams are named in Python, rows get their name by lookup
+    pairs = df[["original_feat", "transformed_feat"]].drop_duplicates()
+    pair_names = pd.Series([_pronoun_pair(original, transformed) for original, transformed
+                            in zip(pairs["original_feat"], pairs["transformed_feat"])],
+                           index = pd.MultiIndex.from_frame(pairs))
+    df.insert(3, "pronoun_pair", pair_names.reindex(pd.MultiIndex.from_frame(df[["original_feat", "transformed_feat"]])).values)
+    return df
+
+
+def aggregate_contributions(contributions_df : pd.DataFrame, swap_type : str, group_weights : pd.Series = None) -> pd.DataFrame:
+    """
+    Total the ngram contributions per pronoun pair across the corpus, with grouped sums over
+    factorized pair codes instead of a loop over messages.
+
+    Parameters
+    ----------
+    contributions_df
+        The output of `ngram_contributions`
+    swap_type
+        A key of `SWAP_DICTIONARY`, e.g. 'f2m'
+    group_weights
+        The number of messages each group id stands for, when the ngrams were deduplicated
+        (see `dedup_feature_bags`). Defaults to 1 for every group
+
+    Returns
+    -------
+    A pandas DataFrame with `swap_type`, `pronoun_pair`, `total_contribution`,
+    `mean_contribution`, `occurrences` and `messages` columns
+    """
+    codes, pairs = pd.factorize(contributions_df["pronoun_pair"])
+    if group_weights is not None:
+        weights = contributions_df["group_id"].map(group_weights).fillna(1).values.astype(np.float64)
+    else:
+        weights = np.ones(len(contributions_df))
+
+    totals = np.bincount(codes, weights = contributions_df["contribution"].values * weights, minlength = len(pairs))
+    occurrences = np.bincount(codes, weights = weights, minlength = len(pairs))
+    first_in_message = ~pd.DataFrame({"code": codes, "group_id": contributions_df["group_id"].values}).duplicated().values
+    messages = np.bincount(codes[first_in_message], weights = weights[first_in_message], minlength = len(pairs))
+
+    return pd.DataFrame({
+        "swap_type": swap_type,
+        "pronoun_pair": pairs,
+        "total_contribution": totals,
+        "mean_contribution": totals / np.maximum(occurrences, 1),
+        "occurrences": occurrences.astype(np.int64),
+        "messages": messages.astype(np.int64),
+    })
+
+
+def attribute_swap(ngram_df : pd.DataFrame, transformed_df : pd.DataFrame, lexicon_weights : pd.Series,
+    swap_type : str, group_map : pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Attribute the score differences of a swap type to pronoun pairs, see `ngram_contributions`
+    and `aggregate_contributions`.
+
+    Parameters
+    ----------
+    ngram_df, transformed_df, lexicon_weights
+        See `ngram_contributions`
+    swap_type
+        A key of `SWAP_DICTIONARY`, e.g. 'f2m'
+    group_map
+        If the ngrams were deduplicated, the group map from `dedup_feature_bags`
+
+    Returns
+    -------
+    See `aggregate_contributions`
+    """
+    group_weights = group_map["representative_id"].value_counts() if group_map is not None else None
+    return aggregate_contributions(ngram_contributions(ngram_df, transformed_df, lexicon_weights),
+                                   swap_type, group_weights)
+
+
+def rank_attributions(attribution_dfs : list) -> pd.DataFrame:
+    """
+    Combine the attributions of every swap type into one table, ranked by the absolute total
+    contribution.
+    """
+    df = pd.concat(attribution_dfs, ignore_index = True)
+    order = np.argsort(-df["total_contribution"].abs().values, kind = "stable")
+    df = df.iloc[order].reset_index(drop = True)
+    df.insert(0, "rank", np.arange(1, len(df) + 1))
+    return df
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+
+def feature_bag_hashes(ngram_df : pd.DataFrame, value_col : str = 'value') -> pd.DataFrame:
+    """
+    Hash the bag of (feat, value) rows of every group. Row hashes are summed per group, so the
+    result doesn't depend on row order; two independently keyed sums and the row count make
+    collisions between different bags negligible.
+
+    Parameters
+    ----------
+    ngram_df
+        A DataFrame with `group_id`, `feat` and `value_col` columns, see `read_ngrams`
+    value_col
+        The column holding the feature counts
+
+    Returns
+    -------
+    A pandas DataFrame indexed by group_id, with `hash_a`, `hash_b` and `rows` columns
+    """
+    features = ngram_df[["feat", value_col]]
+    hashes = pd.DataFrame({
+        "group_id": ngram_df["group_id"].values,
+        # uint64 sums wrap around, which keeps them order independent
+        "hash_a": pd.util.hash_pandas_object(features, index = False, hash_key = "gender_bag_key_a").values,
+        "hash_b": pd.util.hash_pandas_object(features, index = False, hash_key = "gender_bag_key_b").values,
+    })
+    with np.errstate(over = "ignore"):
+        bags = hashes.groupby("group_id").agg(hash_a = ("hash_a", "sum"), hash_b = ("hash_b", "sum"),
+                                              rows = ("hash_a", "size"))
+    return bags
+
+
+def dedup_feature_bags(ngram_df : pd.DataFrame, value_col : str = 'value') -> tuple:
+    """
+    Keep the ngrams of one message per distinct feature bag, e.g. one copy of a retweet. The
+    smallest group id of each bag represents it.
+
+    Parameters
+    ----------
+    ngram_df
+        A DataFrame with `group_id`, `feat` and `value_col` columns, see `read_ngrams`
+    value_col
+        The column holding the feature counts
+
+    Returns
+    -------
+    A tuple of (the rows of `ngram_df` for the representative messages, a group map DataFrame
+    with `group_id` and `representative_id` columns for every message)
+    """
+    bags = feature_bag_hashes(ngram_df, value_col)
+    representatives = bags.reset_index().groupby(["hash_a", "hash_b", "rows"])["group_id"].transform("min")
+    group_map = pd.DataFrame({"group_id": bags.index.values, "representative_id": representatives.values})
+    unique_df = ngram_df[ngram_df["group_id"].isin(group_map["representative_id"].unique())]
+    return unique_df, group_map
+
+
+def dedup_report(group_map : pd.DataFrame) -> dict:
+    """
+    Summarize a group map from `dedup_feature_bags` for the run report.
+
+    Returns
+    -------
+    A dictionary with the number of messages, the number of unique feature bags and the
+    dedup ratio (messages per unique bag)
+    """
+    messages = len(group_map)
+    unique = group_map["representative_id"].nunique()
+    return {"messages": messages, "unique_bags": unique, "dedup_ratio": messages / unique if unique else 1.0}
+
+
+def fan_out(df : pd.DataFrame, group_map : pd.DataFrame, id_col : str = 'id') -> pd.DataFrame:
+    """
+    Copy the rows computed for representative messages to every message with the same
+    feature bag.
+
+    Parameters
+    ----------
+    df
+        A DataFrame keyed by representative message id in `id_col`
+    group_map
+        The group map from `dedup_feature_bags`
+    id_col
+        The id column of `df`
+
+    Returns
+    -------
+    `df` with one row per message of the group map whose representative is in `df`
+    """
+    fanned = group_map.merge(df.rename(columns = {id_col: "representative_id"}), on = "representative_id")
+    fanned = fanned.drop(columns = ["representative_id"]).rename(columns = {"group_id": id_col})
+    return fanned[list(df.columns)]
@@ -0,0 +1,210 @@
+import os
+import numpy as np
+import pandas as pd
+from urllib.parse import quote
+from .swap_gender_pronouns import SWAP_DICTIONARY
+
+
+EXPORT_COLUMNS = ["id", "swap_type", "lexicon", "original_score", "transformed_score", "delta"]
+
+PARTITION_COLUMNS = ["swap_type", "lexicon"]
+
+# Columns identifying the entry of a manifest run, kept in the export when present
+ENTRY_COLUMNS = ["category_value", "category_tag"]
+
+
+def _import_pyarrow():
+    """
+    Import pyarrow, which is only needed to export and query results.
+    """
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("pyarrow is required to export and query results, install pyarrow")
+    return pyarrow
+
+
+def long_format_results(final_df : pd.DataFrame, lexicon : str = None) -> pd.DataFrame:
+    """
+    Reshape a wide results table, with one `<swap_type>_score` column per swap type, into one
+    row per (message, swap type) that the message was transformed by.
+
+    Parameters
+    ----------
+    final_df
+        The results of `run_pipeline`, or of `run_manifest` with a `lexicon` column
+    lexicon
+        The lexicon the scores were computed with. May be left out if `final_df` has a
+        `lexicon` column
+
+    Returns
+    -------
+    A pandas DataFrame with `id`, `swap_type`, `lexicon`, `original_score`,
+    `transformed_score` and `delta` (transformed - original, like the boxplot) columns,
+    followed by the `ENTRY_COLUMNS` of `final_df`
+    """
+    if lexicon is None and "lexicon" not in final_df.columns:
+        raise ValueError("The results have no lexicon column, pass the lexicon name")
+    entry_columns = [column for column in ENTRY_COLUMNS if column in final_df.columns]
+
+    parts = []
+    for swap_type in SWAP_DICTIONARY.keys():
+        score_column = swap_type + "_score"
+        if score_column not in final_df.columns:
+            continue
+        transformed = final_df[final_df[score_column].notna()]
+        part_df = pd.DataFrame({
+            "id": transformed["id"].values,
+            "swap_type": swap_type,
+            "lexicon": transformed["lexicon"].values if lexicon is None else lexicon,
+            "original_score": transformed["original_score"].values.astype(np.float64),
+            "transformed_score": transformed[score_column].values.astype(np.float64),
+        })
+        for column in entry_columns:
+            part_df[column] = transformed[column].values
+        parts.append(part_df)
+    if not parts:
+        return pd.DataFrame(columns = EXPORT_COLUMNS + entry_columns)
+    long_df = pd.concat(parts, ignore_index = True)
+    long_df["delta"] = long_df["transformed_score"] - long_df["original_score"]
+    return long_df[EXPORT_COLUMNS + entry_columns]
+
+
+def partition_path(export_path : str, swap_type : str, lexicon : str) -> str:
+    """
+    The directory of one (swap type, lexicon) partition, in the `key=value` layout that
+    `pyarrow.dataset` reads as hive partitioning. Values are URI encoded, so lexicon table
+    names with `$` or `/` stay one path segment.
+    """
+    return os.path.join(export_path, "swap_type=" + quote(swap_type, safe = ""), "lexicon=" + quote(lexicon, safe = ""))
+
+
+def export_results(final_df : pd.DataFrame, export_path : str, lexicon : str = None,
+    row_group_size : int = 100000, compression : str = 'zstd') -> list:
+    """
+    Write the results in long format (see `long_format_results`) as compressed parquet files,
+    one per swap type and lexicon. Each file is sorted by `delta`, so every row group covers a
+    narrow delta range and its min/max statistics let queries on `delta` skip most of them
+    (see `query_results`). Re-exporting replaces only the partitions in `final_df`.
+
+    Parameters
+    ----------
+    final_df
+        The results of `run_pipeline`, or of `run_manifest` with a `lexicon` column
+    export_path
+        The root directory of the export
+    lexicon
+        See `long_format_results`
+    row_group_size
+        The number of rows per row group; smaller groups make filters more selective, larger
+        ones compress better
+    compression
+        The parquet compression codec, e.g. 'zstd' or 'snappy'
+
+    Returns
+    -------
+    The list of files written
+    """
+    pyarrow = _import_pyarrow()
+    long_df = long_format_results(final_df, lexicon)
+
+    paths = []
+    for (swap_type, lexicon_name), part_df in long_df.groupby(PARTITION_COLUMNS, sort = True):
+        part_df = part_df.drop(columns = PARTITION_COLUMNS).sort_values(["delta", "id"], kind = "stable")
+        directory = partition_path(export_path, swap_type, lexicon_name)
+        os.makedirs(directory, exist_ok = True)
+        path = os.path.join(directory, "part-0.parquet")
+        # Hidden files are skipped by dataset discovery, so readers never see a partial partition
+        temporary_path = os.path.join(directory, ".part-0.parquet.tmp")
+
+        pyarrow.parquet.write_table(pyarrow.Table.from_pandas(part_df, preserve_index = False), temporary_path,
+                                    row_group_size = row_group_size, compression = compression,
+                                    write_statistics = True)
+        os.replace(temporary_path, path)
+        paths.append(path)
+    return paths
+
+
+def results_filter(swap_type : str = None, lexicon : str = None, min_delta : float = None, max_delta : float = None):
+    """
+    Build the `pyarrow.dataset` filter expression of `query_results`, or None without
+    conditions.
+    """
+    pyarrow = _import_pyarrow()
+    field = pyarrow.dataset.field
+    conditions = []
+    if swap_type is not None:
+        conditions.append(field("swap_type") == swap_type)
+    if lexicon is not None:
+        conditions.append(field("lexicon") == lexicon)
+    if min_delta is not None:
+        conditions.append(field("delta") > min_delta)
+    if max_delta is not None:
+        conditions.append(field("delta") < max_delta)
+    if not conditions:
+        return None
+    expression = conditions[0]
+    for condition in conditions[1:]:
+        expression = expression & condition
+    return expression
+
+
+def _results_dataset(export_path : str):
+    """
+    Open an export written by `export_results` as a hive partitioned parquet dataset.
+    """
+    pyarrow = _import_pyarrow()
+    return pyarrow.dataset.dataset(export_path, format = "parquet", partitioning = "hive")
+
+
+def query_results(export_path : str, swap_type : str = None, lexicon : str = None, min_delta : float = None,
+    max_delta : float = None, columns : list = None) -> pd.DataFrame:
+    """
+    Read the exported results matching the conditions, e.g. the f2m deltas above 0.5 with
+    `query_results(path, swap_type = 'f2m', min_delta = 0.5)`. The conditions are pushed down:
+    partitions of other swap types and lexica are not opened, and row groups whose delta
+    statistics fall outside the range are not read.
+
+    Parameters
+    ----------
+    export_path
+        The root directory of the export
+    swap_type, lexicon
+        Keep only this swap type and lexicon
+    min_delta, max_delta
+        Keep only deltas strictly above `min_delta` and below `max_delta`
+    columns
+        The columns to read, defaults to `EXPORT_COLUMNS` and any `ENTRY_COLUMNS` exported
+
+    Returns
+    -------
+    A pandas DataFrame with the matching rows
+    """
+    dataset = _results_dataset(export_path)
+    if columns is None:
+        columns = EXPORT_COLUMNS + [column for column in ENTRY_COLUMNS if column in dataset.schema.names]
+    table = dataset.to_table(columns = columns,
+                             filter = results_filter(swap_type, lexicon, min_delta, max_delta))
+    return table.to_pandas()
+
+
+def count_row_groups(export_path : str, swap_type : str = None, lexicon : str = None, min_delta : float = None,
+    max_delta : float = None) -> tuple:
+    """
+    Count the row groups `query_results` would read with the same conditions, to check how
+    selective a query is.
+
+    Returns
+    -------
+    A tuple of (row groups read, row groups in the export)
+    """
+    dataset = _results_dataset(export_path)
+    expression = results_filter(swap_type, lexicon, min_delta, max_delta)
+    total = sum(fragment.metadata.num_row_groups for fragment in dataset.get_fragments())
+    if expression is None:
+        return total, total
+    read = sum(len(fragment.split_by_row_group(expression, schema = dataset.schema))
+               for fragment in dataset.get_fragments(filter = expression))
+    return read, total
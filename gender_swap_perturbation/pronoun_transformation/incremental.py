@@ -0,0 +1,367 @@
+import os
+import json
+import hashlib
+import pandas as pd
+from .get_engine import engine_from_config
+from .swap_gender_pronouns import SWAP_DICTIONARY
+from .pronoun_transformation_pipeline import table_exists, load_category_ids, run_swap_transformation
+from .pronoun_transformation_pipeline import run_swap_transformations_shared
+from .pronoun_transformation_pipeline import combine_swap_results, attach_messages, store_table, generate_boxplot
+from .attribution import load_lexicon_weights
+from .export import export_results
+
+
+WATERMARK_TABLE = "gender_swap_run_watermarks"
+
+
+def watermark_key(results_table : str, category_table : str, category_col : str, category_name : str) -> str:
+    """
+    Identify the runs sharing watermarks: the same results table (which names the message
+    table, user initials and lexicon) filled from the same category. The key is a hash, since
+    the names together are too long for an index.
+    """
+    identity = [results_table, category_table, category_col, str(category_name)]
+    return hashlib.sha256(json.dumps(identity).encode("utf-8")).hexdigest()
+
+
+def create_watermark_table(db : str = 'politeness'):
+    """
+    Create the table recording the last processed message id per (results table, category,
+    swap type), if it doesn't exist yet.
+    """
+    engine = engine_from_config(database = db)
+    with engine.connect() as conn:
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS {watermark_table} (
+            run_key CHAR(64) NOT NULL,
+            swap_type VARCHAR(16) NOT NULL,
+            results_table VARCHAR(255) NOT NULL,
+            category_table VARCHAR(255) NOT NULL,
+            category_col VARCHAR(255) NOT NULL,
+            category_name VARCHAR(255) NOT NULL,
+            last_sid BIGINT NOT NULL,
+            updated_at DATETIME NOT NULL,
+            PRIMARY KEY (run_key, swap_type)
+            );""".format(watermark_table = WATERMARK_TABLE)
+        )
+
+
+def read_watermarks(results_table : str, category_table : str, category_col : str, category_name : str,
+    db : str = 'politeness') -> dict:
+    """
+    Read the last processed message id of every swap type.
+
+    Parameters
+    ----------
+    results_table
+        The name of the results table the runs upsert into
+    category_table, category_col, category_name
+        The category the messages are selected from, see `create_base_table`
+    db
+        The name of the db
+
+    Returns
+    -------
+    A dictionary from swap type to last processed sid, without the swap types never processed
+    """
+    create_watermark_table(db)
+    engine = engine_from_config(database = db)
+    with engine.connect() as conn:
+        df = pd.read_sql(
+            """SELECT swap_type, last_sid FROM {watermark_table}
+            WHERE run_key = %(run_key)s;""".format(watermark_table = WATERMARK_TABLE),
+            conn,
+            params = {"run_key": watermark_key(results_table, category_table, category_col, category_name)},
+        )
+    return dict(zip(df["swap_type"], df["last_sid"]))
+
+
+def write_watermark(results_table : str, category_table : str, category_col : str, category_name : str,
+    swap_type : str, last_sid : int, db : str = 'politeness'):
+    """
+    Record `last_sid` as the last processed message id of a swap type, see `read_watermarks`.
+    """
+    engine = engine_from_config(database = db)
+    with engine.connect() as conn:
+        conn.execute(
+            """INSERT INTO {watermark_table} (run_key, swap_type, results_table, category_table, category_col,
+            category_name, last_sid, updated_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())
+            ON DUPLICATE KEY UPDATE last_sid = VALUES(last_sid), updated_at = VALUES(updated_at);""".format(
+                watermark_table = WATERMARK_TABLE),
+            (watermark_key(results_table, category_table, category_col, category_name), swap_type, results_table,
+             category_table, category_col, str(category_name), int(last_sid))
+        )
+
+
+def create_delta_base_table(basetable_name : str, category_table : str, category_col : str, category_name : str,
+    after_sid = None, db : str = 'politeness') -> int:
+    """
+    (Re)create a basetable with the ids of the messages in a category added after `after_sid`.
+    Unlike `create_base_table` an existing table is replaced, since its content changes with
+    every run.
+
+    Parameters
+    ----------
+    basetable_name
+        The name of the delta basetable
+    category_table, category_col, category_name
+        See `create_base_table`
+    after_sid
+        The last processed message id, or None to take every message
+    db
+        The name of the db
+
+    Returns
+    -------
+    The number of new messages
+    """
+    after_condition = "" if after_sid is None else "AND {category_table}.group_id > {after_sid}".format(
+        category_table = category_table, after_sid = int(after_sid))
+    engine = engine_from_config(database = db)
+    with engine.connect() as conn:
+        conn.execute("DROP TABLE IF EXISTS {basetable_name};".format(basetable_name = basetable_name))
+        conn.execute(
+            """CREATE TABLE {basetable_name} (PRIMARY KEY (sid)) AS
+            (
+            SELECT DISTINCT {category_table}.group_id AS sid
+            FROM {category_table}
+            WHERE {category_table}.{category_col} = '{category_name}'
+            {after_condition}
+            );""".format(basetable_name = basetable_name, category_table = category_table,
+                category_col = category_col, category_name = category_name, after_condition = after_condition)
+        )
+        return conn.execute("SELECT COUNT(*) FROM {basetable_name};".format(basetable_name = basetable_name)).scalar()
+
+
+def table_columns(engine, table_name : str) -> list:
+    """
+    List the columns of a table in the engine's database, in table order.
+    """
+    with engine.connect() as conn:
+        df = pd.read_sql(
+            """SELECT column_name AS 'column_name' FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = %s
+            ORDER BY ordinal_position;""",
+            conn,
+            params = (table_name,),
+        )
+    return list(df["column_name"])
+
+
+def check_upsert_columns(table_name : str, table_column_names : list, columns : list):
+    """
+    Check that rows with `columns` can be upserted into a table with `table_column_names`.
+
+    Raises
+    ------
+    ValueError
+        If the column sets differ, e.g. when a run without messages upserts into a results
+        table stored with them
+    """
+    missing = [column for column in table_column_names if column not in columns]
+    extra = [column for column in columns if column not in table_column_names]
+    if missing or extra:
+        raise ValueError("The rows can't be upserted into {}: the rows lack the columns {} and have the extra "
+                         "columns {}. Rerun with the same options (e.g. --no_messages) as the run which created "
+                         "the table".format(table_name, missing, extra))
+
+
+def upsert_table(df : pd.DataFrame, table_name : str, key : str = 'id', db : str = 'politeness'):
+    """
+    Insert the rows of `df` into a table, replacing the rows with the same key. The rows are
+    uploaded to a staging table first, and the replacement runs in one transaction. If the
+    table doesn't exist yet it is created from `df`, like `store_table`.
+
+    Parameters
+    ----------
+    df
+        The rows to insert, with the same columns as the table
+    table_name
+        The name of the table
+    key
+        The column identifying a row
+    db
+        The name of the db
+    """
+    engine = engine_from_config(database = db)
+    if not table_exists(engine, table_name):
+        store_table(df, table_name, db)
+        return
+    # Checked before the delete, which the failing insert would otherwise roll back
+    check_upsert_columns(table_name, table_columns(engine, table_name), list(df.columns))
+
+    staging_table_name = table_name + "_staging"
+    store_table(df, staging_table_name, db)
+    columns = ", ".join("`{}`".format(column) for column in df.columns)
+    with engine.begin() as conn:
+        conn.execute(
+            """DELETE {table_name} FROM {table_name} INNER JOIN {staging_table_name}
+            ON {table_name}.{key} = {staging_table_name}.{key};""".format(table_name = table_name,
+                staging_table_name = staging_table_name, key = key)
+        )
+        conn.execute(
+            """INSERT INTO {table_name} ({columns})
+            SELECT {columns} FROM {staging_table_name};""".format(table_name = table_name,
+                staging_table_name = staging_table_name, columns = columns)
+        )
+    with engine.connect() as conn:
+        conn.execute("DROP TABLE {staging_table_name};".format(staging_table_name = staging_table_name))
+
+
+def read_result_scores(final_table_name : str, swap_types : list, db : str = 'politeness') -> pd.DataFrame:
+    """
+    Read the ids and scores of a results table, without the message texts.
+
+    Parameters
+    ----------
+    final_table_name
+        The name of the results table
+    swap_types
+        The swap types with a `<swap_type>_score` column in the table
+    db
+        The name of the db
+
+    Returns
+    -------
+    A pandas DataFrame with `id`, `original_score` and `<swap_type>_score` columns
+    """
+    columns = ["id", "original_score"] + [swap_type + "_score" for swap_type in swap_types]
+    engine = engine_from_config(database = db)
+    with engine.connect() as conn:
+        return pd.read_sql("SELECT {columns} FROM {final_table_name};".format(
+            columns = ", ".join("`{}`".format(column) for column in columns), final_table_name = final_table_name), conn)
+
+
+def run_pipeline_incremental(db,
+                message_table,
+                user_initials,
+                features_used,
+                lexicon_table_name,
+                weighted_lexicon_flag,
+                ngram_table_name,
+                old_score_table,
+                plots_path,
+                category_table,
+                category_col,
+                category_name,
+                semijoin = False,
+                include_messages = True,
+                scorer = None,
+                dedup = False,
+                lexicon_workers = None,
+                export_path = None):
+    """
+    Run the gender swap pipeline only for the messages added since the last run, and upsert
+    their results into the existing `<message_table>_<user_initials>_<lexicon>_gender_swap`
+    table. The last processed sid of every swap type is recorded in the `gender_swap_run_watermarks`
+    table per results table and category, so message ids are expected to grow over time. The ngram and score tables of the
+    message table must already include the new messages.
+
+    All swap types start from the smallest of their watermarks, so that every results row is
+    written with all of its swap type columns. The first run processes every message.
+
+    With `export_path`, the scores of the whole results table are read back after the upsert
+    and exported, since every export partition is rewritten as one file sorted by delta.
+
+    See `run_pipeline` for the parameters.
+
+    Returns
+    -------
+    The results DataFrame of the new messages
+    """
+    if not os.path.exists(plots_path):
+        os.mkdir(plots_path)
+
+    swap_types = list(SWAP_DICTIONARY.keys())
+    final_table_name = message_table + "_" + user_initials + "_" + lexicon_table_name + "_" +  "gender_swap"
+    watermarks = read_watermarks(final_table_name, category_table, category_col, category_name, db)
+    after_sid = min(watermarks[swap_type] for swap_type in swap_types) \
+        if all(swap_type in watermarks for swap_type in swap_types) else None
+    print("Starting incremental Gender Swap Pipeline after sid {}...\n\n".format(after_sid))
+
+    # Fail before any work if the results can't be upserted
+    engine = engine_from_config(database = db)
+    if table_exists(engine, final_table_name):
+        check_upsert_columns(final_table_name, table_columns(engine, final_table_name),
+                             ["id"] + (["message"] if include_messages else []) + ["original_score"] +
+                             [swap_type + "_score" for swap_type in swap_types])
+
+    lexicon_workers = lexicon_workers if scorer is None else None
+    lexicon_weights = load_lexicon_weights(lexicon_table_name, weighted_lexicon_flag, db = db) \
+        if lexicon_workers is not None else None
+
+    category_ids = None
+    if semijoin:
+        category_ids = load_category_ids(category_table, category_col, category_name, db)
+        if after_sid is not None:
+            category_ids = category_ids[category_ids > after_sid]
+
+    final_tables = []
+    shared_basetables = {}
+    run_report = {"after_sid": None if after_sid is None else int(after_sid)}
+    last_sid = None
+
+    for swap_type in swap_types:
+
+        basetable_name = message_table + "_" + user_initials + "_" + swap_type + "_delta"
+        print("\n\nPerforming transformation: {}".format(SWAP_DICTIONARY.get(swap_type).get('transformation_name')))
+
+        ### Create Basetable with the new Message IDs only
+        print("\nStep 1: Creating Basetable containing new Message IDs to be transformed.\n")
+        new_messages = create_delta_base_table(basetable_name, category_table, category_col, category_name, after_sid, db)
+        run_report.setdefault(swap_type, {})["new_messages"] = int(new_messages)
+        if new_messages == 0:
+            print("No new messages since sid {}! Skipping...".format(after_sid))
+            continue
+
+        if last_sid is None:
+            with engine.connect() as conn:
+                last_sid = conn.execute("SELECT MAX(sid) FROM {basetable_name};".format(basetable_name = basetable_name)).scalar()
+
+        if lexicon_workers is not None:
+            shared_basetables[swap_type] = basetable_name
+            continue
+
+        final_tables.append(run_swap_transformation(swap_type, basetable_name, message_table, ngram_table_name,
+                                                    old_score_table, lexicon_table_name, weighted_lexicon_flag, db,
+                                                    category_ids, scorer, dedup, run_report[swap_type]))
+
+    if shared_basetables:
+        # The delta basetables hold the same ids, so the new messages are read and scored once
+        final_tables = run_swap_transformations_shared(list(shared_basetables), list(shared_basetables.values())[0],
+                                                       message_table, ngram_table_name, lexicon_weights, lexicon_workers,
+                                                       db, category_ids, dedup, run_report)
+
+    if not final_tables:
+        print("\nNothing to do, every message was already processed.\n")
+        return None
+
+    print("\nCompiling results from all gender transformations...\n")
+    final_df = combine_swap_results(final_tables)
+    if include_messages:
+        final_df = attach_messages(final_df, message_table, db)
+    print(final_df.head(10))
+
+    upsert_table(final_df, final_table_name, 'id', db)
+    if export_path is not None:
+        export_results(read_result_scores(final_table_name, swap_types, db), export_path, lexicon_table_name)
+
+    # Only advance the watermarks once the results are stored
+    for swap_type in swap_types:
+        write_watermark(final_table_name, category_table, category_col, category_name, swap_type, last_sid, db)
+
+    print("\nCreating boxplot from the new results...\n")
+    generate_boxplot(final_df, save_path = plots_path + "/" + final_table_name + "_delta.png")
+
+    run_report["results"] = {"table": final_table_name, "upserted_messages": len(final_df), "last_sid": int(last_sid)}
+    print("\nRun report:\n")
+    print(json.dumps(run_report, indent = 2))
+    with open(plots_path + "/" + final_table_name + "_delta_report.json", "w") as fh:
+        json.dump(run_report, fh, indent = 2)
+
+    print("\nIncremental pipeline is complete!\n")
+    print("Your results were added to the table {}.{}".format(db, final_table_name))
+    if export_path is not None:
+        print("Your exported results can be found under {}".format(export_path))
+    return final_df
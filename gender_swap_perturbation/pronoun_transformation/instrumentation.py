@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import datetime
+import pandas as pd
+
+
+PIPELINE_STAGES = ["basetable", "read", "remap", "upload", "score", "compare"]
+
+DEFAULT_THROUGHPUT_LOG = os.path.join(os.path.expanduser("~"), ".gender_swap_throughput.jsonl")
+
+
+class StageStats:
+    """
+    Accumulate the time a pipeline stage spends working, and the number of chunks and rows
+    it processed, so that stages running concurrently can be compared to the wall time of
+    the whole run.
+
+    Parameters
+    ----------
+    name
+        The name of the stage, e.g. 'read'
+    """
+
+    def __init__(self, name : str):
+        self.name = name
+        self.busy_seconds = 0.0
+        self.chunks = 0
+        self.rows = 0
+
+    def record(self, seconds : float, rows : int = 0):
+        """
+        Add one unit of work that took `seconds` and processed `rows` rows.
+        """
+        self.busy_seconds += seconds
+        self.chunks += 1
+        self.rows += rows
+
+    def timer(self):
+        """
+        Return a callable which, when called with the number of rows processed, records the
+        time elapsed since `timer` was called.
+        """
+        start = time.perf_counter()
+        return lambda rows = 0: self.record(time.perf_counter() - start, rows)
+
+
+def utilization_report(stage_stats : list, wall_seconds : float) -> pd.DataFrame:
+    """
+    Summarize how busy every stage was during a run. With stages overlapping, the
+    utilizations add up to more than 1.
+
+    Parameters
+    ----------
+    stage_stats
+        A list of `StageStats`
+    wall_seconds
+        The wall clock duration of the run
+
+    Returns
+    -------
+    A pandas DataFrame indexed by stage, with busy seconds, chunks, rows, rows per busy second
+    and utilization (busy seconds / wall seconds) columns
+    """
+    rows = []
+    for stats in stage_stats:
+        rows.append({
+            "stage": stats.name,
+            "busy_seconds": stats.busy_seconds,
+            "chunks": stats.chunks,
+            "rows": stats.rows,
+            "rows_per_second": stats.rows / stats.busy_seconds if stats.busy_seconds else float("nan"),
+            "utilization": stats.busy_seconds / wall_seconds if wall_seconds else float("nan"),
+        })
+    return pd.DataFrame(rows).set_index("stage")
+
+
+def stage_timer(stage_stats : dict, stage : str):
+    """
+    Start timing `stage` if `stage_stats` is given, see `StageStats.timer`. Without stage
+    statistics the returned callable does nothing.
+    """
+    if stage_stats is None:
+        return lambda rows = 0: None
+    return stage_stats[stage].timer()
+
+
+def append_throughput_log(stage_stats : list, run_name : str, path : str = DEFAULT_THROUGHPUT_LOG):
+    """
+    Append the work done by every stage of a run to a JSON lines log, from which
+    `read_throughput_log` derives the throughput expected of future runs. Stages which did
+    no work are left out.
+
+    Parameters
+    ----------
+    stage_stats
+        A list of `StageStats`
+    run_name
+        A name for the run, e.g. the results table
+    path
+        The log file
+    """
+    logged_at = datetime.datetime.now().isoformat(timespec = "seconds")
+    with open(path, "a") as fh:
+        for stats in stage_stats:
+            if stats.chunks == 0:
+                continue
+            fh.write(json.dumps({"logged_at": logged_at, "run": run_name, "stage": stats.name,
+                                 "busy_seconds": stats.busy_seconds, "chunks": stats.chunks, "rows": stats.rows}) + "\n")
+
+
+def read_throughput_log(path : str = DEFAULT_THROUGHPUT_LOG, last_runs : int = 20) -> pd.DataFrame:
+    """
+    Summarize the throughput of every stage over the last runs in a log written by
+    `append_throughput_log`.
+
+    Parameters
+    ----------
+    path
+        The log file
+    last_runs
+        The number of most recent entries per stage to use
+
+    Returns
+    -------
+    A pandas DataFrame indexed by stage, with runs, rows per busy second and busy seconds
+    per chunk columns. Empty if there is no log yet.
+    """
+    columns = ["runs", "rows_per_second", "seconds_per_chunk"]
+    if not os.path.exists(path):
+        return pd.DataFrame(columns = columns).rename_axis("stage")
+    with open(path) as fh:
+        log_df = pd.DataFrame([json.loads(line) for line in fh if line.strip()])
+    if log_df.empty:
+        return pd.DataFrame(columns = columns).rename_axis("stage")
+
+    totals = log_df.groupby("stage").tail(last_runs).groupby("stage").agg(
+        runs = ("run", "size"), busy_seconds = ("busy_seconds", "sum"), chunks = ("chunks", "sum"), rows = ("rows", "sum"))
+    totals["rows_per_second"] = (totals["rows"] / totals["busy_seconds"]).where(totals["rows"] > 0)
+    totals["seconds_per_chunk"] = totals["busy_seconds"] / totals["chunks"]
+    return totals[columns]
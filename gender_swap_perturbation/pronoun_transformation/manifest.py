@@ -0,0 +1,272 @@
+import os
+import json
+import pandas as pd
+from .swap_gender_pronouns import SWAP_DICTIONARY
+from .pronoun_transformation_pipeline import create_base_table, derive_table_names, read_ngrams, remap_swap_type
+from .pronoun_transformation_pipeline import load_category_ids, read_ngrams_semijoin
+from .pronoun_transformation_pipeline import create_transformed_ngram_table, create_tranformation_metadata_table
+from .pronoun_transformation_pipeline import run_lexicon_scoring, compare_transform_scores, swap_result_table
+from .pronoun_transformation_pipeline import combine_swap_results, attach_messages, store_table, generate_boxplot
+from .export import export_results
+
+
+################## Example manifest (YAML) ##############################
+# db: politeness
+# message_table: twitter
+# user: sc
+# ngram_table: feat$1to3gram$twitter$sid$16to16
+# plots_path: gender_swap_plots
+# result_table: twitter_sc_manifest_gender_swap   # optional
+# swap_types: [f2m, f2n, m2f, m2n]                 # optional, defaults to all
+# semijoin: false                                  # optional, see run_pipeline
+# include_messages: true                           # optional, see run_pipeline
+# export_path: gender_swap_export                  # optional, see run_pipeline
+# categories:
+#   - table: feat$cat_LIWC2015$twitter$sid$1gra
+#     column: feat
+#     value: PRONOUN
+#     tag: liwc_pronoun                            # optional, defaults to the lowercased value, must be unique
+# lexicons:
+#   - name: dd_twitter_politeness_npl
+#     weighted: true
+#     score_table: feat$cat_dd_twitter_politeness_npl_w$twitter$sid$1to3
+#   - name: dd_twitter_politeness
+#     weighted: false
+#     score_table: feat$cat_dd_twitter_politeness$twitter$sid$1to3
+
+
+def load_manifest(manifest_path : str) -> dict:
+    """
+    Read a pipeline manifest from a JSON or YAML file. YAML manifests need PyYAML to be installed.
+
+    Parameters
+    ----------
+    manifest_path
+        The path of the manifest file, ending in `.json`, `.yaml` or `.yml`
+
+    Returns
+    -------
+    The manifest as a dictionary, with defaults filled in (see `normalize_manifest`)
+    """
+    with open(manifest_path, "r", encoding="utf-8") as fh:
+        if manifest_path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("PyYAML is required to read YAML manifests, use a JSON manifest or install pyyaml")
+            manifest = yaml.safe_load(fh)
+        else:
+            manifest = json.load(fh)
+    return normalize_manifest(manifest)
+
+
+def normalize_manifest(manifest : dict) -> dict:
+    """
+    Validate a manifest and fill in the optional keys.
+
+    Parameters
+    ----------
+    manifest
+        The manifest dictionary, see the example at the top of this module
+
+    Returns
+    -------
+    A new manifest dictionary with `user`, `swap_types`, `result_table`, `semijoin`,
+    `include_messages`, `export_path`, and the per-category `column` and `tag` keys populated
+    """
+    for key in ["db", "message_table", "ngram_table", "plots_path", "categories", "lexicons"]:
+        if key not in manifest:
+            raise ValueError("Manifest is missing required key '{}'".format(key))
+
+    manifest = dict(manifest)
+    manifest.setdefault("user", "")
+    manifest.setdefault("swap_types", list(SWAP_DICTIONARY.keys()))
+    manifest.setdefault("semijoin", False)
+    manifest.setdefault("include_messages", True)
+    manifest.setdefault("export_path", None)
+    manifest.setdefault("result_table",
+        manifest["message_table"] + "_" + manifest["user"] + "_manifest_gender_swap")
+
+    unknown_swaps = [swap_type for swap_type in manifest["swap_types"] if swap_type not in SWAP_DICTIONARY]
+    if unknown_swaps:
+        raise ValueError("Unknown swap types {}, expected some of {}".format(unknown_swaps, list(SWAP_DICTIONARY.keys())))
+
+    categories = []
+    for category in manifest["categories"]:
+        category = dict(category)
+        category.setdefault("column", "feat")
+        category.setdefault("tag", str(category["value"]).lower())
+        categories.append(category)
+    manifest["categories"] = categories
+
+    # The tag names the basetables, so a repeated tag would reuse another filter's ids
+    tags = [category["tag"] for category in categories]
+    duplicate_tags = sorted(set(tag for tag in tags if tags.count(tag) > 1))
+    if duplicate_tags:
+        raise ValueError("Category tags {} are used by several category filters, give each filter a unique "
+                         "'tag'".format(duplicate_tags))
+
+    lexicons = []
+    for lexicon in manifest["lexicons"]:
+        lexicon = dict(lexicon)
+        lexicon.setdefault("weighted", False)
+        lexicons.append(lexicon)
+    manifest["lexicons"] = lexicons
+    return manifest
+
+
+def manifest_basetable_name(manifest : dict, category : dict, swap_type : str) -> str:
+    """
+    Name the basetable for a category filter and swap type. The category tag is part of the
+    name so that different filters of the same message table don't overwrite each other.
+    """
+    return "_".join([manifest["message_table"], manifest["user"], category["tag"], swap_type])
+
+
+def plan_manifest(manifest : dict) -> pd.DataFrame:
+    """
+    Expand a manifest into the full grid of (category, swap type, lexicon) entries, and
+    resolve the tables each entry reads and writes.
+
+    Parameters
+    ----------
+    manifest
+        A normalized manifest, see `normalize_manifest`
+
+    Returns
+    -------
+    A pandas DataFrame with one row per grid entry. The basetable and transformed ngram
+    table columns repeat across lexicons, since those are shared.
+    """
+    rows = []
+    for category in manifest["categories"]:
+        for swap_type in manifest["swap_types"]:
+            basetable_name = manifest_basetable_name(manifest, category, swap_type)
+            for lexicon in manifest["lexicons"]:
+                transformed_ngram_table_name, new_score_table = derive_table_names(manifest["message_table"],
+                    basetable_name, manifest["ngram_table"], lexicon["score_table"])
+                rows.append({
+                    "category_table": category["table"],
+                    "category_value": category["value"],
+                    "category_tag": category["tag"],
+                    "swap_type": swap_type,
+                    "lexicon": lexicon["name"],
+                    "basetable": basetable_name,
+                    "transformed_ngram_table": transformed_ngram_table_name,
+                    "old_score_table": lexicon["score_table"],
+                    "new_score_table": new_score_table,
+                })
+    return pd.DataFrame(rows)
+
+
+def print_manifest_plan(plan_df : pd.DataFrame):
+    """
+    Print how much work a manifest plan shares, compared to one `run_pipeline` call per entry.
+    """
+    print("Manifest grid: {} entries".format(len(plan_df)))
+    print("  basetables to create:          {}".format(plan_df.basetable.nunique()))
+    print("  ngram table pulls:             {}".format(plan_df.category_tag.nunique()))
+    print("  transformed tables to upload:  {}".format(plan_df.transformed_ngram_table.nunique()))
+    print("  dlatk scoring runs:            {}".format(len(plan_df)))
+    print(plan_df[["category_value", "swap_type", "lexicon", "new_score_table"]])
+
+
+def run_manifest(manifest : dict):
+    """
+    Run the gender swap pipeline for every (category, swap type, lexicon) entry of a manifest,
+    sharing the work that does not depend on the lexicon. For each category filter the
+    basetables are created once, the ngram table is read once, and every swap type's
+    transformed ngram table is uploaded once; only the dlatk scoring and the score comparison
+    fan out per lexicon. All results are stored in a single table, with `lexicon`,
+    `category_value` and `category_tag` columns identifying the entry.
+
+    Parameters
+    ----------
+    manifest
+        A normalized manifest, see `load_manifest` and `normalize_manifest`
+
+    Returns
+    -------
+    The consolidated results DataFrame
+    """
+    db = manifest["db"]
+    message_table = manifest["message_table"]
+    plots_path = manifest["plots_path"]
+
+    if not os.path.exists(plots_path):
+        os.mkdir(plots_path)
+
+    plan_df = plan_manifest(manifest)
+    print_manifest_plan(plan_df)
+
+    results = []
+
+    for category in manifest["categories"]:
+
+        print("\n\nCategory filter: {}.{} = '{}'".format(category["table"], category["column"], category["value"]))
+
+        ### Create Basetables with Message IDs, shared by all lexicons
+        print("\nStep 1: Creating Basetables containing Message IDs to be transformed.\n")
+        basetable_names = {}
+        for swap_type in manifest["swap_types"]:
+            basetable_names[swap_type] = manifest_basetable_name(manifest, category, swap_type)
+            create_base_table(basetable_names[swap_type], category["table"], category["column"], category["value"], db)
+
+        ### Read the ngrams once, every swap type transforms its own copy
+        print("\nStep 2: Reading ngram table and swapping gender terms.\n")
+        if manifest["semijoin"]:
+            category_ids = load_category_ids(category["table"], category["column"], category["value"], db)
+            ngram_df = read_ngrams_semijoin(manifest["ngram_table"], category_ids, db)
+        else:
+            ngram_df = read_ngrams(manifest["ngram_table"], basetable_names[manifest["swap_types"][0]], db)
+
+        lexicon_tables = {lexicon["name"]: [] for lexicon in manifest["lexicons"]}
+
+        for swap_type in manifest["swap_types"]:
+            basetable_name = basetable_names[swap_type]
+            print("\nPerforming transformation: {}".format(SWAP_DICTIONARY.get(swap_type).get('transformation_name')))
+
+            transformed_df = remap_swap_type(ngram_df, swap_type)
+            metadata_df = create_tranformation_metadata_table(transformed_df)
+
+            transformed_ngram_table_name, _ = derive_table_names(message_table, basetable_name,
+                                                                 manifest["ngram_table"], manifest["lexicons"][0]["score_table"])
+            print("\nStep 3: Push updated ngram table to the database.\n")
+            store_table(create_transformed_ngram_table(transformed_df), transformed_ngram_table_name, db)
+
+            ### Only the scoring fans out per lexicon
+            for lexicon in manifest["lexicons"]:
+                _, new_score_table = derive_table_names(message_table, basetable_name,
+                                                        manifest["ngram_table"], lexicon["score_table"])
+                print("\nStep 4: Scoring {} with lexicon {}.\n".format(swap_type, lexicon["name"]))
+                run_lexicon_scoring(transformed_ngram_table_name, basetable_name, lexicon["name"],
+                                    lexicon["weighted"], db)
+                effect_df = compare_transform_scores(lexicon["score_table"], new_score_table, db)
+
+                lexicon_tables[lexicon["name"]].append(swap_result_table(metadata_df, effect_df, swap_type))
+
+        for lexicon_name, final_tables in lexicon_tables.items():
+            final_df = combine_swap_results(final_tables)
+            generate_boxplot(final_df, save_path = "{}/{}_{}_{}.png".format(plots_path, message_table, category["tag"], lexicon_name))
+            final_df.insert(1, 'lexicon', lexicon_name)
+            final_df.insert(2, 'category_value', category["value"])
+            final_df.insert(3, 'category_tag', category["tag"])
+            results.append(final_df)
+
+    print("\nCompiling results from all manifest entries...\n")
+    result_df = pd.concat(results, ignore_index = True, sort = False)
+    if manifest["include_messages"]:
+        result_df = attach_messages(result_df, message_table, db)
+    print(result_df.head(10))
+
+    store_table(result_df, manifest["result_table"], db)
+    if manifest["export_path"] is not None:
+        # Every lexicon is a partition, and the category value is kept as a column
+        export_results(result_df, manifest["export_path"])
+
+    print("\nManifest run is complete!\n")
+    print("Your results can be found in the table {}.{}".format(db, manifest["result_table"]))
+    print("Your boxplots can be found in {}".format(plots_path))
+    if manifest["export_path"] is not None:
+        print("Your exported results can be found under {}".format(manifest["export_path"]))
+    return result_df
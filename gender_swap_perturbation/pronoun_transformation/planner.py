@@ -0,0 +1,261 @@
+import numpy as np
+import pandas as pd
+from .get_engine import engine_from_config
+from .swap_gender_pronouns import SWAP_DICTIONARY
+from .instrumentation import PIPELINE_STAGES, DEFAULT_THROUGHPUT_LOG, read_throughput_log
+from .pronoun_transformation_pipeline import derive_table_names, ngram_join_sql
+
+
+# The stages `run_pipeline_async` runs concurrently within a swap type
+ASYNC_OVERLAPPED_STAGES = ["read", "remap", "upload"]
+
+
+def table_statistics(engine, table_names : list) -> pd.DataFrame:
+    """
+    Read the row count estimate and average row length the server keeps for every table,
+    with a single catalog query. Nothing is scanned, so the counts of InnoDB tables are
+    approximate.
+
+    Parameters
+    ----------
+    engine
+        A SQLAlchemy engine, see `engine_from_config`
+    table_names
+        The names of the tables
+
+    Returns
+    -------
+    A pandas DataFrame indexed by table name, with `table_rows`, `avg_row_length` and
+    `data_length` columns. Tables that don't exist are missing from the index.
+    """
+    table_names = list(dict.fromkeys(table_names))
+    with engine.connect() as conn:
+        df = pd.read_sql(
+            """SELECT table_name AS 'table_name', table_rows AS 'table_rows',
+            avg_row_length AS 'avg_row_length', data_length AS 'data_length'
+            FROM information_schema.tables
+            WHERE table_schema = DATABASE() AND table_name IN ({placeholders});""".format(
+                placeholders = ", ".join(["%s"] * len(table_names))),
+            conn,
+            params = tuple(table_names),
+        )
+    return df.set_index("table_name").fillna(0)
+
+
+def explain_rows(engine, sql : str) -> float:
+    """
+    Estimate the number of rows a query returns from its `EXPLAIN` plan, without running it.
+    The estimate multiplies the rows examined per table of the plan, scaled by the percentage
+    of them the server expects to pass the conditions.
+
+    Parameters
+    ----------
+    engine
+        A SQLAlchemy engine, see `engine_from_config`
+    sql
+        A SELECT query
+
+    Returns
+    -------
+    The estimated number of rows
+    """
+    with engine.connect() as conn:
+        plan_df = pd.read_sql("EXPLAIN " + sql.strip().rstrip(";") + ";", conn)
+    rows = plan_df["rows"].fillna(1).astype(np.float64)
+    filtered = plan_df["filtered"].fillna(100).astype(np.float64) / 100 if "filtered" in plan_df.columns else 1.0
+    return float(np.prod(rows * filtered))
+
+
+def plan_pipeline(db,
+                message_table,
+                user_initials,
+                lexicon_table_name,
+                ngram_table_name,
+                old_score_table,
+                category_table,
+                category_col,
+                category_name,
+                scorer = None,
+                lexicon_workers = None,
+                async_mode = False,
+                throughput_log = DEFAULT_THROUGHPUT_LOG,
+                **pipeline_args):
+    """
+    Plan a `run_pipeline` or `run_pipeline_async` call without running it: resolve every table
+    the run reads and writes, check which exist, and estimate the rows pulled, rows uploaded,
+    bytes transferred and time of every stage. Only catalog queries and `EXPLAIN` are sent to
+    the server.
+
+    Row counts come from the table statistics and `EXPLAIN` plans. Times come from the
+    throughput of previous runs in `throughput_log` (see `append_throughput_log`), and are
+    missing for stages which were never logged.
+
+    Parameters
+    ----------
+    scorer
+        If given, the run scores locally (see `run_pipeline`), so nothing is uploaded or
+        scored by dlatk
+    lexicon_workers
+        If given, the run scores the lexicon locally (see `run_pipeline`), so the lexicon
+        table is read but nothing is uploaded or scored by dlatk
+    async_mode
+        If True, plan `run_pipeline_async`, which writes the same tables but overlaps the
+        read, remap and upload stages of every swap type
+    throughput_log
+        The log of previous runs
+    pipeline_args
+        The other arguments of `run_pipeline`, which don't change the plan
+
+    Returns
+    -------
+    A tuple of (tables DataFrame with one row per table, stages DataFrame with one row per
+    swap type and stage, list of problems which would make the run fail or overwrite data).
+    Stages which run concurrently with the other stages of their swap type have `overlap` set.
+    """
+    engine = engine_from_config(database = db)
+    swap_types = list(SWAP_DICTIONARY.keys())
+    local_scoring = scorer is not None or lexicon_workers is not None
+    scoring_note = "scored locally" if scorer is not None else "lexicon scored locally in {} processes".format(lexicon_workers)
+    final_table_name = message_table + "_" + user_initials + "_" + lexicon_table_name + "_" +  "gender_swap"
+
+    tables = [("message table", None, message_table), ("category table", None, category_table),
+              ("ngram table", None, ngram_table_name), ("original score table", None, old_score_table)]
+    if scorer is None:
+        tables.append(("lexicon table", None, lexicon_table_name))
+    for swap_type in swap_types:
+        basetable_name = message_table + "_" + user_initials + "_" + swap_type
+        transformed_ngram_table_name, new_score_table = derive_table_names(message_table, basetable_name,
+                                                                           ngram_table_name, old_score_table)
+        tables.append(("basetable", swap_type, basetable_name))
+        if not local_scoring:
+            tables.append(("transformed ngram table", swap_type, transformed_ngram_table_name))
+            tables.append(("new score table", swap_type, new_score_table))
+    tables.append(("results table", None, final_table_name))
+
+    tables_df = pd.DataFrame(tables, columns = ["role", "swap_type", "table"])
+    statistics = table_statistics(engine, list(tables_df["table"]))
+    tables_df["exists"] = tables_df["table"].isin(statistics.index)
+    tables_df["table_rows"] = tables_df["table"].map(statistics["table_rows"])
+    tables_df["avg_row_length"] = tables_df["table"].map(statistics["avg_row_length"])
+
+    problems = []
+    inputs = tables_df[tables_df["swap_type"].isna() & (tables_df["role"] != "results table")]
+    for _, row in inputs[~inputs["exists"]].iterrows():
+        problems.append("The {} {} doesn't exist".format(row["role"], row["table"]))
+    for output_role, input_table in [("transformed ngram table", ngram_table_name), ("new score table", old_score_table)]:
+        if (tables_df[tables_df["role"] == output_role]["table"] == input_table).any():
+            problems.append("{} has no ${}$ segment, the {} would overwrite it".format(input_table, message_table, output_role))
+    if not tables_df[tables_df["role"].isin(["message table", "category table", "ngram table"])]["exists"].all():
+        # Without the inputs there is nothing to estimate
+        return tables_df, pd.DataFrame(columns = ["swap_type", "stage", "overlap"]), problems
+
+    def statistic(table, column):
+        return float(statistics[column].get(table, 0))
+
+    # Every swap type selects the same messages, so the category is explained once
+    category_messages = explain_rows(engine, """SELECT DISTINCT group_id FROM {category_table}
+        WHERE {category_col} = '{category_name}'""".format(category_table = category_table,
+            category_col = category_col, category_name = category_name))
+    messages = statistic(message_table, "table_rows")
+    ngram_rows = statistic(ngram_table_name, "table_rows")
+    ngram_row_length = statistic(ngram_table_name, "avg_row_length")
+    score_row_length = statistic(old_score_table, "avg_row_length")
+
+    throughput = read_throughput_log(throughput_log)
+
+    stages = []
+    for swap_type in swap_types:
+        basetable_name = message_table + "_" + user_initials + "_" + swap_type
+        if basetable_name in statistics.index:
+            base_messages = statistic(basetable_name, "table_rows")
+            rows_pulled = explain_rows(engine, ngram_join_sql(ngram_table_name, basetable_name))
+            basetable_note = "exists, creation is skipped"
+        else:
+            base_messages = category_messages
+            rows_pulled = ngram_rows * min(1.0, base_messages / messages) if messages else ngram_rows
+            basetable_note = "created from {}".format(category_table)
+        rows_uploaded = 0 if local_scoring else rows_pulled
+        chunk_note = "in chunks, overlapping the read, remap and upload" if async_mode else ""
+
+        swap_stages = {
+            "basetable": (0, 0, 0, 0 if basetable_name in statistics.index else base_messages, basetable_note),
+            "read": (rows_pulled, 0, rows_pulled * ngram_row_length, rows_pulled, chunk_note),
+            "remap": (0, 0, 0, rows_pulled, chunk_note or "in memory"),
+            "upload": (0, rows_uploaded, rows_uploaded * ngram_row_length, rows_uploaded,
+                       "local scoring, nothing uploaded" if local_scoring else chunk_note),
+            "score": (0, 0, 0, rows_uploaded, scoring_note if local_scoring else "dlatk, on the server"),
+            "compare": (base_messages, 0, base_messages * score_row_length, base_messages, ""),
+        }
+        for stage in PIPELINE_STAGES:
+            rows_pulled_stage, rows_uploaded_stage, bytes_transferred, work_rows, note = swap_stages[stage]
+            stages.append({
+                "swap_type": swap_type,
+                "stage": stage,
+                "rows_pulled": int(rows_pulled_stage),
+                "rows_uploaded": int(rows_uploaded_stage),
+                "bytes_transferred": int(bytes_transferred),
+                "est_seconds": _estimate_seconds(throughput, stage, work_rows, basetable_name in statistics.index,
+                                                 local_scoring),
+                "overlap": async_mode and stage in ASYNC_OVERLAPPED_STAGES,
+                "note": note,
+            })
+
+    return tables_df, pd.DataFrame(stages), problems
+
+
+def _total_seconds(stages_df : pd.DataFrame) -> float:
+    """
+    Estimate the time of a whole run: the sum of the stage times, where stages which overlap
+    only count with the slowest of them per swap type.
+    """
+    sequential = stages_df.loc[~stages_df["overlap"].astype(bool), "est_seconds"].sum(min_count = 1)
+    overlapped = stages_df[stages_df["overlap"].astype(bool)].groupby("swap_type")["est_seconds"].max().sum(min_count = 1)
+    return float(np.nansum([sequential, overlapped]))
+
+
+def _estimate_seconds(throughput : pd.DataFrame, stage : str, work_rows : float, skipped : bool = False,
+    local_scoring : bool = False) -> float:
+    """
+    Estimate the time of a stage from the logged throughput: rows divided by rows per second,
+    or the time per chunk for stages logged without rows. NaN if the stage was never logged.
+    With local scoring nothing is uploaded, and the logged score throughput is that of dlatk,
+    so the score time is NaN.
+    """
+    if stage == "basetable" and skipped:
+        return 0.0
+    if local_scoring and stage == "upload":
+        return 0.0
+    if local_scoring and stage == "score":
+        return float("nan")
+    if stage not in throughput.index:
+        return float("nan")
+    rows_per_second = throughput.loc[stage, "rows_per_second"]
+    if pd.notna(rows_per_second) and work_rows > 0:
+        return float(work_rows / rows_per_second)
+    return float(throughput.loc[stage, "seconds_per_chunk"])
+
+
+def print_plan(tables_df : pd.DataFrame, stages_df : pd.DataFrame, problems : list):
+    """
+    Print a plan from `plan_pipeline`: the tables, the estimates per stage summed over the
+    swap types, and the problems found.
+    """
+    print("Tables:\n")
+    print(tables_df.to_string(index = False))
+
+    if not stages_df.empty:
+        totals_df = stages_df.groupby("stage", sort = False)[["rows_pulled", "rows_uploaded", "bytes_transferred",
+                                                             "est_seconds"]].sum(min_count = 1)
+        print("\nEstimated work per stage, over all swap types:\n")
+        print(totals_df.to_string())
+        print("\nEstimated total: {:.0f} rows pulled, {:.0f} rows uploaded, {:.1f} MB transferred, {}".format(
+            totals_df["rows_pulled"].sum(), totals_df["rows_uploaded"].sum(), totals_df["bytes_transferred"].sum() / 1e6,
+            "{:.0f} s".format(_total_seconds(stages_df)) if totals_df["est_seconds"].notna().all()
+            else "time unknown for stages without logged runs"))
+
+    if problems:
+        print("\nProblems:\n")
+        for problem in problems:
+            print("  " + problem)
+    else:
+        print("\nNo problems found.")
@@ -1,10 +1,21 @@
 import os
+import json
+import time
+import numpy as np
 import pandas as pd
 from sys import argv
 import subprocess
+from functools import lru_cache
 from .get_engine import engine_from_config
 from .swap_gender_pronouns import remap_df, remap_df_swap, gender_name_to_id
 from .swap_gender_pronouns import SWAP_DICTIONARY
+from .scorers import Scorer, score_transform_effect, score_message_swap
+from .dedup import dedup_feature_bags, dedup_report, fan_out
+from .shared_features import parallel_lexicon_effect
+from .attribution import load_lexicon_weights, attribute_swap, rank_attributions
+from .instrumentation import PIPELINE_STAGES, DEFAULT_THROUGHPUT_LOG, StageStats, stage_timer
+from .instrumentation import utilization_report, append_throughput_log
+from .export import export_results
 from functools import reduce
 
 import matplotlib.pyplot as plt
@@ -34,14 +45,15 @@ def create_base_table(basetable_name : str, category_table : str, category_col :
 
     """
     engine = engine_from_config(database = db)
-    if basetable_name in engine.table_names():
+    if table_exists(engine, basetable_name):
         print(basetable_name, "already exists! Skipping creation...")
     else:
         with engine.connect() as conn:
+            # The primary key gives the ngram table join an index on the basetable side
             conn.execute(
-                """CREATE TABLE {basetable_name} AS
+                """CREATE TABLE {basetable_name} (PRIMARY KEY (sid)) AS
                 (
-                SELECT {category_table}.group_id AS sid
+                SELECT DISTINCT {category_table}.group_id AS sid
                 FROM {category_table}
                 WHERE {category_table}.{category_col} = '{category_name}'
                 );""".format(basetable_name = basetable_name, category_table = category_table,
@@ -49,9 +61,165 @@ def create_base_table(basetable_name : str, category_table : str, category_col :
             )
 
 
+def table_exists(engine, table_name : str) -> bool:
+    """
+    Check whether a table exists in the engine's database with a single catalog lookup,
+    instead of listing every table.
+
+    Parameters
+    ----------
+    engine
+        A SQLAlchemy engine, see `engine_from_config`
+    table_name
+        The name of the table
+
+    Returns
+    -------
+    True if the table exists
+    """
+    with engine.connect() as conn:
+        result = conn.execute(
+            """SELECT 1 FROM information_schema.tables
+            WHERE table_schema = DATABASE() AND table_name = %s
+            LIMIT 1;""", (table_name,)
+        )
+        return result.first() is not None
+
+
+@lru_cache(maxsize = None)
+def load_category_ids(category_table : str, category_col : str = 'feat', category_name : str = 'PRONOUN',
+    db : str = 'politeness') -> np.ndarray:
+    """
+    Read the ids of the messages in a category as a sorted array. The result is cached, so
+    every swap type of a run filters against the same id set with a single query.
+
+    Parameters
+    ----------
+    category_table, category_col, category_name
+        See `create_base_table`
+    db
+        The name of the db
+
+    Returns
+    -------
+    A sorted, read-only numpy array of unique message ids
+    """
+    engine = engine_from_config(database = db)
+    with engine.connect() as conn:
+        ids = pd.read_sql(
+            """SELECT DISTINCT group_id FROM {category_table}
+            WHERE {category_col} = '{category_name}';""".format(category_table = category_table,
+                category_col = category_col, category_name = category_name),
+            conn,
+        )["group_id"].values
+    ids = np.unique(ids)
+    ids.setflags(write = False)
+    return ids
+
+
+def read_ngrams_semijoin(ngram_table_name : str, category_ids : np.ndarray, db : str = 'politeness',
+    batch_size : int = 10000) -> pd.DataFrame:
+    """
+    Collect the n-grams of the messages in `category_ids` without joining against a basetable.
+    The ids are sent to the server in batches of `IN` lists, so with the usual index on
+    `group_id` only the rows of the category's messages are read, as with the join.
+
+    This mode saves the join against the basetable for every swap type, since the ids are
+    read once per run (see `load_category_ids`). It reads the same ngram rows as the join, so
+    it doesn't help when that join is already cheap.
+
+    Parameters
+    ----------
+    ngram_table_name
+        The name of the ngram table to be read
+    category_ids
+        A sorted array of message ids, see `load_category_ids`
+    db
+        The name of the db
+    batch_size
+        The number of ids per query
+
+    Returns
+    -------
+    A pandas DataFrame which contains the rows of the n-gram table for the given messages.
+    """
+    engine = engine_from_config(database = db)
+    parts = []
+    with engine.connect() as conn:
+        if len(category_ids) == 0:
+            return pd.read_sql("SELECT * FROM {ngram_table_name} LIMIT 0;".format(ngram_table_name = ngram_table_name), conn)
+        for start in range(0, len(category_ids), batch_size):
+            ids = ", ".join(str(int(group_id)) for group_id in category_ids[start:start + batch_size])
+            parts.append(pd.read_sql("""SELECT * FROM {ngram_table_name}
+                WHERE group_id IN ({ids});""".format(ngram_table_name = ngram_table_name, ids = ids), conn))
+    return pd.concat(parts, ignore_index = True)
+
+
+def derive_table_names(message_table : str, basetable_name : str, ngram_table_name : str,
+    old_score_table : str) -> tuple:
+    """
+    Resolve the names of the transformed ngram table and the score table that dlatk will
+    create for a basetable, by substituting the basetable for the message table in the
+    `$message_table$` segment of the original table names.
+
+    Parameters
+    ----------
+    message_table
+        The name of the original message table
+    basetable_name
+        The name of the basetable containing ids of messages to be transformed
+    ngram_table_name
+        The name of the original ngram table
+    old_score_table
+        The name of the original score table
+
+    Returns
+    -------
+    A tuple of (transformed ngram table name, new score table name)
+    """
+    message_table_ref = "$" + message_table + "$"
+    base_table_ref = "$" + basetable_name + "$"
+    transformed_ngram_table_name = ngram_table_name.replace(message_table_ref, base_table_ref)
+    new_score_table = old_score_table.replace(message_table_ref, base_table_ref)
+    return transformed_ngram_table_name, new_score_table
+
+
+def read_ngrams(ngram_table_name : str, basetable_name : str, db : str = 'politeness') -> pd.DataFrame:
+    """
+    Collect all of the n-grams from the messages in the basetable, without transforming them.
+
+    Parameters
+    ----------
+    ngram_table_name
+        The name of the ngram table to be read
+    basetable_name
+        The name of the basetable containing ids of messages to be transformed
+    db
+        The name of the db
+
+    Returns
+    -------
+    A pandas DataFrame which contains the rows of the n-gram table for the basetable messages.
+    """
+    engine = engine_from_config(database = db)
+    with engine.connect() as conn:
+        df = pd.read_sql(ngram_join_sql(ngram_table_name, basetable_name), conn)
+    return df
+
+
+def ngram_join_sql(ngram_table_name : str, basetable_name : str) -> str:
+    """
+    The query selecting the rows of the ngram table for the messages in the basetable.
+    """
+    return """SELECT {ngram_table_name}.*
+            FROM {ngram_table_name} INNER JOIN {basetable_name}
+            ON {ngram_table_name}.group_id={basetable_name}.sid;""".format(ngram_table_name = ngram_table_name, 
+                basetable_name = basetable_name)
+
+
 def transform_ngrams(ngram_table_name : str, basetable_name : str, 
                         gender_from_names: list, gender_to_name: str,
-                        db : str = 'politeness') -> pd.DataFrame:
+                        db : str = 'politeness', category_ids : np.ndarray = None) -> pd.DataFrame:
     """
     Collect all of the n-grams from the messages to be analyzed, and perform the
     specified gender swaps.
@@ -68,21 +236,19 @@ def transform_ngrams(ngram_table_name : str, basetable_name : str,
         The name of the target gender for the replaced pronouns
     db
         The name of the db
+    category_ids
+        If given, a sorted array of message ids (see `load_category_ids`) whose ngrams are
+        read instead of joining the ngram table against the basetable
 
     Returns
     -------
     A pandas DataFrame which contains the n-gram table with the `feat` column
     containing the transformed pronouns.
     """
-    engine = engine_from_config(database = db)
-    with engine.connect() as conn:
-        df = pd.read_sql(
-            """SELECT {ngram_table_name}.*
-            FROM {ngram_table_name} INNER JOIN {basetable_name}
-            ON {ngram_table_name}.group_id={basetable_name}.sid;""".format(ngram_table_name = ngram_table_name, 
-                basetable_name = basetable_name),
-            conn,
-        )
+    if category_ids is not None:
+        df = read_ngrams_semijoin(ngram_table_name, category_ids, db)
+    else:
+        df = read_ngrams(ngram_table_name, basetable_name, db)
 
     gender_from_ids = list(map(gender_name_to_id, gender_from_names))
     df = remap_df(
@@ -91,6 +257,30 @@ def transform_ngrams(ngram_table_name : str, basetable_name : str,
     return df
 
 
+def remap_swap_type(ngram_df : pd.DataFrame, swap_type : str) -> pd.DataFrame:
+    """
+    Apply the gender swap described by an entry of `SWAP_DICTIONARY` to a copy of an
+    already collected ngram DataFrame, leaving the input untouched so that it can be
+    reused for the other swap types.
+
+    Parameters
+    ----------
+    ngram_df
+        A DataFrame with a `feat` column, as returned by `read_ngrams`
+    swap_type
+        A key of `SWAP_DICTIONARY`, e.g. 'f2m'
+
+    Returns
+    -------
+    A pandas DataFrame which contains the n-gram table with the `feat` column
+    containing the transformed pronouns.
+    """
+    gender_from_names = SWAP_DICTIONARY.get(swap_type).get('gender_from_names')
+    gender_to_name = SWAP_DICTIONARY.get(swap_type).get('gender_to_name')
+    gender_from_ids = list(map(gender_name_to_id, gender_from_names))
+    return remap_df(ngram_df.copy(), gender_from_ids, gender_name_to_id(gender_to_name))
+
+
 def transform_ngrams_swap(ngram_table_name : str, basetable_name : str, 
                         a_gender: str, b_gender: str,
                         db : str = 'politeness') -> pd.DataFrame:
@@ -114,15 +304,7 @@ def transform_ngrams_swap(ngram_table_name : str, basetable_name : str,
     A pandas DataFrame which contains the n-gram table with the `feat` column
     containing the transformed pronouns.
     """
-    engine = engine_from_config(database = db)
-    with engine.connect() as conn:
-        df = pd.read_sql(
-            """SELECT {ngram_table_name}.*
-            FROM {ngram_table_name} INNER JOIN {basetable_name}
-            ON {ngram_table_name}.group_id={basetable_name}.sid;""".format(ngram_table_name = ngram_table_name, 
-                basetable_name = basetable_name),
-            conn,
-        )
+    df = read_ngrams(ngram_table_name, basetable_name, db)
 
     df = remap_df_swap(
         df, gender_name_to_id(a_gender), gender_name_to_id(b_gender)
@@ -183,7 +365,7 @@ def calculate_transformed_scores(transformed_df: pd.DataFrame,
     db : str = 'politeness'):
     """
     Create a n-gram table from the `transformed_df`, and runs dlatk to compute
-    lexicon scores on the transformed messages.
+    lexicon scores on the transformed messages (see `run_lexicon_scoring`).
 
     Parameters
     ----------
@@ -204,18 +386,55 @@ def calculate_transformed_scores(transformed_df: pd.DataFrame,
     #upload ngrams to table
     store_table(transformed_df, table_name, db)
 
-    weighted_lexicon_condition = '--weighted_lexicon' if weighted_lexicon_flag else ''
+    run_lexicon_scoring(transformed_ngram_table_name, basetable_name, lexicon_table_name, weighted_lexicon_flag, db)
+
+
+def run_lexicon_scoring(transformed_ngram_table_name : str,
+    basetable_name : str,
+    lexicon_table_name : str,
+    weighted_lexicon_flag: bool,
+    db : str = 'politeness'):
+    """
+    Run dlatk to compute lexicon scores on an already uploaded transformed ngram table.
+
+    Parameters
+    ----------
+    transformed_ngram_table_name
+        The name of the gender swapped ngram table in sql
+    basetable_name
+        The name of the basetable created for this task
+    lexicon_table_name
+        The name of the lexicon table to be applied to the basetable
+    weighted_lexicon_flag
+        Whether the lexicon is weighted
+    db
+        The name of the db
+    """
     # Use dlatk to create lex table
     print("Calculating updating scores...")
-    dlatk_command = "~/dlatkInterface.py -d {db} -t {basetable_name} -c sid --add_lex_table -l {lexicon_table_name} {weighted_lexicon_condition} --word_table '{transformed_ngram_table_name}'".format(
-        db = db, basetable_name = basetable_name, lexicon_table_name = lexicon_table_name, 
-        weighted_lexicon_condition = weighted_lexicon_condition,
-        transformed_ngram_table_name = transformed_ngram_table_name)
+    dlatk_command = dlatk_lexicon_command(transformed_ngram_table_name, basetable_name, lexicon_table_name,
+                                          weighted_lexicon_flag, db)
     print("Running: ", dlatk_command)
     output = subprocess.call(dlatk_command, shell=True)
     print("dlatk command returned ", output)
 
 
+def dlatk_lexicon_command(transformed_ngram_table_name : str,
+    basetable_name : str,
+    lexicon_table_name : str,
+    weighted_lexicon_flag: bool,
+    db : str = 'politeness') -> str:
+    """
+    The shell command running dlatk to score a transformed ngram table with a lexicon, see
+    `run_lexicon_scoring` for the parameters.
+    """
+    weighted_lexicon_condition = '--weighted_lexicon' if weighted_lexicon_flag else ''
+    return "~/dlatkInterface.py -d {db} -t {basetable_name} -c sid --add_lex_table -l {lexicon_table_name} {weighted_lexicon_condition} --word_table '{transformed_ngram_table_name}'".format(
+        db = db, basetable_name = basetable_name, lexicon_table_name = lexicon_table_name, 
+        weighted_lexicon_condition = weighted_lexicon_condition,
+        transformed_ngram_table_name = transformed_ngram_table_name)
+
+
 def compare_transform_effect(old_score_table : str, new_score_table : str, message_table : str, db : str = 'politeness'):
     """
     Select the message id, the lexicon-predicted scores of the original message,
@@ -257,6 +476,156 @@ def compare_transform_effect(old_score_table : str, new_score_table : str, messa
         df["score_difference"] = df["original_score"] - df["transformed_score"]
         return df
 
+def compare_transform_scores(old_score_table : str, new_score_table : str, db : str = 'politeness',
+    group_map : pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Select the message id and the lexicon-predicted scores of the original and the transformed
+    message, and compute their difference. Unlike `compare_transform_effect` no message text
+    is read; see `fetch_messages` to get the text of selected messages.
+
+    Parameters
+    ----------
+    old_score_table
+        The name of the score table of the original messages
+    new_score_table
+        The name of the score table of the transformed messages
+    db
+        The name of the db
+    group_map
+        If only representative messages were scored, the group map from `dedup_feature_bags`;
+        their scores are copied to every message with the same ngram bag
+
+    Returns
+    -------
+    A pandas DataFrame with `id`, `original_score`, `transformed_score` and `score_difference` columns
+    """
+    sql = """SELECT {old_score_table}.group_id AS 'id',
+    {old_score_table}.group_norm AS 'original_score',
+    {new_score_table}.group_norm AS 'transformed_score'
+
+    FROM {old_score_table} INNER JOIN {new_score_table}
+    ON {old_score_table}.group_id={new_score_table}.group_id""".format(
+        old_score_table = old_score_table, new_score_table = new_score_table)
+    engine = engine_from_config(database = db)
+    with engine.connect() as conn:
+        df = pd.read_sql(sql, conn)
+    df["score_difference"] = df["original_score"] - df["transformed_score"]
+    if group_map is not None:
+        df = fan_out(df, group_map)
+    return df
+
+
+def select_top_affected(effect_df : pd.DataFrame, k : int = 10) -> pd.DataFrame:
+    """
+    Select the `k` messages with the largest absolute score difference, with a partial sort
+    instead of sorting every message.
+
+    Parameters
+    ----------
+    effect_df
+        A DataFrame with a `score_difference` column, e.g. from `compare_transform_scores`
+    k
+        The number of messages to select
+
+    Returns
+    -------
+    The `k` rows of `effect_df` with the largest absolute score difference, largest first,
+    leaving out messages whose score didn't change
+    """
+    abs_difference = effect_df["score_difference"].abs()
+    abs_difference = abs_difference[abs_difference > 0]
+    return effect_df.loc[abs_difference.nlargest(k).index]
+
+
+def top_affected_messages(old_score_table : str, new_score_table : str, message_table : str, k : int = 10,
+    db : str = 'politeness') -> pd.DataFrame:
+    """
+    Select the `k` messages whose score changed the most, letting the database sort and limit
+    the score differences, and read the text of these `k` messages only. With deduplicated
+    scoring only the representative of each ngram bag is in the new score table.
+
+    Parameters
+    ----------
+    old_score_table
+        The name of the score table of the original messages
+    new_score_table
+        The name of the score table of the transformed messages
+    message_table
+        The name of the original message table
+    k
+        The number of messages to select
+    db
+        The name of the db
+
+    Returns
+    -------
+    A pandas DataFrame with `id`, `message`, `original_score`, `transformed_score` and
+    `score_difference` columns, largest absolute difference first
+    """
+    sql = """SELECT {old_score_table}.group_id AS 'id',
+    {old_score_table}.group_norm AS 'original_score',
+    {new_score_table}.group_norm AS 'transformed_score'
+
+    FROM {old_score_table} INNER JOIN {new_score_table}
+    ON {old_score_table}.group_id={new_score_table}.group_id
+    WHERE {old_score_table}.group_norm <> {new_score_table}.group_norm
+    ORDER BY ABS({old_score_table}.group_norm - {new_score_table}.group_norm) DESC
+    LIMIT {k}""".format(old_score_table = old_score_table, new_score_table = new_score_table, k = int(k))
+    engine = engine_from_config(database = db)
+    with engine.connect() as conn:
+        df = pd.read_sql(sql, conn)
+    df["score_difference"] = df["original_score"] - df["transformed_score"]
+    return attach_messages(df, message_table, db)
+
+
+def fetch_messages(ids, message_table : str, db : str = 'politeness', batch_size : int = 10000) -> pd.DataFrame:
+    """
+    Read the text of the given messages only.
+
+    Parameters
+    ----------
+    ids
+        The message ids
+    message_table
+        The name of the original message table
+    db
+        The name of the db
+    batch_size
+        The maximum number of ids per query
+
+    Returns
+    -------
+    A pandas DataFrame with `id` and `message` columns
+    """
+    ids = pd.unique(pd.Series(ids).dropna())
+    parts = []
+    engine = engine_from_config(database = db)
+    with engine.connect() as conn:
+        for start in range(0, len(ids), batch_size):
+            id_list = ", ".join(repr(id_) for id_ in ids[start:start + batch_size].tolist())
+            parts.append(pd.read_sql(
+                """SELECT {message_table}.sid AS 'id', {message_table}.message AS message
+                FROM {message_table}
+                WHERE {message_table}.sid IN ({id_list})""".format(message_table = message_table, id_list = id_list),
+                conn,
+            ))
+    if not parts:
+        return pd.DataFrame(columns = ['id', 'message'])
+    return pd.concat(parts, ignore_index = True)
+
+
+def attach_messages(df : pd.DataFrame, message_table : str, db : str = 'politeness') -> pd.DataFrame:
+    """
+    Add a `message` column after the `id` column of `df`, reading the text of the messages
+    in `df` only.
+    """
+    messages_df = fetch_messages(df["id"], message_table, db)
+    df = df.merge(messages_df, on = 'id', how = 'left')
+    columns = [column for column in df.columns if column != 'message']
+    columns.insert(columns.index('id') + 1, 'message')
+    return df[columns]
+
+
 def store_table(df : pd.DataFrame, table_name : str, db : str = 'politeness'):
     """
     Upload a table to the database
@@ -316,16 +685,289 @@ def generate_boxplot(result_df, save_path):
     """
 
     df = result_df.copy()
-    df['f2m_delta'] = df['f2m_score'] - df['original_score']
-    df['m2f_delta'] = df['m2f_score'] - df['original_score']
-    df['m2n_delta'] = df['m2n_score'] - df['original_score']
-    df['f2n_delta'] = df['f2n_score'] - df['original_score']
-
-    plot_df = df[['id', 'f2m_delta', 'f2n_delta', 'm2n_delta', 'm2f_delta']]
-    plot_df = pd.melt(plot_df, id_vars = ['id'], value_vars = ['f2m_delta', 'f2n_delta', 'm2n_delta', 'm2f_delta'],
+    delta_columns = []
+    for swap_type in SWAP_DICTIONARY.keys():
+        if swap_type + '_score' in df.columns:
+            df[swap_type + '_delta'] = df[swap_type + '_score'] - df['original_score']
+            delta_columns.append(swap_type + '_delta')
+
+    plot_df = df[['id'] + delta_columns]
+    plot_df = pd.melt(plot_df, id_vars = ['id'], value_vars = delta_columns,
         var_name = 'type', value_name = 'delta')
-    fig = sns.boxplot(x = 'type', y = 'delta', data = plot_df, hue = 'type').get_figure()
+    # A figure of its own, so that plots made in the same process don't pile up on one axes
+    fig, ax = plt.subplots()
+    sns.boxplot(x = 'type', y = 'delta', data = plot_df, hue = 'type', ax = ax)
     fig.savefig(save_path)
+    plt.close(fig)
+
+
+def run_swap_transformation(swap_type : str, basetable_name : str, message_table : str, ngram_table_name : str,
+    old_score_table : str, lexicon_table_name : str, weighted_lexicon_flag : bool,
+    db : str = 'politeness', category_ids : np.ndarray = None, scorer : Scorer = None,
+    dedup : bool = False, report : dict = None, lexicon_weights : pd.Series = None,
+    attributions : list = None, stage_stats : dict = None) -> pd.DataFrame:
+    """
+    Run the transform, scoring and comparison steps of the pipeline for a single swap type on
+    an existing basetable.
+
+    Parameters
+    ----------
+    swap_type
+        A key of `SWAP_DICTIONARY`, e.g. 'f2m'
+    basetable_name
+        The name of the basetable containing ids of messages to be transformed
+    message_table
+        The name of the original message table
+    ngram_table_name
+        The name of the original ngram table
+    old_score_table
+        The name of the original score table
+    lexicon_table_name
+        The name of the lexicon table to be applied to the basetable
+    weighted_lexicon_flag
+        Whether the lexicon is weighted
+    db
+        The name of the db
+    category_ids
+        See `transform_ngrams`
+    scorer
+        If given, score the original and transformed messages locally with this `Scorer`
+        (see `run_swap_transformation_with_scorer`) instead of uploading the ngrams and running
+        dlatk with the lexicon
+    dedup
+        If True, transform, upload and score only one message per distinct ngram bag (see
+        `dedup_feature_bags`), and copy the results to the identical messages
+    report
+        If given, a dictionary in which the dedup statistics are stored under 'dedup'
+    lexicon_weights, attributions
+        If given, the term weights of the lexicon (see `load_lexicon_weights`) and a list to
+        which the attribution of the score differences to pronoun pairs is appended (see
+        `attribute_swap`)
+    stage_stats
+        If given, a dictionary of `StageStats` keyed by the stages in `PIPELINE_STAGES`, in
+        which the time and rows of every stage are recorded
+
+    Returns
+    -------
+    A pandas DataFrame with `id`, `original_score` and `<swap_type>_score` columns, for the
+    transformed messages
+    """
+    ### Collect ngrams, keeping one copy of identical messages
+    done = stage_timer(stage_stats, "read")
+    ngram_df, group_map = read_swap_ngrams(ngram_table_name, basetable_name, db, category_ids, dedup, report)
+    done(len(ngram_df))
+
+    if scorer is not None:
+        return run_swap_transformation_with_scorer(swap_type, ngram_df, message_table, scorer, db, group_map)
+
+    transformed_ngram_table_name, new_score_table = derive_table_names(message_table, basetable_name,
+                                                                       ngram_table_name, old_score_table)
+
+    ### Transform ngrams with Gender Swap
+    print("\nStep 2: Swapping gender terms in ngram table.\n")
+    done = stage_timer(stage_stats, "remap")
+    transformed_df = remap_swap_type(ngram_df, swap_type)
+    if attributions is not None:
+        attributions.append(attribute_swap(ngram_df, transformed_df, lexicon_weights, swap_type, group_map))
+    print("Example:")
+    print(transformed_df.head(10))
+
+    ### Create updated ngram df and transformation metadata df
+    onegram_df = create_transformed_ngram_table(transformed_df)
+    metadata_df = create_tranformation_metadata_table(transformed_df)
+    done(len(onegram_df))
+
+    ### Calculate Updated Politness Scores on Swapped Table
+    print("\nStep 3: Push updated ngram table to the database and re-run lexica-based model to gather updated scores.\n")
+    done = stage_timer(stage_stats, "upload")
+    store_table(onegram_df, transformed_ngram_table_name, db)
+    done(len(onegram_df))
+    done = stage_timer(stage_stats, "score")
+    run_lexicon_scoring(transformed_ngram_table_name, basetable_name, lexicon_table_name, weighted_lexicon_flag, db)
+    done(len(onegram_df))
+
+    ### Calculate the difference in scores before and after the gender swap
+    print("\nStep 4: Calculate score differences.\n")
+    done = stage_timer(stage_stats, "compare")
+    effect_df = compare_transform_scores(old_score_table, new_score_table, db, group_map)
+    done(len(effect_df))
+    print("Messages with the largest change in scores after gender swap:")
+    print(top_affected_messages(old_score_table, new_score_table, message_table, 10, db))
+
+    if group_map is not None:
+        metadata_df = fan_out(metadata_df, group_map, 'group_id')
+    swap_final_df = swap_result_table(metadata_df, effect_df, swap_type)
+
+    print(swap_final_df.head(10))
+
+    return swap_final_df
+
+
+def read_swap_ngrams(ngram_table_name : str, basetable_name : str, db : str = 'politeness',
+    category_ids : np.ndarray = None, dedup : bool = False, report : dict = None) -> tuple:
+    """
+    Collect the n-grams of the messages to be transformed, by joining the basetable or by the
+    in-memory semi-join, optionally keeping one message per distinct ngram bag.
+
+    Parameters
+    ----------
+    ngram_table_name, basetable_name, db, category_ids, dedup, report
+        See `run_swap_transformation`
+
+    Returns
+    -------
+    A tuple of (ngram DataFrame, group map from `dedup_feature_bags` or None without dedup)
+    """
+    if category_ids is not None:
+        ngram_df = read_ngrams_semijoin(ngram_table_name, category_ids, db)
+    else:
+        ngram_df = read_ngrams(ngram_table_name, basetable_name, db)
+
+    if not dedup:
+        return ngram_df, None
+
+    ngram_df, group_map = dedup_feature_bags(ngram_df)
+    dedup_stats = dedup_report(group_map)
+    print("Deduplication: {messages} messages, {unique_bags} unique ngram bags (ratio {dedup_ratio:.2f})".format(**dedup_stats))
+    if report is not None:
+        report["dedup"] = dedup_stats
+    return ngram_df, group_map
+
+
+def run_swap_transformation_with_scorer(swap_type : str, ngram_df : pd.DataFrame, message_table : str,
+    scorer : Scorer, db : str = 'politeness', group_map : pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Run the transform and comparison steps for a single swap type, scoring the messages with
+    a local model instead of dlatk. Only the messages that were transformed are scored, since
+    the others keep their original features. Nothing is uploaded to the database.
+
+    Parameters
+    ----------
+    swap_type, message_table, db
+        See `run_swap_transformation`
+    ngram_df
+        The ngrams of the messages, see `read_swap_ngrams`
+    scorer
+        A `Scorer`. Feature scorers get the ngram rows of the messages, text scorers the
+        message texts
+    group_map
+        If the ngrams were deduplicated, the group map from `dedup_feature_bags`
+
+    Returns
+    -------
+    A pandas DataFrame with `id`, `original_score` and `<swap_type>_score` columns, for the
+    transformed messages
+    """
+    print("\nStep 2: Swapping gender terms in ngram table.\n")
+    transformed_df = remap_swap_type(ngram_df, swap_type)
+    metadata_df = create_tranformation_metadata_table(transformed_df)
+    transformed_ids = metadata_df["group_id"].unique()
+
+    print("\nStep 3: Scoring original and transformed messages with {}.\n".format(type(scorer).__name__))
+    if scorer.input_type == "texts":
+        effect_df = score_message_swap(scorer, fetch_messages(transformed_ids, message_table, db), swap_type)
+    else:
+        effect_df = score_transform_effect(scorer,
+                                           ngram_df[ngram_df["group_id"].isin(transformed_ids)],
+                                           transformed_df[transformed_df["group_id"].isin(transformed_ids)])
+
+    print("\nStep 4: Calculate score differences.\n")
+    if group_map is not None:
+        effect_df = fan_out(effect_df, group_map)
+        metadata_df = fan_out(metadata_df, group_map, 'group_id')
+    print("Messages with the largest change in scores after gender swap:")
+    print(attach_messages(select_top_affected(effect_df, 10), message_table, db))
+
+    return swap_result_table(metadata_df, effect_df, swap_type)
+
+
+def run_swap_transformations_shared(swap_types : list, basetable_name : str, message_table : str,
+    ngram_table_name : str, lexicon_weights : pd.Series, workers : int, db : str = 'politeness',
+    category_ids : np.ndarray = None, dedup : bool = False, report : dict = None, attributions : list = None,
+    stage_stats : dict = None) -> list:
+    """
+    Run the transform, scoring and comparison steps for several swap types at once, scoring
+    the messages with the lexicon weights in worker processes. The ngrams are read once, and
+    the feature matrix, vocabulary, pronoun mappings of every swap type and weights are placed
+    in shared memory once (see `parallel_lexicon_effect`). Nothing is uploaded to the database.
+
+    Parameters
+    ----------
+    swap_types
+        Keys of `SWAP_DICTIONARY`
+    basetable_name
+        The name of a basetable containing ids of messages to be transformed, the same
+        messages for every swap type
+    message_table, ngram_table_name, db, category_ids, dedup, report, attributions, stage_stats
+        See `run_swap_transformation`
+    lexicon_weights
+        The term weights, see `load_lexicon_weights`
+    workers
+        The number of worker processes
+
+    Returns
+    -------
+    A list with one DataFrame per swap type, with `id`, `original_score` and `<swap_type>_score`
+    columns for the transformed messages
+    """
+    done = stage_timer(stage_stats, "read")
+    ngram_df, group_map = read_swap_ngrams(ngram_table_name, basetable_name, db, category_ids, dedup, report)
+    done(len(ngram_df))
+
+    print("\nStep 2 and 3: Swapping gender terms and scoring the messages in {} processes.\n".format(workers))
+    effect_df = parallel_lexicon_effect(ngram_df, lexicon_weights, swap_types, workers)
+
+    final_tables = []
+    for swap_type in swap_types:
+        print("\nStep 4: Calculate score differences for {}.\n".format(swap_type))
+        if attributions is not None:
+            attributions.append(attribute_swap(ngram_df, remap_swap_type(ngram_df, swap_type), lexicon_weights,
+                                               swap_type, group_map))
+        swap_effect_df = effect_df[effect_df["swap_type"] == swap_type].drop(columns = ["swap_type"])
+        # Every message with a swapped ngram is scored, like the messages in the transformation metadata
+        metadata_df = pd.DataFrame({"group_id": swap_effect_df["id"].values})
+        if group_map is not None:
+            swap_effect_df = fan_out(swap_effect_df, group_map)
+            metadata_df = fan_out(metadata_df, group_map, 'group_id')
+        print("Messages with the largest change in scores after gender swap:")
+        print(attach_messages(select_top_affected(swap_effect_df, 10), message_table, db))
+        final_tables.append(swap_result_table(metadata_df, swap_effect_df, swap_type))
+    return final_tables
+
+
+def swap_result_table(metadata_df : pd.DataFrame, effect_df : pd.DataFrame, swap_type : str) -> pd.DataFrame:
+    """
+    Keep the scores of the messages that were transformed, naming the transformed score
+    column after the swap type.
+
+    Parameters
+    ----------
+    metadata_df
+        The output of `create_tranformation_metadata_table`
+    effect_df
+        The output of `compare_transform_scores` or `compare_transform_effect`
+    swap_type
+        A key of `SWAP_DICTIONARY`, e.g. 'f2m'
+
+    Returns
+    -------
+    A pandas DataFrame with `id`, `original_score` and `<swap_type>_score` columns, and a
+    `message` column after `id` if `effect_df` has one
+    """
+    columns = ['id', 'message', 'original_score', 'transformed_score'] if 'message' in effect_df.columns \
+        else ['id', 'original_score', 'transformed_score']
+    swap_final_df = metadata_df.merge(effect_df, left_on = 'group_id', right_on = 'id')[columns]
+    score_column_name = swap_type + "_score"
+    swap_final_df.columns = columns[:-1] + [score_column_name]
+    return swap_final_df
+
+
+def combine_swap_results(final_tables : list) -> pd.DataFrame:
+    """
+    Outer join the per swap type results from `run_swap_transformation` into one wide table.
+    """
+    keys = ['id', 'message', 'original_score'] if 'message' in final_tables[0].columns else ['id', 'original_score']
+    return reduce(lambda left, right: pd.merge(left, right, on = keys, how = 'outer'), final_tables)
 
 
 def run_pipeline(db,
@@ -339,28 +981,71 @@ def run_pipeline(db,
                 plots_path,
                 category_table,
                 category_col,
-                category_name):
+                category_name,
+                semijoin = False,
+                include_messages = True,
+                scorer = None,
+                dedup = False,
+                attribution = False,
+                throughput_log = DEFAULT_THROUGHPUT_LOG,
+                export_path = None,
+                lexicon_workers = None):
     """
+    Run the gender swap pipeline for every swap type in `SWAP_DICTIONARY`, store the combined
+    scores in the `<message_table>_<user_initials>_<lexicon>_gender_swap` table and plot the
+    score deltas.
 
+    Parameters
+    ----------
+    semijoin
+        If True, read the ngrams of the category ids, cached once for all swap types (see
+        `read_ngrams_semijoin`), instead of joining the ngram table against every basetable.
+        The basetables are still created, since dlatk names and scopes the score tables by them.
+    include_messages
+        If True, read the text of the transformed messages once at the end and store it in the
+        results table. Otherwise the results table only has ids and scores.
+    scorer
+        If given, a `Scorer` used to score the messages locally instead of dlatk and the
+        lexicon; `lexicon_table_name` then only names the results table
+    dedup
+        If True, messages with identical ngram bags are transformed and scored once, see
+        `run_swap_transformation`. The dedup ratios are part of the run report, which is
+        printed and saved next to the boxplot.
+    attribution
+        If True, decompose the score differences into the contributions of the swapped pronoun
+        pairs and store the ranked totals in the `<results table>_attribution` table. Only
+        available when scoring with the lexicon.
+    throughput_log
+        The log to which the time and rows of every stage are appended, for the estimates of
+        `plan_pipeline`. None to not log the run.
+    export_path
+        If given, also export the results in long format as parquet files partitioned by swap
+        type and lexicon under this directory, see `export_results`
+    lexicon_workers
+        If given, score the lexicon locally in this many processes sharing the ngram features,
+        instead of uploading the transformed ngrams and running dlatk (see
+        `run_swap_transformations_shared`). The messages are then read and scored once for
+        all swap types. Ignored with `scorer`.
     """
 
     if not os.path.exists(plots_path):
         os.mkdir(plots_path)
 
     final_tables = []
+    run_report = {}
+    stage_stats = {stage: StageStats(stage) for stage in PIPELINE_STAGES}
+    start = time.perf_counter()
+    category_ids = load_category_ids(category_table, category_col, category_name, db) if semijoin else None
+    attributions = [] if attribution and scorer is None else None
+    lexicon_workers = lexicon_workers if scorer is None else None
+    lexicon_weights = load_lexicon_weights(lexicon_table_name, weighted_lexicon_flag, db = db) \
+        if attributions is not None or lexicon_workers is not None else None
 
     print("Starting Gender Swap Pipeline...\n\n")
 
     for swap_type in list(SWAP_DICTIONARY.keys()):
 
         basetable_name = message_table + "_" + user_initials + "_" + swap_type
-        message_table_ref = "$" + message_table + "$"
-        base_table_ref = "$" + basetable_name + "$"
-        transformed_ngram_table_name = ngram_table_name.replace(message_table_ref, base_table_ref)
-        new_score_table = old_score_table.replace(message_table_ref, base_table_ref)
-
-        gender_from_names = SWAP_DICTIONARY.get(swap_type).get('gender_from_names')
-        gender_to_name = SWAP_DICTIONARY.get(swap_type).get('gender_to_name')
         transformation_name = SWAP_DICTIONARY.get(swap_type).get('transformation_name')
 
 
@@ -369,55 +1054,66 @@ def run_pipeline(db,
 
         ### Create Basetable with Message IDs
         print("\nStep 1: Creating Basetable containing Message IDs to be transformed.\n")
+        done = stage_stats["basetable"].timer()
         create_base_table(basetable_name, category_table, category_col, category_name, db)
+        done()
+        if lexicon_workers is not None:
+            continue
 
-        ### Transform ngrams with Gender Swap
-        print("\nStep 2: Swapping gender terms in ngram table.\n")
-        transformed_df = transform_ngrams(ngram_table_name, basetable_name, gender_from_names, gender_to_name, db)
-        print("Example:")
-        print(transformed_df.head(10))
-
-        ### Create updated ngram df and transformation metadata df
-        onegram_df = create_transformed_ngram_table(transformed_df)
-        metadata_df = create_tranformation_metadata_table(transformed_df)
-
-        ### Calculate Updated Politness Scores on Swapped Table
-        print("\nStep 3: Push updated ngram table to the database and re-run lexica-based model to gather updated scores.\n")
-        calculate_transformed_scores(onegram_df, transformed_ngram_table_name, basetable_name, 
-                                            lexicon_table_name, weighted_lexicon_flag, db)
-
-        ### Calculate the difference in scores before and after the gender swap
-        print("\nStep 4: Calculate score differences.\n")
-        effect_df = compare_transform_effect(old_score_table, new_score_table, message_table, db)
-        print("Messages with a change in scores after gender swap:")
-        print(effect_df[effect_df.score_difference != 0].head(10))
-
-        swap_final_df = metadata_df.merge(effect_df, left_on = 'group_id', right_on = 'id')[['id', 'message', 'original_score', 'transformed_score']]
-        score_column_name = swap_type + "_score"
-        swap_final_df.columns = ['id', 'message', 'original_score', score_column_name]
-
-        print(swap_final_df.head(10))
+        swap_final_df = run_swap_transformation(swap_type, basetable_name, message_table, ngram_table_name,
+                                                old_score_table, lexicon_table_name, weighted_lexicon_flag, db,
+                                                category_ids, scorer, dedup, run_report.setdefault(swap_type, {}),
+                                                lexicon_weights, attributions, stage_stats)
 
         final_tables.append(swap_final_df)
 
+    if lexicon_workers is not None:
+        # Every basetable holds the same category ids, so the messages are read and scored once
+        swap_types = list(SWAP_DICTIONARY.keys())
+        final_tables = run_swap_transformations_shared(swap_types, message_table + "_" + user_initials + "_" + swap_types[0],
+                                                       message_table, ngram_table_name, lexicon_weights, lexicon_workers,
+                                                       db, category_ids, dedup, run_report, attributions, stage_stats)
+
     print("\nCompiling results from all gender transformations...\n")
 
-    final_df = reduce(lambda left, right: pd.merge(left, right, on = ['id', 'message', 'original_score'], how = 'outer'), final_tables)
+    final_df = combine_swap_results(final_tables)
+    if include_messages:
+        final_df = attach_messages(final_df, message_table, db)
 
     print(final_df.head(10))
 
     final_table_name = message_table + "_" + user_initials + "_" + lexicon_table_name + "_" +  "gender_swap"
 
     store_table(final_df, final_table_name, db)
+    if export_path is not None:
+        export_results(final_df, export_path, lexicon_table_name)
+
+    if attributions:
+        attribution_df = rank_attributions(attributions)
+        print("\nScore differences attributed to pronoun pairs:\n")
+        print(attribution_df.head(20))
+        store_table(attribution_df, final_table_name + "_attribution", db)
 
     print("\nCreating boxplot from results...\n")
 
     generate_boxplot(final_df, save_path = plots_path + "/" + final_table_name + ".png")
 
+    run_report["results"] = {"table": final_table_name, "messages": len(final_df)}
+    run_report["stages"] = utilization_report(list(stage_stats.values()), time.perf_counter() - start).to_dict(orient = "index")
+    if throughput_log is not None:
+        append_throughput_log(list(stage_stats.values()), final_table_name, throughput_log)
+    print("\nRun report:\n")
+    print(json.dumps(run_report, indent = 2))
+    with open(plots_path + "/" + final_table_name + "_report.json", "w") as fh:
+        json.dump(run_report, fh, indent = 2)
+
 
     print("\nPipeline is complete!\n") 
     print("Your results can be found in the table {}.{}".format(db, final_table_name))
     print("Your boxplot can be found at {}/{}.png".format(plots_path, final_table_name))
+    print("Your run report can be found at {}/{}_report.json".format(plots_path, final_table_name))
+    if export_path is not None:
+        print("Your exported results can be found under {}".format(export_path))
     
 
 
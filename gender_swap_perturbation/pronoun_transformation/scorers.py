@@ -0,0 +1,413 @@
+import pickle
+import hashlib
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from .swap_gender_pronouns import SWAP_DICTIONARY, replace_pronouns, gender_name_to_id
+from .shared_features import share_csr, attach_shared_arrays, csr_rows
+
+
+def build_vocabulary(feats) -> dict:
+    """
+    Map every distinct feature to a column index, in sorted order.
+
+    Parameters
+    ----------
+    feats
+        An iterable of features, e.g. the `feat` column of an ngram table
+
+    Returns
+    -------
+    A dictionary from feature to column index
+    """
+    return {feat: index for index, feat in enumerate(sorted(set(feats)))}
+
+
+def build_feature_matrix(ngram_df : pd.DataFrame, vocabulary : dict, group_ids = None,
+    value_col : str = 'group_norm') -> tuple:
+    """
+    Build a sparse group x feature matrix from an ngram table. Features missing from the
+    vocabulary are dropped, and repeated features of a group (e.g. "her" and "them" both
+    becoming "them") are summed.
+
+    Parameters
+    ----------
+    ngram_df
+        A DataFrame with `group_id`, `feat` and `value_col` columns
+    vocabulary
+        A dictionary from feature to column index, see `build_vocabulary`
+    group_ids
+        The group ids giving the row order of the matrix. Defaults to the sorted group ids
+        of `ngram_df`
+    value_col
+        The column holding the feature values
+
+    Returns
+    -------
+    A tuple of (scipy.sparse.csr_matrix, numpy array of the group id of every row)
+    """
+    if group_ids is None:
+        group_ids = np.sort(ngram_df["group_id"].unique())
+    group_ids = np.asarray(group_ids)
+
+    columns = ngram_df["feat"].map(vocabulary)
+    rows = pd.Index(group_ids).get_indexer(ngram_df["group_id"])
+    keep = columns.notna().values & (rows >= 0)
+
+    matrix = sparse.coo_matrix(
+        (ngram_df[value_col].values[keep].astype(np.float64), (rows[keep], columns.values[keep].astype(np.int64))),
+        shape = (len(group_ids), len(vocabulary)),
+    ).tocsr()
+    matrix.sum_duplicates()
+    return matrix, group_ids
+
+
+def _row_hashes(inputs) -> list:
+    """
+    Hash every row of a csr matrix, or every text in a list.
+    """
+    if sparse.issparse(inputs):
+        inputs = inputs.tocsr()
+        hashes = []
+        for row in range(inputs.shape[0]):
+            start, end = inputs.indptr[row], inputs.indptr[row + 1]
+            digest = hashlib.blake2b(inputs.indices[start:end].tobytes(), digest_size = 16)
+            digest.update(inputs.data[start:end].tobytes())
+            hashes.append(digest.digest())
+        return hashes
+    return [hashlib.blake2b(str(text).encode("utf-8"), digest_size = 16).digest() for text in inputs]
+
+
+def _take_rows(inputs, rows):
+    """
+    Select rows of a csr matrix, or items of a list of texts.
+    """
+    if sparse.issparse(inputs):
+        return inputs[rows]
+    return [inputs[row] for row in rows]
+
+
+def _predict_batch(scorer, batch):
+    """
+    Module level wrapper around `Scorer.predict_batch`, so that batches can be sent to worker
+    processes.
+    """
+    return np.asarray(scorer.predict_batch(batch), dtype = np.float64).ravel()
+
+
+_worker_scorer = None
+
+
+def _init_worker_scorer(scorer):
+    """
+    Process pool initializer, so that the scorer is sent once per worker rather than once
+    per batch.
+    """
+    global _worker_scorer
+    _worker_scorer = scorer
+
+
+def _predict_worker_batch(batch):
+    """
+    Worker task: score one batch with the scorer set by `_init_worker_scorer`.
+    """
+    return _predict_batch(_worker_scorer, batch)
+
+
+def _predict_shared_batch(descriptor, start, stop):
+    """
+    Worker task: score rows `start` to `stop` of a feature matrix in shared memory.
+    """
+    arrays, handles = attach_shared_arrays(descriptor)
+    try:
+        return _predict_batch(_worker_scorer, csr_rows(arrays, start, stop))
+    finally:
+        del arrays
+        for handle in handles:
+            handle.close()
+
+
+def _predict_shared(scorer, matrix) -> list:
+    """
+    Score a csr matrix in worker processes which attach to it in shared memory, instead of
+    pickling every batch.
+    """
+    bounds = [(start, min(start + scorer.batch_size, matrix.shape[0])) for start in range(0, matrix.shape[0], scorer.batch_size)]
+    with share_csr(matrix) as shared:
+        with ProcessPoolExecutor(max_workers = scorer.n_jobs, initializer = _init_worker_scorer,
+                                 initargs = (scorer,)) as executor:
+            return list(executor.map(_predict_shared_batch, [shared.descriptor] * len(bounds),
+                                     [start for start, _ in bounds], [stop for _, stop in bounds]))
+
+
+class Scorer:
+    """
+    Base class for models scoring original and perturbed messages. Subclasses implement
+    `predict_batch`; `score` splits its input into batches, fans them out to a thread or
+    process pool, and caches results by a hash of each input row, so rows that are scored
+    again (e.g. the original messages, once per swap type) cost nothing.
+
+    Parameters
+    ----------
+    batch_size
+        The number of rows passed to `predict_batch` at a time
+    n_jobs
+        The number of batches scored concurrently
+    executor
+        'thread' or 'process'. Threads suit models that release the GIL (most numpy/scipy
+        based predictions). With processes the scorer is sent once to every worker, feature
+        matrices are shared with them through shared memory, and text batches are pickled.
+    cache
+        Whether to cache scores by input hash
+    """
+
+    input_type = "features"
+
+    def __init__(self, batch_size : int = 10000, n_jobs : int = 1, executor : str = 'thread', cache : bool = True):
+        if executor not in ["thread", "process"]:
+            raise ValueError("Unknown executor '{}', expected 'thread' or 'process'".format(executor))
+        self.batch_size = batch_size
+        self.n_jobs = n_jobs
+        self.executor = executor
+        self.cache = {} if cache else None
+
+    def predict_batch(self, batch) -> np.ndarray:
+        """
+        Score one batch: a csr matrix for feature scorers, a list of str for text scorers.
+        """
+        raise NotImplementedError
+
+    def __getstate__(self):
+        # Worker processes don't need the cache
+        state = self.__dict__.copy()
+        state["cache"] = None
+        return state
+
+    def score(self, inputs) -> np.ndarray:
+        """
+        Score every row of `inputs`.
+
+        Parameters
+        ----------
+        inputs
+            A scipy sparse matrix for feature scorers, or a list of str for text scorers
+
+        Returns
+        -------
+        A numpy array with one score per row
+        """
+        num_rows = inputs.shape[0] if sparse.issparse(inputs) else len(inputs)
+        scores = np.empty(num_rows, dtype = np.float64)
+
+        if self.cache is not None:
+            hashes = _row_hashes(inputs)
+            missing = []
+            for row, row_hash in enumerate(hashes):
+                cached = self.cache.get(row_hash)
+                if cached is None:
+                    missing.append(row)
+                else:
+                    scores[row] = cached
+        else:
+            missing = list(range(num_rows))
+
+        if missing:
+            # Score each distinct input once, duplicates within `inputs` share the result
+            if self.cache is not None:
+                first_rows = {}
+                for row in missing:
+                    first_rows.setdefault(hashes[row], row)
+                unique_rows = list(first_rows.values())
+            else:
+                unique_rows = missing
+
+            unique_inputs = _take_rows(inputs, unique_rows)
+            batches = [_take_rows(unique_inputs, range(start, min(start + self.batch_size, len(unique_rows))))
+                       for start in range(0, len(unique_rows), self.batch_size)]
+
+            if self.n_jobs > 1 and len(batches) > 1 and self.executor == "process" and sparse.issparse(unique_inputs):
+                results = _predict_shared(self, unique_inputs)
+            elif self.n_jobs > 1 and len(batches) > 1 and self.executor == "process":
+                with ProcessPoolExecutor(max_workers = self.n_jobs, initializer = _init_worker_scorer,
+                                         initargs = (self,)) as executor:
+                    results = list(executor.map(_predict_worker_batch, batches))
+            elif self.n_jobs > 1 and len(batches) > 1:
+                with ThreadPoolExecutor(max_workers = self.n_jobs) as executor:
+                    results = list(executor.map(_predict_batch, [self] * len(batches), batches))
+            else:
+                results = [_predict_batch(self, batch) for batch in batches]
+            unique_scores = np.concatenate(results) if results else np.empty(0)
+
+            if self.cache is not None:
+                for row, row_score in zip(unique_rows, unique_scores):
+                    self.cache[hashes[row]] = row_score
+                for row in missing:
+                    scores[row] = self.cache[hashes[row]]
+            else:
+                scores[unique_rows] = unique_scores
+
+        return scores
+
+
+class LexiconScorer(Scorer):
+    """
+    Score feature rows with a lexicon locally, as the weighted sum of feature values, the
+    way dlatk's `--add_lex_table` computes `group_norm` for a single category.
+
+    Parameters
+    ----------
+    lexicon_df
+        A dlatk lexicon table with `term` and `weight` columns, restricted to one category
+    weighted
+        Whether to use the lexicon weights, or weight every term 1
+    """
+
+    def __init__(self, lexicon_df : pd.DataFrame, weighted : bool = True, **kwargs):
+        super().__init__(**kwargs)
+        self.vocabulary = build_vocabulary(lexicon_df["term"])
+        self.weights = np.zeros(len(self.vocabulary))
+        weights = lexicon_df["weight"].values if weighted else np.ones(len(lexicon_df))
+        np.add.at(self.weights, lexicon_df["term"].map(self.vocabulary).values.astype(np.int64), weights)
+
+    def predict_batch(self, batch) -> np.ndarray:
+        return batch @ self.weights
+
+
+class ModelScorer(Scorer):
+    """
+    Score feature rows with a fitted model exposing a vectorized `predict` on sparse
+    matrices, e.g. a scikit-learn classifier or regressor.
+
+    Parameters
+    ----------
+    model
+        The fitted model
+    vocabulary
+        A dictionary from feature to the model's input column index
+    method
+        'predict', 'predict_proba' (the probability of the last class is used) or
+        'decision_function'
+    """
+
+    def __init__(self, model, vocabulary : dict, method : str = 'predict', **kwargs):
+        super().__init__(**kwargs)
+        self.model = model
+        self.vocabulary = vocabulary
+        self.method = method
+
+    def predict_batch(self, batch) -> np.ndarray:
+        predictions = getattr(self.model, self.method)(batch)
+        if self.method == "predict_proba":
+            predictions = predictions[:, -1]
+        return predictions
+
+
+class TextModelScorer(ModelScorer):
+    """
+    Score message texts with a fitted model that vectorizes text itself, e.g. a scikit-learn
+    Pipeline starting with a TfidfVectorizer. See `ModelScorer` for the parameters.
+    """
+
+    input_type = "texts"
+
+    def __init__(self, model, method : str = 'predict', **kwargs):
+        super().__init__(model, vocabulary = None, method = method, **kwargs)
+
+
+def load_pickled_scorer(model_path : str, vocabulary_path : str = None, method : str = 'predict',
+    **kwargs) -> Scorer:
+    """
+    Load a pickled model as a scorer. With a vocabulary the model scores ngram feature rows,
+    without one it is expected to take raw message texts.
+
+    Parameters
+    ----------
+    model_path
+        The path of the pickled model
+    vocabulary_path
+        The path of a text file with one feature per line, in the order of the model's input
+        columns
+    method
+        See `ModelScorer`
+    kwargs
+        Passed on to `Scorer`, e.g. batch_size, n_jobs, executor
+
+    Returns
+    -------
+    A `ModelScorer` or `TextModelScorer`
+    """
+    with open(model_path, "rb") as fh:
+        model = pickle.load(fh)
+    if vocabulary_path is None:
+        return TextModelScorer(model, method = method, **kwargs)
+    with open(vocabulary_path, "r", encoding = "utf-8") as fh:
+        vocabulary = {line.rstrip("\n"): index for index, line in enumerate(fh)}
+    return ModelScorer(model, vocabulary, method = method, **kwargs)
+
+
+def score_transform_effect(scorer : Scorer, ngram_df : pd.DataFrame, transformed_df : pd.DataFrame,
+    value_col : str = 'group_norm') -> pd.DataFrame:
+    """
+    Score the original and transformed ngrams of the messages with a feature scorer, the local
+    counterpart of running dlatk and `compare_transform_scores`.
+
+    Parameters
+    ----------
+    scorer
+        A feature `Scorer`
+    ngram_df
+        The original ngrams, see `read_ngrams`
+    transformed_df
+        The transformed ngrams, see `remap_swap_type`
+    value_col
+        The column holding the feature values
+
+    Returns
+    -------
+    A pandas DataFrame with `id`, `original_score`, `transformed_score` and `score_difference` columns
+    """
+    original_matrix, group_ids = build_feature_matrix(ngram_df, scorer.vocabulary, value_col = value_col)
+    transformed_matrix, _ = build_feature_matrix(transformed_df, scorer.vocabulary, group_ids, value_col)
+    df = pd.DataFrame({
+        "id": group_ids,
+        "original_score": scorer.score(original_matrix),
+        "transformed_score": scorer.score(transformed_matrix),
+    })
+    df["score_difference"] = df["original_score"] - df["transformed_score"]
+    return df
+
+
+def score_message_swap(scorer : Scorer, messages_df : pd.DataFrame, swap_type : str) -> pd.DataFrame:
+    """
+    Swap the gender terms of whole message texts and score the original and transformed texts
+    with a text scorer. Messages are lowercased and split on whitespace, like ngrams.
+
+    Parameters
+    ----------
+    scorer
+        A text `Scorer`
+    messages_df
+        A DataFrame with `id` and `message` columns, see `fetch_messages`
+    swap_type
+        A key of `SWAP_DICTIONARY`, e.g. 'f2m'
+
+    Returns
+    -------
+    A pandas DataFrame with `id`, `original_score`, `transformed_score` and `score_difference`
+    columns, for the messages that were transformed
+    """
+    gender_from_ids = list(map(gender_name_to_id, SWAP_DICTIONARY.get(swap_type).get('gender_from_names')))
+    gender_to_id = gender_name_to_id(SWAP_DICTIONARY.get(swap_type).get('gender_to_name'))
+
+    originals = messages_df["message"].fillna("").str.lower().tolist()
+    transformed = [replace_pronouns(message, gender_from_ids, gender_to_id)[0] for message in originals]
+    changed = [row for row, (original, new) in enumerate(zip(originals, transformed)) if original != new]
+
+    df = pd.DataFrame({
+        "id": messages_df["id"].values[changed],
+        "original_score": scorer.score([originals[row] for row in changed]),
+        "transformed_score": scorer.score([transformed[row] for row in changed]),
+    })
+    df["score_difference"] = df["original_score"] - df["transformed_score"]
+    return df
@@ -0,0 +1,478 @@
+import os
+import json
+import uuid
+import traceback
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from .get_engine import engine_from_config
+from .swap_gender_pronouns import SWAP_DICTIONARY
+from .pronoun_transformation_pipeline import run_swap_transformation, combine_swap_results, table_exists
+from .pronoun_transformation_pipeline import attach_messages, store_table, generate_boxplot
+from .export import export_results
+
+
+SHARD_METHODS = ["hash", "range"]
+
+
+def shard_name(shard : int, num_shards : int) -> str:
+    """
+    The suffix identifying a shard, used in its basetable name and its output files.
+    """
+    return "s{}of{}".format(shard, num_shards)
+
+
+def shard_range_bounds(category_table : str, category_col : str, category_name : str, num_shards : int,
+    db : str = 'politeness') -> list:
+    """
+    Split the ids of the messages in a category into `num_shards` contiguous ranges of
+    (almost) equal size. Only the ids are read. The category table grows between runs, so
+    the bounds are computed once per run and recorded in its shard directory (see
+    `claim_shard_dir`), rather than by every worker.
+
+    Parameters
+    ----------
+    category_table
+        The name of the category table from which to draw the ids of messages from a specified category
+    category_col
+        The name of the column under which to match the specified category
+    category_name
+        The name of the category from which to select messages
+    num_shards
+        The number of shards
+    db
+        The name of the db
+
+    Returns
+    -------
+    A list of `num_shards` (lower, upper) tuples, where the upper bound is exclusive and None
+    for the last shard
+    """
+    engine = engine_from_config(database = db)
+    with engine.connect() as conn:
+        ids = pd.read_sql(
+            """SELECT DISTINCT group_id FROM {category_table}
+            WHERE {category_col} = '{category_name}'
+            ORDER BY group_id;""".format(category_table = category_table,
+                category_col = category_col, category_name = category_name),
+            conn,
+        )["group_id"].values
+
+    splits = [split for split in np.array_split(ids, num_shards) if len(split) > 0]
+    lowers = [int(split[0]) for split in splits]
+    uppers = lowers[1:] + [None]
+    bounds = list(zip(lowers, uppers))
+    # Fewer ids than shards, the remaining shards select nothing
+    bounds += [(None, None)] * (num_shards - len(bounds))
+    return bounds
+
+
+def create_shard_base_table(basetable_name : str, category_table : str, category_col : str, category_name : str,
+    shard : int, num_shards : int, method : str = 'hash', db : str = 'politeness', range_bounds : list = None):
+    """
+    Create a basetable containing only the ids of the messages in one shard. Shards select
+    straight from the category table, so workers never wait on a shared basetable.
+
+    Parameters
+    ----------
+    basetable_name
+        The name of the shard basetable
+    category_table, category_col, category_name
+        See `create_base_table`
+    shard
+        The index of the shard, from 0 to `num_shards` - 1
+    num_shards
+        The number of shards
+    method
+        'hash' to assign ids by `CRC32(group_id) % num_shards`, or 'range' to assign contiguous
+        id ranges of equal size
+    db
+        The name of the db
+    range_bounds
+        The bounds of every shard recorded for the run, see `shard_range_bounds`. Required
+        with the 'range' method
+
+    """
+    if method not in SHARD_METHODS:
+        raise ValueError("Unknown shard method '{}', expected one of {}".format(method, SHARD_METHODS))
+    if method == 'range' and range_bounds is None:
+        raise ValueError("The range method needs the range bounds recorded for the run, see claim_shard_dir")
+
+    if method == 'hash':
+        shard_condition = "MOD(CRC32({category_table}.group_id), {num_shards}) = {shard}".format(
+            category_table = category_table, num_shards = num_shards, shard = shard)
+    else:
+        lower, upper = range_bounds[shard]
+        if lower is None:
+            shard_condition = "FALSE"
+        elif upper is None:
+            shard_condition = "{category_table}.group_id >= {lower}".format(category_table = category_table, lower = lower)
+        else:
+            shard_condition = "{category_table}.group_id >= {lower} AND {category_table}.group_id < {upper}".format(
+                category_table = category_table, lower = lower, upper = upper)
+
+    engine = engine_from_config(database = db)
+    if table_exists(engine, basetable_name):
+        print(basetable_name, "already exists! Skipping creation...")
+    else:
+        with engine.connect() as conn:
+            conn.execute(
+                """CREATE TABLE {basetable_name} (PRIMARY KEY (sid)) AS
+                (
+                SELECT DISTINCT {category_table}.group_id AS sid
+                FROM {category_table}
+                WHERE {category_table}.{category_col} = '{category_name}'
+                AND {shard_condition}
+                );""".format(basetable_name = basetable_name, category_table = category_table,
+                    category_col = category_col, category_name = category_name, shard_condition = shard_condition)
+            )
+
+
+def shard_statistics(shard_df : pd.DataFrame) -> dict:
+    """
+    Compute additive statistics of the score deltas in a shard's results, which can be merged
+    across shards without access to the rows.
+
+    Returns
+    -------
+    A dictionary keyed by swap type, with the count, changed count, sum and sum of squares of
+    the deltas
+    """
+    stats = {}
+    for swap_type in SWAP_DICTIONARY.keys():
+        score_column = swap_type + "_score"
+        if score_column not in shard_df.columns:
+            continue
+        delta = (shard_df[score_column] - shard_df["original_score"]).dropna()
+        stats[swap_type] = {
+            "count": int(len(delta)),
+            "changed": int((delta != 0).sum()),
+            "sum": float(delta.sum()),
+            "sum_sq": float((delta ** 2).sum()),
+        }
+    return stats
+
+
+def merge_shard_statistics(shard_stats : list) -> pd.DataFrame:
+    """
+    Combine the statistics from `shard_statistics` for every shard. The shards are added in
+    shard order, so the merged numbers don't depend on which worker finished first.
+
+    Returns
+    -------
+    A pandas DataFrame indexed by swap type, with count, changed, mean_delta and std_delta columns
+    """
+    totals = {}
+    for stats in shard_stats:
+        for swap_type, swap_stats in stats.items():
+            total = totals.setdefault(swap_type, {"count": 0, "changed": 0, "sum": 0.0, "sum_sq": 0.0})
+            for key in total:
+                total[key] += swap_stats[key]
+
+    rows = []
+    for swap_type, total in totals.items():
+        count = total["count"]
+        mean = total["sum"] / count if count else np.nan
+        variance = total["sum_sq"] / count - mean ** 2 if count else np.nan
+        rows.append({"swap_type": swap_type, "count": count, "changed": total["changed"],
+                     "mean_delta": mean, "std_delta": np.sqrt(max(variance, 0.0)) if count else np.nan})
+    return pd.DataFrame(rows).set_index("swap_type")
+
+
+def shard_output_paths(output_dir : str, shard : int, num_shards : int) -> tuple:
+    """
+    The paths of a shard's result and statistics files. The result file is written last, so
+    its existence marks the shard as complete.
+    """
+    prefix = os.path.join(output_dir, "shard_" + shard_name(shard, num_shards))
+    return prefix + ".pkl", prefix + "_stats.json"
+
+
+def shard_run_fingerprint(pipeline_args : dict, num_shards : int, method : str = 'hash', **options) -> dict:
+    """
+    Identify a sharded run by everything that changes its results: the pipeline arguments
+    (tables, lexicon, user, category filter), the sharding and any extra options.
+    """
+    fingerprint = dict(pipeline_args, num_shards = num_shards, method = method, **options)
+    # Compared against the recorded JSON, so normalize through JSON too
+    return json.loads(json.dumps(fingerprint, sort_keys = True))
+
+
+def claim_shard_dir(output_dir : str, fingerprint : dict, compute_range_bounds = None) -> list:
+    """
+    Record the fingerprint of a run in its shard directory, or check that the directory
+    belongs to the same run. Results in a shard directory are only reused by the run that
+    wrote them; another run (e.g. with a different lexicon) needs its own `output_dir`.
+
+    Parameters
+    ----------
+    output_dir
+        The shard directory
+    fingerprint
+        See `shard_run_fingerprint`
+    compute_range_bounds
+        For the 'range' method, a function returning the bounds of every shard (see
+        `shard_range_bounds`). It is only called by the first claim, every later claim gets
+        the recorded bounds, so all workers use the same ranges while the category grows.
+
+    Returns
+    -------
+    The recorded range bounds, as a list of (lower, upper) lists, or None
+
+    Raises
+    ------
+    ValueError
+        If the directory holds the results of a different run
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok = True)
+    path = os.path.join(output_dir, "run.json")
+
+    if os.path.exists(path):
+        with open(path) as fh:
+            recorded = json.load(fh)
+    else:
+        record = {"fingerprint": fingerprint,
+                  "range_bounds": compute_range_bounds() if compute_range_bounds is not None else None}
+        # Link a complete file into place, so that concurrent workers never read a partial one
+        temporary_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        with open(temporary_path, "w") as fh:
+            json.dump(record, fh, indent = 2, sort_keys = True)
+        try:
+            os.link(temporary_path, path)
+            recorded = json.loads(json.dumps(record))
+        except FileExistsError:
+            with open(path) as fh:
+                recorded = json.load(fh)
+        finally:
+            os.remove(temporary_path)
+
+    _check_fingerprint(output_dir, recorded.get("fingerprint", {}), fingerprint)
+    return recorded.get("range_bounds")
+
+
+def _check_fingerprint(output_dir : str, recorded : dict, fingerprint : dict):
+    """
+    Raise a ValueError listing the differences if a shard directory belongs to another run.
+    """
+    if recorded != fingerprint:
+        differences = ["{}: {!r} != {!r}".format(key, recorded.get(key), fingerprint.get(key))
+                       for key in sorted(set(recorded) | set(fingerprint)) if recorded.get(key) != fingerprint.get(key)]
+        raise ValueError("{} holds the shards of a different run ({}). Use another shard directory, or remove it "
+                         "to start over".format(output_dir, "; ".join(differences)))
+
+
+def _range_bounds_function(pipeline_args : dict, num_shards : int, method : str):
+    """
+    The `compute_range_bounds` argument of `claim_shard_dir` for a run, None unless sharding by range.
+    """
+    if method != 'range':
+        return None
+    return lambda: shard_range_bounds(pipeline_args["category_table"], pipeline_args["category_col"],
+                                      pipeline_args["category_name"], num_shards, pipeline_args["db"])
+
+
+def run_shard(pipeline_args : dict, shard : int, num_shards : int, output_dir : str, method : str = 'hash',
+    dedup : bool = False):
+    """
+    Run transform, scoring and comparison for every swap type on one shard, and write the
+    shard's results and statistics to `output_dir`. A shard whose result file already exists
+    is skipped, so that a rerun only redoes failed shards; `output_dir` must not hold the
+    shards of a different run (see `claim_shard_dir`).
+
+    Parameters
+    ----------
+    pipeline_args
+        The keyword arguments of `run_pipeline`, without `plots_path`
+    shard
+        The index of the shard, from 0 to `num_shards` - 1
+    num_shards
+        The number of shards
+    output_dir
+        A directory shared by all workers, e.g. on a network filesystem
+    method
+        See `create_shard_base_table`
+    dedup
+        See `run_swap_transformation`
+    """
+    range_bounds = claim_shard_dir(output_dir, shard_run_fingerprint(pipeline_args, num_shards, method, dedup = dedup),
+                                   _range_bounds_function(pipeline_args, num_shards, method))
+    result_path, stats_path = shard_output_paths(output_dir, shard, num_shards)
+    if os.path.exists(result_path):
+        print("Shard", shard_name(shard, num_shards), "already complete! Skipping...")
+        return
+
+    db = pipeline_args["db"]
+    message_table = pipeline_args["message_table"]
+
+    final_tables = []
+    for swap_type in SWAP_DICTIONARY.keys():
+        basetable_name = "_".join([message_table, pipeline_args["user_initials"], swap_type, shard_name(shard, num_shards)])
+
+        print("\n\nShard {}, performing transformation: {}".format(shard_name(shard, num_shards),
+            SWAP_DICTIONARY.get(swap_type).get('transformation_name')))
+        print("\nStep 1: Creating shard Basetable containing Message IDs to be transformed.\n")
+        create_shard_base_table(basetable_name, pipeline_args["category_table"], pipeline_args["category_col"],
+            pipeline_args["category_name"], shard, num_shards, method, db, range_bounds)
+
+        final_tables.append(run_swap_transformation(swap_type, basetable_name, message_table,
+            pipeline_args["ngram_table_name"], pipeline_args["old_score_table"],
+            pipeline_args["lexicon_table_name"], pipeline_args["weighted_lexicon_flag"], db, dedup = dedup))
+
+    shard_df = combine_swap_results(final_tables)
+
+    # Write to temporary files and rename, so a crashed worker never leaves a partial result
+    with open(stats_path + ".tmp", "w") as fh:
+        json.dump(shard_statistics(shard_df), fh)
+    os.replace(stats_path + ".tmp", stats_path)
+    shard_df.to_pickle(result_path + ".tmp")
+    os.replace(result_path + ".tmp", result_path)
+
+
+def merge_shard_results(output_dir : str, num_shards : int) -> tuple:
+    """
+    Read the results of every shard and merge them deterministically: rows are sorted by id
+    and statistics are combined in shard order.
+
+    Parameters
+    ----------
+    output_dir
+        The directory the shards were written to
+    num_shards
+        The number of shards
+
+    Returns
+    -------
+    A tuple of (results DataFrame, statistics DataFrame)
+    """
+    shard_dfs = []
+    shard_stats = []
+    missing = []
+    for shard in range(num_shards):
+        result_path, stats_path = shard_output_paths(output_dir, shard, num_shards)
+        if not os.path.exists(result_path):
+            missing.append(shard)
+            continue
+        shard_dfs.append(pd.read_pickle(result_path))
+        with open(stats_path) as fh:
+            shard_stats.append(json.load(fh))
+
+    if missing:
+        raise RuntimeError("Shards {} of {} have no results in {}".format(missing, num_shards, output_dir))
+
+    final_df = pd.concat(shard_dfs, ignore_index = True, sort = False)
+    final_df = final_df.sort_values("id", kind = "mergesort").reset_index(drop = True)
+    return final_df, merge_shard_statistics(shard_stats)
+
+
+def _run_shard_safely(pipeline_args, shard, num_shards, output_dir, method, dedup):
+    """
+    Run a shard in a worker process, returning the traceback instead of raising so that one
+    failing shard doesn't cancel the others.
+    """
+    try:
+        run_shard(pipeline_args, shard, num_shards, output_dir, method, dedup)
+        return None
+    except Exception:
+        return traceback.format_exc()
+
+
+def run_sharded_pipeline(pipeline_args : dict,
+                num_shards : int,
+                output_dir : str,
+                plots_path : str,
+                method : str = 'hash',
+                workers : int = None,
+                max_retries : int = 2,
+                run_missing : bool = True,
+                dedup : bool = False,
+                include_messages : bool = True,
+                export_path : str = None):
+    """
+    Run the pipeline with the basetable split into `num_shards` shards by `group_id`, each shard
+    processed by an independent local worker process. Failed shards are retried individually,
+    up to `max_retries` times, then all shard results are merged and stored like `run_pipeline`.
+
+    Workers on other hosts can process shards with `run_pipeline.py --shard`, as long as they
+    share `output_dir`; shards that are already complete are not run again. The directory is
+    tied to this run's arguments (see `claim_shard_dir`), so the shards of another run are
+    never reused.
+
+    Parameters
+    ----------
+    pipeline_args
+        The keyword arguments of `run_pipeline`, without `plots_path`
+    num_shards
+        The number of shards
+    output_dir
+        The directory shard results are written to
+    plots_path
+        The path for storing the boxplot
+    method
+        See `create_shard_base_table`
+    workers
+        The number of worker processes, defaults to `num_shards`
+    max_retries
+        The number of times a failed shard is retried
+    run_missing
+        If False, don't run any shard and only merge the results of shards completed by other
+        workers
+    dedup
+        See `run_swap_transformation`
+    include_messages, export_path
+        See `run_pipeline`
+
+    Returns
+    -------
+    A tuple of (results DataFrame, statistics DataFrame)
+    """
+    for path in [output_dir, plots_path]:
+        if not os.path.exists(path):
+            os.makedirs(path)
+    # Compute the range bounds here once, the workers read them from the directory
+    claim_shard_dir(output_dir, shard_run_fingerprint(pipeline_args, num_shards, method, dedup = dedup),
+                    _range_bounds_function(pipeline_args, num_shards, method))
+
+    pending = [shard for shard in range(num_shards)
+               if not os.path.exists(shard_output_paths(output_dir, shard, num_shards)[0])]
+
+    for attempt in range(max_retries + 1):
+        if not pending or not run_missing:
+            break
+        print("\nRunning shards {} (attempt {})...\n".format(pending, attempt + 1))
+        # A new pool per attempt, since a crashed worker breaks the whole pool
+        with ProcessPoolExecutor(max_workers = workers or num_shards) as executor:
+            futures = {shard: executor.submit(_run_shard_safely, pipeline_args, shard, num_shards, output_dir, method, dedup)
+                       for shard in pending}
+        failed = []
+        for shard, future in futures.items():
+            try:
+                error = future.result()
+            except Exception as e:
+                error = repr(e)
+            if error is not None:
+                print("Shard", shard_name(shard, num_shards), "failed:\n", error)
+                failed.append(shard)
+        pending = failed
+
+    if pending and run_missing:
+        raise RuntimeError("Shards {} failed after {} retries".format(pending, max_retries))
+
+    print("\nMerging results from all shards...\n")
+    final_df, stats_df = merge_shard_results(output_dir, num_shards)
+    if include_messages:
+        final_df = attach_messages(final_df, pipeline_args["message_table"], pipeline_args["db"])
+    print(stats_df)
+
+    final_table_name = "_".join([pipeline_args["message_table"], pipeline_args["user_initials"],
+                                 pipeline_args["lexicon_table_name"], "gender_swap"])
+    store_table(final_df, final_table_name, pipeline_args["db"])
+    if export_path is not None:
+        export_results(final_df, export_path, pipeline_args["lexicon_table_name"])
+    generate_boxplot(final_df, save_path = plots_path + "/" + final_table_name + ".png")
+
+    print("\nSharded pipeline is complete!\n")
+    print("Your results can be found in the table {}.{}".format(pipeline_args["db"], final_table_name))
+    if export_path is not None:
+        print("Your exported results can be found under {}".format(export_path))
+    return final_df, stats_df
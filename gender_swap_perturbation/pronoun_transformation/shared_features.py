@@ -0,0 +1,335 @@
+import os
+import uuid
+import tempfile
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from concurrent.futures import ProcessPoolExecutor
+from .swap_gender_pronouns import SWAP_DICTIONARY, replace_pronouns, gender_name_to_id
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8, only the memmap backend is available
+    shared_memory = None
+
+
+SHARED_BACKENDS = ["shm", "memmap"]
+
+
+class SharedArrays:
+    """
+    A set of numpy arrays placed once in shared memory (or in memory-mapped files), which
+    worker processes attach to without copying. Only the small `descriptor` is pickled to
+    the workers.
+
+    Parameters
+    ----------
+    arrays
+        A dictionary of numpy arrays to share
+    backend
+        'shm' for POSIX shared memory, or 'memmap' for .npy files in `directory`, e.g. on a
+        filesystem shared by several hosts
+    directory
+        The directory for the memmap backend, defaults to a new temporary directory
+    """
+
+    def __init__(self, arrays : dict, backend : str = 'shm', directory : str = None):
+        if backend not in SHARED_BACKENDS:
+            raise ValueError("Unknown backend '{}', expected one of {}".format(backend, SHARED_BACKENDS))
+        if backend == "shm" and shared_memory is None:
+            raise ValueError("The shm backend needs Python 3.8 or later, use the memmap backend")
+
+        self.backend = backend
+        self._segments = []
+        self.descriptor = {"backend": backend, "arrays": {}}
+
+        if backend == "memmap":
+            self.directory = directory or tempfile.mkdtemp(prefix = "gender_swap_")
+            self._owns_directory = directory is None
+
+        for key, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            if backend == "shm":
+                segment = shared_memory.SharedMemory(create = True, size = max(array.nbytes, 1))
+                np.ndarray(array.shape, dtype = array.dtype, buffer = segment.buf)[...] = array
+                self._segments.append(segment)
+                location = segment.name
+            else:
+                location = os.path.join(self.directory, "{}_{}.npy".format(key, uuid.uuid4().hex))
+                np.save(location, array)
+            self.descriptor["arrays"][key] = {"location": location, "dtype": array.dtype.str, "shape": array.shape}
+
+    def close(self):
+        """
+        Release the shared arrays. Workers must be done with them.
+        """
+        for segment in self._segments:
+            segment.close()
+            segment.unlink()
+        self._segments = []
+        if self.backend == "memmap":
+            for spec in self.descriptor["arrays"].values():
+                if os.path.exists(spec["location"]):
+                    os.remove(spec["location"])
+            if self._owns_directory and os.path.isdir(self.directory):
+                os.rmdir(self.directory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def attach_shared_arrays(descriptor : dict) -> tuple:
+    """
+    Attach to the arrays of a `SharedArrays` descriptor without copying them.
+
+    Returns
+    -------
+    A tuple of (dictionary of read-only numpy arrays, list of handles which must be kept
+    alive while the arrays are used)
+    """
+    arrays = {}
+    handles = []
+    for key, spec in descriptor["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        shape = tuple(spec["shape"])
+        if descriptor["backend"] == "shm":
+            try:
+                segment = shared_memory.SharedMemory(name = spec["location"], track = False)
+            except TypeError:
+                # Before Python 3.13 attaching registers the segment again, with the resource
+                # tracker the workers share with the process which created it
+                segment = shared_memory.SharedMemory(name = spec["location"])
+            handles.append(segment)
+            array = np.ndarray(shape, dtype = dtype, buffer = segment.buf)
+        else:
+            array = np.load(spec["location"], mmap_mode = "r")
+        array.flags.writeable = False
+        arrays[key] = array
+    return arrays, handles
+
+
+def share_csr(matrix : sparse.csr_matrix, backend : str = 'shm', directory : str = None, **extra_arrays) -> SharedArrays:
+    """
+    Place the arrays of a csr matrix, and any extra arrays, in shared memory.
+    """
+    matrix = matrix.tocsr()
+    return SharedArrays(dict(data = matrix.data, indices = matrix.indices, indptr = matrix.indptr,
+                             shape = np.asarray(matrix.shape, dtype = np.int64), **extra_arrays),
+                        backend, directory)
+
+
+def csr_rows(arrays : dict, start : int, stop : int) -> sparse.csr_matrix:
+    """
+    View rows `start` to `stop` of a shared csr matrix as a scipy matrix, without copying
+    the values.
+    """
+    indptr = arrays["indptr"]
+    first, last = indptr[start], indptr[stop]
+    return sparse.csr_matrix((arrays["data"][first:last], arrays["indices"][first:last], indptr[start:stop + 1] - first),
+                             shape = (stop - start, int(arrays["shape"][1])))
+
+
+def encode_vocabulary(feats : list) -> tuple:
+    """
+    Pack a list of features into one utf-8 byte array and an offsets array, which can be
+    shared instead of a list of Python strings.
+    """
+    encoded = [feat.encode("utf-8") for feat in feats]
+    offsets = np.zeros(len(encoded) + 1, dtype = np.int64)
+    offsets[1:] = np.cumsum([len(feat) for feat in encoded])
+    return np.frombuffer(b"".join(encoded), dtype = np.uint8).copy(), offsets
+
+
+def decode_vocabulary(vocabulary_bytes : np.ndarray, offsets : np.ndarray) -> list:
+    """
+    Unpack the features packed by `encode_vocabulary`.
+    """
+    buffer = vocabulary_bytes.tobytes()
+    return [buffer[offsets[index]:offsets[index + 1]].decode("utf-8") for index in range(len(offsets) - 1)]
+
+
+def compile_pronoun_mapping(feats : list, swap_types : list) -> tuple:
+    """
+    Compile the gender swaps into integer mappings over the vocabulary, so that transforming
+    a feature matrix is an index lookup instead of string replacement on every row. Each
+    distinct feature is transformed once; transformed features missing from the vocabulary
+    are appended to it.
+
+    Parameters
+    ----------
+    feats
+        The vocabulary, a list of distinct features
+    swap_types
+        Keys of `SWAP_DICTIONARY`
+
+    Returns
+    -------
+    A tuple of (the extended vocabulary list, an int64 array of shape (len(swap_types),
+    len(extended vocabulary)) mapping every feature index to its transformed feature index)
+    """
+    vocabulary = list(feats)
+    index = {feat: position for position, feat in enumerate(vocabulary)}
+    transformed = []
+    for swap_type in swap_types:
+        gender_from_ids = list(map(gender_name_to_id, SWAP_DICTIONARY.get(swap_type).get('gender_from_names')))
+        gender_to_id = gender_name_to_id(SWAP_DICTIONARY.get(swap_type).get('gender_to_name'))
+        swap_mapping = []
+        for feat in feats:
+            new_feat = replace_pronouns(feat, gender_from_ids, gender_to_id)[0]
+            if new_feat not in index:
+                index[new_feat] = len(vocabulary)
+                vocabulary.append(new_feat)
+            swap_mapping.append(index[new_feat])
+        transformed.append(swap_mapping)
+
+    # Appended features map to themselves
+    mapping = np.tile(np.arange(len(vocabulary), dtype = np.int64), (len(swap_types), 1))
+    mapping[:, :len(feats)] = np.asarray(transformed, dtype = np.int64).reshape(len(swap_types), len(feats))
+    return vocabulary, mapping
+
+
+def build_shared_feature_store(ngram_df : pd.DataFrame, swap_types : list = None, value_col : str = 'group_norm',
+    backend : str = 'shm', directory : str = None, lexicon_weights : pd.Series = None) -> tuple:
+    """
+    Build the group x feature matrix of an ngram table, its vocabulary, the compiled pronoun
+    mapping of every swap type and optionally the lexicon weights over the vocabulary, and
+    place them in shared memory once.
+
+    Parameters
+    ----------
+    ngram_df
+        A DataFrame with `group_id`, `feat` and `value_col` columns, see `read_ngrams`
+    swap_types
+        Keys of `SWAP_DICTIONARY`, defaults to all of them
+    value_col
+        The column holding the feature values
+    backend, directory
+        See `SharedArrays`
+    lexicon_weights
+        If given, the term weights (see `load_lexicon_weights`), shared as a `weights` array
+        aligned with the extended vocabulary
+
+    Returns
+    -------
+    A tuple of (`SharedArrays`, extended vocabulary list, swap types)
+    """
+    swap_types = swap_types or list(SWAP_DICTIONARY.keys())
+    codes, feats = pd.factorize(ngram_df["feat"])
+    group_codes, group_ids = pd.factorize(ngram_df["group_id"], sort = True)
+    vocabulary, mapping = compile_pronoun_mapping(list(feats), swap_types)
+
+    matrix = sparse.coo_matrix((ngram_df[value_col].values.astype(np.float64), (group_codes, codes)),
+                               shape = (len(group_ids), len(vocabulary))).tocsr()
+    matrix.sum_duplicates()
+    vocabulary_bytes, vocabulary_offsets = encode_vocabulary(vocabulary)
+    extra_arrays = {}
+    if lexicon_weights is not None:
+        extra_arrays["weights"] = pd.Series(vocabulary).map(lexicon_weights).fillna(0.0).values.astype(np.float64)
+
+    store = share_csr(matrix, backend, directory, group_ids = np.asarray(group_ids), mapping = mapping,
+                      vocabulary_bytes = vocabulary_bytes, vocabulary_offsets = vocabulary_offsets, **extra_arrays)
+    return store, vocabulary, swap_types
+
+
+def _score_shared_rows(descriptor : dict, start : int, stop : int) -> tuple:
+    """
+    Worker task: score rows `start` to `stop` of a shared feature store with its lexicon
+    weights, before and after every swap type.
+
+    Returns
+    -------
+    A tuple of (original scores, transformed scores with one row per swap type, boolean array
+    with one row per swap type telling which messages had a feature swapped)
+    """
+    arrays, handles = attach_shared_arrays(descriptor)
+    try:
+        return _score_rows(arrays, start, stop)
+    finally:
+        # The views must go before the segments can be closed
+        del arrays
+        for handle in handles:
+            handle.close()
+
+
+def _score_rows(arrays : dict, start : int, stop : int) -> tuple:
+    """
+    See `_score_shared_rows`.
+    """
+    rows = csr_rows(arrays, start, stop)
+    weights = arrays["weights"]
+    num_rows = stop - start
+    row_ids = np.repeat(np.arange(num_rows), np.diff(rows.indptr))
+    num_swaps = arrays["mapping"].shape[0]
+
+    original = rows @ weights
+    transformed = np.empty((num_swaps, num_rows))
+    swapped = np.empty((num_swaps, num_rows), dtype = bool)
+    for swap in range(num_swaps):
+        new_indices = arrays["mapping"][swap][rows.indices]
+        transformed[swap] = np.bincount(row_ids, weights = weights[new_indices] * rows.data, minlength = num_rows)
+        swapped[swap] = np.bincount(row_ids, weights = new_indices != rows.indices, minlength = num_rows) > 0
+    return original, transformed, swapped
+
+
+def parallel_lexicon_effect(ngram_df : pd.DataFrame, lexicon_weights : pd.Series, swap_types : list = None,
+    workers : int = None, rows_per_task : int = 100000, backend : str = 'shm', value_col : str = 'group_norm') -> pd.DataFrame:
+    """
+    Score every message with a lexicon before and after every swap type in worker processes.
+    The feature matrix, vocabulary, pronoun mapping and weights are shared once; workers attach
+    to them and only send back score arrays, so memory stays flat as the number of workers
+    grows.
+
+    Parameters
+    ----------
+    ngram_df
+        A DataFrame with `group_id`, `feat` and `value_col` columns, see `read_ngrams`
+    lexicon_weights
+        The term weights, see `load_lexicon_weights`
+    swap_types
+        Keys of `SWAP_DICTIONARY`, defaults to all of them
+    workers
+        The number of worker processes, defaults to the number of cores
+    rows_per_task
+        The number of messages scored per task
+    backend
+        See `SharedArrays`
+    value_col
+        The column holding the feature values
+
+    Returns
+    -------
+    A pandas DataFrame with `id`, `swap_type`, `original_score`, `transformed_score` and
+    `score_difference` columns, for the messages transformed by each swap type
+    """
+    store, vocabulary, swap_types = build_shared_feature_store(ngram_df, swap_types, value_col, backend,
+                                                               lexicon_weights = lexicon_weights)
+    with store:
+        group_ids = np.asarray(pd.factorize(ngram_df["group_id"], sort = True)[1])
+        bounds = [(start, min(start + rows_per_task, len(group_ids))) for start in range(0, len(group_ids), rows_per_task)]
+
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            results = list(executor.map(_score_shared_rows, [store.descriptor] * len(bounds),
+                                        [start for start, _ in bounds], [stop for _, stop in bounds]))
+
+    if not results:
+        return pd.DataFrame(columns = ["id", "swap_type", "original_score", "transformed_score", "score_difference"])
+    original = np.concatenate([result[0] for result in results])
+    transformed = np.concatenate([result[1] for result in results], axis = 1)
+    swapped = np.concatenate([result[2] for result in results], axis = 1)
+
+    effect_dfs = []
+    for swap, swap_type in enumerate(swap_types):
+        changed = swapped[swap]
+        effect_df = pd.DataFrame({
+            "id": group_ids[changed],
+            "swap_type": swap_type,
+            "original_score": original[changed],
+            "transformed_score": transformed[swap][changed],
+        })
+        effect_df["score_difference"] = effect_df["original_score"] - effect_df["transformed_score"]
+        effect_dfs.append(effect_df)
+    return pd.concat(effect_dfs, ignore_index = True)
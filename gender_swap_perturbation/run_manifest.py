@@ -0,0 +1,35 @@
+import argparse
+import pronoun_transformation.manifest as manifest_runner
+import matplotlib
+matplotlib.use('agg')
+
+
+############ EXAMPLE COMMAND ##################
+
+# python run_manifest.py politeness_manifest.yaml
+#
+# See pronoun_transformation/manifest.py for the manifest format.
+
+if __name__ == '__main__':
+
+	# Create the parser
+	my_parser = argparse.ArgumentParser(prog='Gender Perturbation Manifest Runner',
+		description="Run the Gender Perturbation Pipeline for every lexicon and category filter in a manifest")
+
+	# Add the arguments
+	my_parser.add_argument('manifest',
+                       type=str,
+                       help='the JSON or YAML manifest listing lexicons, category filters and swap types')
+
+	my_parser.add_argument('--dry_run',
+                       help='only print the planned grid of pipeline entries',
+                       action = "store_true")
+
+	args = my_parser.parse_args()
+
+	manifest = manifest_runner.load_manifest(args.manifest)
+
+	if args.dry_run:
+		manifest_runner.print_manifest_plan(manifest_runner.plan_manifest(manifest))
+	else:
+		manifest_runner.run_manifest(manifest)
@@ -8,6 +8,13 @@ import dlatk
 from functools import reduce
 import argparse
 import pronoun_transformation.pronoun_transformation_pipeline as pronoun_pp
+import pronoun_transformation.sharding as sharding
+import pronoun_transformation.async_pipeline as async_pp
+import pronoun_transformation.scorers as scorers
+import pronoun_transformation.incremental as incremental
+import pronoun_transformation.planner as planner
+import pronoun_transformation.instrumentation as instrumentation
+import asyncio
 import matplotlib
 matplotlib.use('agg')
 
@@ -40,6 +47,42 @@ pd.set_option("display.max_rows", 500)
 # 'feat$1to3gram$twitter$sid$16to16' 'feat$cat_dd_twitter_politeness_npl_w$twitter$sid$1to3' gender_swap_plots \
 # --weighted_lexicon --user sc --features_used ngr_liwc_plex
 
+############ LOCAL MODEL EXAMPLE COMMAND ##################
+
+# The lexicon argument then only names the results table, the score table is not read
+# python run_pipeline.py politeness twitter politeness_lr \
+# 'feat$1to3gram$twitter$sid$16to16' 'feat$cat_dd_twitter_politeness_npl_w$twitter$sid$1to3' gender_swap_plots \
+# --model_path politeness_lr.pkl --vocabulary_path politeness_lr_vocab.txt --model_method predict_proba \
+# --batch_size 50000 --n_jobs 4 --user sc
+
+############ LOCAL LEXICON EXAMPLE COMMAND ##################
+
+# Score the lexicon in 8 local processes instead of uploading the transformed ngrams and running dlatk:
+# python run_pipeline.py politeness twitter dd_twitter_politeness_npl \
+# 'feat$1to3gram$twitter$sid$16to16' 'feat$cat_dd_twitter_politeness_npl_w$twitter$sid$1to3' gender_swap_plots \
+# --weighted_lexicon --user sc --features_used ngr_liwc_plex --lexicon_workers 8
+
+############ PLAN EXAMPLE COMMAND ##################
+
+# Check the tables and estimate the work of the example command, without running it:
+# python run_pipeline.py politeness twitter dd_twitter_politeness_npl \
+# 'feat$1to3gram$twitter$sid$16to16' 'feat$cat_dd_twitter_politeness_npl_w$twitter$sid$1to3' gender_swap_plots \
+# --weighted_lexicon --user sc --features_used ngr_liwc_plex --plan
+
+############ EXPORT EXAMPLE ##################
+
+# Add --export_path gender_swap_export to the example command, then read e.g. the f2m deltas above 0.5 with
+# pronoun_transformation.export.query_results('gender_swap_export', swap_type = 'f2m', min_delta = 0.5)
+
+############ SHARDED EXAMPLE COMMANDS ##################
+
+# Four local worker processes:
+# python run_pipeline.py ... --num_shards 4 --shard_dir /shared/gender_swap_shards
+
+# One shard per host sharing /shared, then merge once every shard is done:
+# python run_pipeline.py ... --num_shards 4 --shard 0 --shard_dir /shared/gender_swap_shards
+# python run_pipeline.py ... --num_shards 4 --merge_shards --shard_dir /shared/gender_swap_shards
+
 if __name__ == '__main__':
 
 	# Create the parser
@@ -100,38 +143,197 @@ if __name__ == '__main__':
                        help='a string representation of the features used for the pipeline being run',
                        default = "")    
 
-	args = my_parser.parse_args()
-
-	pronoun_pp.run_pipeline(db = args.db,
-                message_table = args.message_table,
-                user_initials = args.user,
-                features_used = args.features_used,
-                lexicon_table_name = args.lexicon,
-                weighted_lexicon_flag = args.weighted_lexicon,
-                ngram_table_name = args.ngram_table,
-                old_score_table = args.score_table,
-                plots_path = args.plots_path,
-                category_table = args.category_table,
-                category_col = args.category_column,
-                category_name = args.category_value)
-
-
-
-
-
-
+	my_parser.add_argument('--semijoin',
+                       help='read the ngrams of the cached category ids in batches of IN lists instead of joining the basetable',
+                       action = "store_true")
 
+	my_parser.add_argument('--no_messages',
+                       help='store only ids and scores in the results table, without reading the message text',
+                       action = "store_true")
 
+	my_parser.add_argument('--dedup',
+                       help='transform and score messages with identical ngram bags (e.g. retweets) only once',
+                       action = "store_true")
 
+	my_parser.add_argument('--incremental',
+                       help='process only the messages added since the last run, and upsert them into the results table',
+                       action = "store_true")
 
+	my_parser.add_argument('--attribution',
+                       help='attribute the score differences to the swapped pronoun pairs using the lexicon weights',
+                       action = "store_true")
 
+	my_parser.add_argument('--model_path',
+                       type=str,
+                       help='a pickled model to score messages with locally, instead of dlatk and the lexicon',
+                       default = None)
 
+	my_parser.add_argument('--vocabulary_path',
+                       type=str,
+                       help='the features of the model inputs, one per line; without it the model gets message texts',
+                       default = None)
 
+	my_parser.add_argument('--model_method',
+                       type=str,
+                       help='the model method used for scoring',
+                       choices = ['predict', 'predict_proba', 'decision_function'],
+                       default = 'predict')
 
+	my_parser.add_argument('--batch_size',
+                       type=int,
+                       help='the number of messages scored per model call',
+                       default = 10000)
 
+	my_parser.add_argument('--n_jobs',
+                       type=int,
+                       help='the number of batches scored concurrently',
+                       default = 1)
 
+	my_parser.add_argument('--executor',
+                       type=str,
+                       help='whether concurrent batches are scored in threads or processes (which attach to the features in shared memory)',
+                       choices = ['thread', 'process'],
+                       default = 'thread')
+
+	my_parser.add_argument('--lexicon_workers',
+                       type=int,
+                       help='score the lexicon locally in this many processes sharing the ngram features, instead of uploading the transformed ngrams and running dlatk',
+                       default = None)
+
+	my_parser.add_argument('--num_shards',
+                       type=int,
+                       help='split the basetable into this many shards by group_id and process them independently',
+                       default = 0)
+
+	my_parser.add_argument('--shard',
+                       type=int,
+                       help='process only this shard, e.g. on one of several hosts sharing --shard_dir',
+                       default = None)
+
+	my_parser.add_argument('--shard_method',
+                       type=str,
+                       help='how to assign group_ids to shards, defaults to hash',
+                       choices = sharding.SHARD_METHODS,
+                       default = None)
 
+	my_parser.add_argument('--shard_dir',
+                       type=str,
+                       help='the directory, shared by all workers, for per-shard results',
+                       default = 'gender_swap_shards')
+
+	my_parser.add_argument('--workers',
+                       type=int,
+                       help='the number of local worker processes for sharded runs, defaults to the number of shards',
+                       default = None)
+
+	my_parser.add_argument('--max_retries',
+                       type=int,
+                       help='the number of times a failed shard is retried, defaults to 2',
+                       default = None)
+
+	my_parser.add_argument('--merge_shards',
+                       help='merge the results of all completed shards in --shard_dir and store them',
+                       action = "store_true")
+
+	my_parser.add_argument('--async_mode',
+                       help='overlap reading, remapping and uploading the ngram table in chunks, and report stage utilization',
+                       action = "store_true")
+
+	my_parser.add_argument('--chunksize',
+                       type=int,
+                       help='the number of ngram rows per chunk in async mode',
+                       default = 100000)
+
+	my_parser.add_argument('--cpu_workers',
+                       type=int,
+                       help='the number of processes remapping chunks in async mode, defaults to the number of cores',
+                       default = None)
+
+	my_parser.add_argument('--plan',
+                       help='only print the tables the run reads and writes, and estimate the rows, bytes and time of every stage',
+                       action = "store_true")
+
+	my_parser.add_argument('--throughput_log',
+                       type=str,
+                       help='the log of stage throughput written by every run, and used for the estimates of --plan',
+                       default = instrumentation.DEFAULT_THROUGHPUT_LOG)
 
+	my_parser.add_argument('--export_path',
+                       type=str,
+                       help='also export the results as parquet files partitioned by swap type and lexicon under this directory',
+                       default = None)
 
+	args = my_parser.parse_args()
 
+	# Without --num_shards the plain pipeline would run over the whole corpus instead
+	shard_flags = [args.shard is not None, args.merge_shards, args.workers is not None, args.max_retries is not None,
+                args.shard_method is not None]
+	if not args.num_shards and any(shard_flags):
+		my_parser.error("--shard, --merge_shards, --workers, --max_retries and --shard_method require --num_shards")
+	args.shard_method = args.shard_method or 'hash'
+	args.max_retries = 2 if args.max_retries is None else args.max_retries
+
+	# Only the plain and incremental runs read the ngrams of the cached category ids or score locally
+	if args.semijoin and (args.num_shards or args.async_mode):
+		my_parser.error("--semijoin is not supported with --num_shards or --async_mode")
+	if args.model_path and (args.num_shards or args.async_mode):
+		my_parser.error("--model_path is not supported with --num_shards or --async_mode")
+	if args.lexicon_workers and (args.num_shards or args.async_mode or args.model_path):
+		my_parser.error("--lexicon_workers is not supported with --num_shards, --async_mode or --model_path")
+	if args.dedup and args.async_mode:
+		my_parser.error("--dedup is not supported with --async_mode")
+	if args.incremental and (args.num_shards or args.async_mode):
+		my_parser.error("--incremental is not supported with --num_shards or --async_mode")
+	# Attribution totals cover the whole corpus, so only a plain run scored by the lexicon can compute them
+	if args.attribution and (args.incremental or args.num_shards or args.async_mode):
+		my_parser.error("--attribution is not supported with --incremental, --num_shards or --async_mode")
+	if args.attribution and args.model_path:
+		my_parser.error("--attribution uses the lexicon weights and is not supported with --model_path")
+	# A single shard stores nothing, the results are exported when the shards are merged
+	if args.export_path and args.num_shards and args.shard is not None:
+		my_parser.error("--export_path is not supported with --shard, pass it when merging the shards")
+	# The planner knows the layout of the plain and async runs only
+	if args.plan and (args.num_shards or args.incremental):
+		my_parser.error("--plan is not supported with --num_shards or --incremental")
+
+	pipeline_args = dict(db = args.db,
+                message_table = args.message_table,
+                user_initials = args.user,
+                features_used = args.features_used,
+                lexicon_table_name = args.lexicon,
+                weighted_lexicon_flag = args.weighted_lexicon,
+                ngram_table_name = args.ngram_table,
+                old_score_table = args.score_table,
+                category_table = args.category_table,
+                category_col = args.category_column,
+                category_name = args.category_value)
 
+	if args.plan:
+		# The model is not loaded, the plan only needs to know that scoring is local
+		planner.print_plan(*planner.plan_pipeline(scorer = args.model_path, lexicon_workers = args.lexicon_workers,
+                async_mode = args.async_mode, throughput_log = args.throughput_log, **pipeline_args))
+	elif args.num_shards and args.shard is not None:
+		sharding.run_shard(pipeline_args, args.shard, args.num_shards, args.shard_dir, args.shard_method, args.dedup)
+	elif args.num_shards:
+		sharding.run_sharded_pipeline(pipeline_args, args.num_shards, args.shard_dir, args.plots_path,
+                method = args.shard_method, workers = args.workers, max_retries = args.max_retries,
+                run_missing = not args.merge_shards, dedup = args.dedup, include_messages = not args.no_messages,
+                export_path = args.export_path)
+	elif args.async_mode:
+		asyncio.run(async_pp.run_pipeline_async(plots_path = args.plots_path, chunksize = args.chunksize,
+                cpu_workers = args.cpu_workers, include_messages = not args.no_messages,
+                throughput_log = args.throughput_log, export_path = args.export_path, **pipeline_args))
+	else:
+		scorer = None
+		if args.model_path:
+			scorer = scorers.load_pickled_scorer(args.model_path, args.vocabulary_path, method = args.model_method,
+                batch_size = args.batch_size, n_jobs = args.n_jobs, executor = args.executor)
+		if args.incremental:
+			incremental.run_pipeline_incremental(plots_path = args.plots_path, semijoin = args.semijoin,
+                include_messages = not args.no_messages, scorer = scorer, dedup = args.dedup,
+                lexicon_workers = args.lexicon_workers, export_path = args.export_path, **pipeline_args)
+		else:
+			pronoun_pp.run_pipeline(plots_path = args.plots_path, semijoin = args.semijoin,
+                include_messages = not args.no_messages, scorer = scorer, dedup = args.dedup,
+                attribution = args.attribution, throughput_log = args.throughput_log, export_path = args.export_path,
+                lexicon_workers = args.lexicon_workers, **pipeline_args)
@@ -0,0 +1,28 @@
+import numpy as np
+import pandas as pd
+
+
+LEXICON_DF = pd.DataFrame({"term": ["her", "him", "love", "they", "thank her", "thank him", "his book"],
+                           "category": "POLITE",
+                           "weight": [0.5, -0.2, 1.0, 0.3, -1.0, 2.0, 0.7]})
+
+
+def random_ngrams(num_messages : int = 200, seed : int = 0) -> pd.DataFrame:
+    """
+    A small ngram table with gendered terms, in the layout of `read_ngrams`.
+    """
+    rng = np.random.default_rng(seed)
+    feats = ["her", "she", "him", "he", "thank her", "love", "they", "hate", "his book", "hers"]
+    df = pd.DataFrame({"group_id": rng.integers(0, num_messages, num_messages * 5), "feat": rng.choice(feats, num_messages * 5)})
+    df = df.drop_duplicates(["group_id", "feat"]).reset_index(drop = True)
+    df.insert(0, "id", np.arange(len(df)))
+    df["value"] = 1
+    df["group_norm"] = df.groupby("group_id")["feat"].transform(lambda feat: 1.0 / len(feat))
+    return df
+
+
+PIPELINE_ARGS = dict(db = "politeness", message_table = "twitter", user_initials = "sc", features_used = "",
+                     lexicon_table_name = "lexicon_a", weighted_lexicon_flag = True,
+                     ngram_table_name = "feat$1gram$twitter$16to16", old_score_table = "feat$cat_lexicon_a$twitter$1gra",
+                     category_table = "feat$cat_LIWC2015$twitter$sid$1gra", category_col = "feat",
+                     category_name = "PRONOUN")
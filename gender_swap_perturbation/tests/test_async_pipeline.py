@@ -0,0 +1,41 @@
+import asyncio
+import threading
+import pandas as pd
+import sqlalchemy
+from concurrent.futures import ThreadPoolExecutor
+import pronoun_transformation.async_pipeline as async_pipeline
+from pronoun_transformation.instrumentation import StageStats, PIPELINE_STAGES
+from pronoun_transformation.pronoun_transformation_pipeline import remap_swap_type, create_transformed_ngram_table
+
+
+def test_chunks_are_read_off_the_event_loop(tmp_path, monkeypatch):
+    engine = sqlalchemy.create_engine("sqlite:///" + str(tmp_path / "pipeline.db"))
+    ngram_df = pd.DataFrame({"id": range(8), "group_id": [1, 1, 2, 2, 3, 3, 4, 4],
+                             "feat": ["her", "thank her", "he", "love", "she", "they", "his", "him"],
+                             "value": 1, "group_norm": 0.5})
+    with engine.begin() as conn:
+        ngram_df.to_sql("ngrams", conn, index = False)
+        pd.DataFrame({"sid": [1, 2, 3]}).to_sql("base", conn, index = False)
+    monkeypatch.setattr(async_pipeline, "engine_from_config", lambda database: engine)
+
+    query_threads = []
+    read_sql = pd.read_sql
+    def recording_read_sql(*args, **kwargs):
+        query_threads.append(threading.current_thread())
+        return read_sql(*args, **kwargs)
+    monkeypatch.setattr(async_pipeline.pd, "read_sql", recording_read_sql)
+
+    stage_stats = {stage: StageStats(stage) for stage in PIPELINE_STAGES}
+    with ThreadPoolExecutor(max_workers = 1) as cpu_executor:
+        asyncio.run(async_pipeline.transform_and_upload_async("ngrams", "base", "f2m", "ngrams_f2m", stage_stats,
+                                                              cpu_executor, chunksize = 2))
+
+    assert query_threads and threading.main_thread() not in query_threads
+    assert stage_stats["read"].chunks == 3 and stage_stats["read"].rows == 6
+
+    with engine.connect() as conn:
+        uploaded = pd.read_sql("SELECT * FROM ngrams_f2m", conn)
+    expected = create_transformed_ngram_table(remap_swap_type(ngram_df[ngram_df["group_id"] <= 3], "f2m"))
+    key = ["group_id", "feat"]
+    pd.testing.assert_frame_equal(uploaded.sort_values(key).reset_index(drop = True)[expected.columns],
+                                  expected.sort_values(key).reset_index(drop = True), check_dtype = False)
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+from pronoun_transformation.attribution import ngram_contributions, attribute_swap
+from pronoun_transformation.dedup import dedup_feature_bags
+from pronoun_transformation.pronoun_transformation_pipeline import remap_swap_type
+from pronoun_transformation.scorers import LexiconScorer, score_transform_effect
+from helpers import LEXICON_DF, random_ngrams
+
+
+def test_contributions_sum_to_the_lexicon_score_difference():
+    ngram_df = random_ngrams()
+    transformed_df = remap_swap_type(ngram_df, "f2m")
+    lexicon_weights = LEXICON_DF.set_index("term")["weight"]
+
+    scores = score_transform_effect(LexiconScorer(LEXICON_DF, weighted = True), ngram_df, transformed_df).set_index("id")
+    contributions = ngram_contributions(ngram_df, transformed_df, lexicon_weights)
+    totals = contributions.groupby("group_id")["contribution"].sum().reindex(scores.index, fill_value = 0.0)
+
+    assert (scores["score_difference"] != 0).any()
+    assert np.allclose(totals.values, scores["score_difference"].values)
+
+    attribution_df = attribute_swap(ngram_df, transformed_df, lexicon_weights, "f2m")
+    assert np.isclose(attribution_df["total_contribution"].sum(), scores["score_difference"].sum())
+
+
+def test_deduplicated_attribution_matches_the_full_attribution():
+    ngram_df = random_ngrams()
+    copies = ngram_df.assign(group_id = ngram_df["group_id"] + 1000)
+    ngram_df = pd.concat([ngram_df, copies], ignore_index = True)
+    lexicon_weights = LEXICON_DF.set_index("term")["weight"]
+
+    expected = attribute_swap(ngram_df, remap_swap_type(ngram_df, "f2m"), lexicon_weights, "f2m")
+    unique_df, group_map = dedup_feature_bags(ngram_df)
+    deduplicated = attribute_swap(unique_df, remap_swap_type(unique_df, "f2m"), lexicon_weights, "f2m", group_map)
+
+    expected = expected.set_index("pronoun_pair").sort_index()
+    deduplicated = deduplicated.set_index("pronoun_pair").sort_index()
+    assert np.allclose(deduplicated["total_contribution"], expected["total_contribution"])
+    assert (deduplicated[["occurrences", "messages"]] == expected[["occurrences", "messages"]]).all().all()
@@ -0,0 +1,17 @@
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from pronoun_transformation.pronoun_transformation_pipeline import generate_boxplot
+
+
+def test_generate_boxplot_uses_a_fresh_figure(tmp_path):
+    rng = np.random.default_rng(0)
+    result_df = pd.DataFrame({"id": np.arange(20), "original_score": rng.random(20),
+                              "f2m_score": rng.random(20), "m2f_score": rng.random(20)})
+
+    generate_boxplot(result_df, str(tmp_path / "first.png"))
+    generate_boxplot(result_df[["id", "original_score", "f2m_score"]], str(tmp_path / "second.png"))
+
+    assert (tmp_path / "first.png").exists() and (tmp_path / "second.png").exists()
+    # Every figure is closed after saving, nothing carries over to the next plot
+    assert plt.get_fignums() == []
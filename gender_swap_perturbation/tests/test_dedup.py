@@ -0,0 +1,42 @@
+import pandas as pd
+from pandas.testing import assert_frame_equal
+from pronoun_transformation.dedup import dedup_feature_bags, dedup_report, fan_out
+from pronoun_transformation.pronoun_transformation_pipeline import remap_swap_type
+from pronoun_transformation.scorers import LexiconScorer, score_transform_effect
+from helpers import LEXICON_DF, random_ngrams
+
+
+def with_copies(ngram_df : pd.DataFrame, copies : int = 3) -> pd.DataFrame:
+    """
+    Append `copies` retweets of every even message, with shuffled ngram rows.
+    """
+    originals = ngram_df[ngram_df["group_id"] % 2 == 0]
+    offset = ngram_df["group_id"].max() + 1
+    parts = [ngram_df]
+    for copy in range(1, copies + 1):
+        parts.append(originals.assign(group_id = originals["group_id"] + copy * offset).sample(frac = 1, random_state = copy))
+    df = pd.concat(parts, ignore_index = True)
+    df["id"] = range(len(df))
+    return df
+
+
+def test_dedup_fan_out_matches_scoring_every_message():
+    ngram_df = with_copies(random_ngrams())
+    scorer = LexiconScorer(LEXICON_DF, weighted = True, cache = False)
+
+    expected = score_transform_effect(scorer, ngram_df, remap_swap_type(ngram_df, "f2m"))
+
+    unique_df, group_map = dedup_feature_bags(ngram_df)
+    assert len(group_map) == ngram_df["group_id"].nunique()
+    assert dedup_report(group_map)["unique_bags"] < len(group_map)
+    scores = fan_out(score_transform_effect(scorer, unique_df, remap_swap_type(unique_df, "f2m")), group_map)
+
+    assert_frame_equal(scores.sort_values("id").reset_index(drop = True),
+                       expected.sort_values("id").reset_index(drop = True))
+
+
+def test_dedup_keeps_bags_with_different_counts_apart():
+    ngram_df = pd.DataFrame({"id": [1, 2, 3, 4], "group_id": [10, 11, 12, 12], "feat": ["her", "her", "her", "him"],
+                             "value": [1, 2, 1, 1], "group_norm": [1.0, 1.0, 0.5, 0.5]})
+    _, group_map = dedup_feature_bags(ngram_df)
+    assert group_map["representative_id"].tolist() == [10, 11, 12]
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+import sqlalchemy
+import pronoun_transformation.incremental as incremental
+from pronoun_transformation.export import long_format_results, export_results, query_results, count_row_groups
+
+pytest.importorskip("pyarrow")
+
+
+def results(num_messages : int = 2000, seed : int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({"id": np.arange(num_messages), "original_score": rng.normal(size = num_messages)})
+    for swap_type in ["f2m", "f2n", "m2f", "m2n"]:
+        df[swap_type + "_score"] = np.where(rng.random(num_messages) < 0.5, rng.normal(size = num_messages), np.nan)
+    return df
+
+
+def test_delta_query_reads_only_the_matching_row_groups(tmp_path):
+    final_df = results()
+    export_results(final_df, str(tmp_path), "lexicon_a", row_group_size = 50)
+
+    long_df = long_format_results(final_df, "lexicon_a")
+    expected = long_df[(long_df["swap_type"] == "f2m") & (long_df["delta"] > 0.5)]
+    actual = query_results(str(tmp_path), swap_type = "f2m", min_delta = 0.5)
+    assert sorted(actual["id"]) == sorted(expected["id"])
+    assert np.allclose(actual.sort_values("id")["delta"], expected.sort_values("id")["delta"])
+
+    read, total = count_row_groups(str(tmp_path), swap_type = "f2m", min_delta = 0.5)
+    f2m_groups = int(np.ceil((long_df["swap_type"] == "f2m").sum() / 50))
+    assert 0 < read < f2m_groups < total
+
+
+def test_manifest_export_keeps_the_category_value(tmp_path):
+    final_df = pd.concat([results(100, 1).assign(lexicon = "lexicon_a", category_value = "PRONOUN"),
+                          results(100, 2).assign(lexicon = "lexicon_a", category_value = "PPRON")], ignore_index = True)
+    export_results(final_df, str(tmp_path))
+    exported = query_results(str(tmp_path), swap_type = "m2f", lexicon = "lexicon_a")
+    assert exported.groupby("category_value").size().to_dict() == \
+        final_df[final_df["m2f_score"].notna()].groupby("category_value").size().to_dict()
+
+
+def test_incremental_export_reads_the_scores_of_the_whole_table(tmp_path, monkeypatch):
+    engine = sqlalchemy.create_engine("sqlite:///" + str(tmp_path / "results.db"))
+    final_df = results(20).assign(message = "text")
+    with engine.begin() as conn:
+        final_df.to_sql("twitter_sc_lexicon_a_gender_swap", conn, index = False)
+    monkeypatch.setattr(incremental, "engine_from_config", lambda database: engine)
+
+    scores_df = incremental.read_result_scores("twitter_sc_lexicon_a_gender_swap", ["f2m", "f2n", "m2f", "m2n"])
+    pd.testing.assert_frame_equal(scores_df, final_df.drop(columns = ["message"]))
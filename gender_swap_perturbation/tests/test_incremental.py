@@ -0,0 +1,172 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pronoun_transformation import incremental
+from pronoun_transformation.incremental import watermark_key, check_upsert_columns, upsert_table
+from pronoun_transformation.incremental import run_pipeline_incremental
+from pronoun_transformation.swap_gender_pronouns import SWAP_DICTIONARY
+from helpers import PIPELINE_ARGS
+
+
+SWAP_TYPES = list(SWAP_DICTIONARY.keys())
+MESSAGE_IDS = np.array([3, 5, 8, 12, 15])
+
+
+def test_watermark_key_separates_results_tables_and_categories():
+    key = watermark_key("msgs_ab_lex_gender_swap", "msgs_cat", "label", "polite")
+    assert len(key) == 64
+    assert key == watermark_key("msgs_ab_lex_gender_swap", "msgs_cat", "label", "polite")
+    others = [watermark_key("msgs_cd_lex_gender_swap", "msgs_cat", "label", "polite"),
+              watermark_key("msgs_ab_lex_gender_swap", "msgs_cat", "label", "rude"),
+              watermark_key("msgs_ab_lex_gender_swap", "msgs_cat", "topic", "polite"),
+              watermark_key("msgs_ab_lex_gender_swap", "other_cat", "label", "polite")]
+    assert len(set(others + [key])) == 5
+
+
+def test_upsert_columns_must_match_the_table():
+    check_upsert_columns("results", ["id", "message", "original_score"], ["original_score", "message", "id"])
+    with pytest.raises(ValueError, match = r"lack the columns \['message'\] and have the extra columns \[\]"):
+        check_upsert_columns("results", ["id", "message", "original_score"], ["id", "original_score"])
+
+
+def test_upsert_checks_the_columns_before_touching_the_table(monkeypatch):
+    stored = []
+    monkeypatch.setattr(incremental, "engine_from_config", lambda database: object())
+    monkeypatch.setattr(incremental, "table_exists", lambda engine, table_name: True)
+    monkeypatch.setattr(incremental, "table_columns", lambda engine, table_name: ["id", "message", "original_score"])
+    monkeypatch.setattr(incremental, "store_table", lambda df, table_name, db: stored.append(table_name))
+
+    with pytest.raises(ValueError, match = "--no_messages"):
+        upsert_table(pd.DataFrame({"id": [1], "original_score": [0.5]}), "results")
+    assert stored == []
+
+
+class FakeEngine:
+    """
+    Answers the `SELECT MAX(sid)` query on the delta basetable.
+    """
+    def __init__(self, last_sid):
+        self.last_sid = last_sid
+
+    def connect(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query):
+        assert query.startswith("SELECT MAX(sid)")
+        return self
+
+    def scalar(self):
+        return self.last_sid
+
+
+@pytest.fixture
+def incremental_run(monkeypatch, tmp_path):
+    """
+    Stub the database helpers of `run_pipeline_incremental`, recording their calls in order.
+    """
+    calls = []
+    state = {"watermarks": {}, "upsert_error": None}
+
+    def create_delta_base_table(basetable_name, category_table, category_col, category_name, after_sid, db):
+        calls.append(("delta", after_sid))
+        return int((MESSAGE_IDS > (after_sid or 0)).sum())
+
+    def run_swap_transformation(swap_type, basetable_name, message_table, ngram_table_name, old_score_table,
+                                lexicon_table_name, weighted_lexicon_flag, db, category_ids, scorer, dedup, report):
+        calls.append(("transform", swap_type, None if category_ids is None else list(category_ids)))
+        new_ids = MESSAGE_IDS[MESSAGE_IDS > (state["after_sid"] or 0)]
+        return pd.DataFrame({"id": new_ids, "original_score": 0.5, swap_type + "_score": 0.25})
+
+    def upsert_table(df, table_name, key, db):
+        calls.append(("upsert", table_name, sorted(df["id"])))
+        if state["upsert_error"] is not None:
+            raise state["upsert_error"]
+
+    def write_watermark(results_table, category_table, category_col, category_name, swap_type, last_sid, db):
+        calls.append(("watermark", swap_type, last_sid))
+
+    def read_watermarks(results_table, category_table, category_col, category_name, db):
+        state["after_sid"] = min(state["watermarks"].values()) if state["watermarks"] else None
+        return dict(state["watermarks"])
+
+    monkeypatch.setattr(incremental, "engine_from_config", lambda database: FakeEngine(int(MESSAGE_IDS.max())))
+    monkeypatch.setattr(incremental, "table_exists", lambda engine, table_name: False)
+    monkeypatch.setattr(incremental, "read_watermarks", read_watermarks)
+    monkeypatch.setattr(incremental, "write_watermark", write_watermark)
+    monkeypatch.setattr(incremental, "create_delta_base_table", create_delta_base_table)
+    monkeypatch.setattr(incremental, "run_swap_transformation", run_swap_transformation)
+    monkeypatch.setattr(incremental, "load_category_ids", lambda category_table, category_col, category_name, db:
+                        pd.Series([2, 5, 7, 8, 15]))
+    monkeypatch.setattr(incremental, "upsert_table", upsert_table)
+    monkeypatch.setattr(incremental, "generate_boxplot", lambda df, save_path: calls.append(("boxplot",)))
+
+    def run(**kwargs):
+        args = {key: value for key, value in PIPELINE_ARGS.items() if key != "lexicon_workers"}
+        args.update(plots_path = str(tmp_path), include_messages = False)
+        args.update(kwargs)
+        return run_pipeline_incremental(**args)
+
+    return run, calls, state
+
+
+def test_incremental_run_starts_after_the_smallest_watermark(incremental_run):
+    run, calls, state = incremental_run
+    state["watermarks"] = {swap_type: 8 for swap_type in SWAP_TYPES}
+    state["watermarks"][SWAP_TYPES[-1]] = 5
+
+    final_df = run(semijoin = True)
+
+    assert [call[1] for call in calls if call[0] == "delta"] == [5] * len(SWAP_TYPES)
+    # The semijoin ids are cut to the new messages as well
+    assert [call[2] for call in calls if call[0] == "transform"] == [[7, 8, 15]] * len(SWAP_TYPES)
+    assert sorted(final_df["id"]) == [8, 12, 15]
+
+
+def test_incremental_first_run_processes_every_message(incremental_run):
+    run, calls, state = incremental_run
+    state["watermarks"] = {SWAP_TYPES[0]: 12}
+
+    run(semijoin = True)
+
+    assert [call[1] for call in calls if call[0] == "delta"] == [None] * len(SWAP_TYPES)
+    assert [call[2] for call in calls if call[0] == "transform"] == [[2, 5, 7, 8, 15]] * len(SWAP_TYPES)
+
+
+def test_incremental_watermarks_advance_after_the_upsert(incremental_run):
+    run, calls, state = incremental_run
+    state["watermarks"] = {swap_type: 8 for swap_type in SWAP_TYPES}
+
+    run()
+
+    steps = [call[0] for call in calls]
+    upsert = steps.index("upsert")
+    assert calls[upsert][2] == [12, 15]
+    assert calls[upsert + 1:upsert + 1 + len(SWAP_TYPES)] == [("watermark", swap_type, 15) for swap_type in SWAP_TYPES]
+    assert "watermark" not in steps[:upsert]
+
+
+def test_incremental_failed_upsert_keeps_the_watermarks(incremental_run):
+    run, calls, state = incremental_run
+    state["upsert_error"] = RuntimeError("lost connection")
+
+    with pytest.raises(RuntimeError, match = "lost connection"):
+        run()
+
+    assert "upsert" in [call[0] for call in calls]
+    assert "watermark" not in [call[0] for call in calls]
+
+
+def test_incremental_run_without_new_messages_returns_early(incremental_run):
+    run, calls, state = incremental_run
+    state["watermarks"] = {swap_type: 15 for swap_type in SWAP_TYPES}
+
+    assert run() is None
+
+    assert [call[0] for call in calls] == ["delta"] * len(SWAP_TYPES)
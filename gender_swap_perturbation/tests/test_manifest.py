@@ -0,0 +1,110 @@
+import json
+import pandas as pd
+import pytest
+import sqlalchemy
+import pronoun_transformation.manifest as manifest_runner
+from pronoun_transformation.manifest import load_manifest, normalize_manifest, plan_manifest, run_manifest
+
+
+MANIFEST = {
+    "db": "politeness",
+    "message_table": "twitter",
+    "user": "sc",
+    "ngram_table": "feat$1gram$twitter$16to16",
+    "plots_path": "plots",
+    "swap_types": ["f2m", "m2f"],
+    "categories": [{"table": "feat$cat_LIWC2015$twitter$sid$1gra", "value": "PRONOUN"}],
+    "lexicons": [{"name": "lexicon_a", "weighted": True, "score_table": "feat$cat_lexicon_a$twitter$1gra"},
+                 {"name": "lexicon_b", "score_table": "feat$cat_lexicon_b$twitter$1gra"}],
+}
+
+
+def test_normalize_fills_in_the_optional_keys(tmp_path):
+    path = tmp_path / "manifest.json"
+    path.write_text(json.dumps(MANIFEST))
+    manifest = load_manifest(str(path))
+
+    assert manifest["result_table"] == "twitter_sc_manifest_gender_swap"
+    assert manifest["semijoin"] is False and manifest["include_messages"] is True and manifest["export_path"] is None
+    assert manifest["categories"] == [dict(MANIFEST["categories"][0], column = "feat", tag = "pronoun")]
+    assert [lexicon["weighted"] for lexicon in manifest["lexicons"]] == [True, False]
+    # The input is not modified
+    assert "tag" not in MANIFEST["categories"][0]
+
+
+@pytest.mark.parametrize("change, message", [
+    ({"lexicons": None}, "missing required key 'lexicons'"),
+    ({"swap_types": ["f2m", "x2y"]}, "Unknown swap types"),
+    ({"categories": [{"table": "liwc_a", "value": "PRONOUN"}, {"table": "liwc_b", "value": "pronoun"}]}, "pronoun"),
+])
+def test_normalize_rejects_invalid_manifests(change, message):
+    manifest = dict(MANIFEST, **change)
+    manifest = {key: value for key, value in manifest.items() if value is not None}
+    with pytest.raises(ValueError, match = message):
+        normalize_manifest(manifest)
+
+
+def test_explicit_tags_keep_filters_with_the_same_value_apart():
+    manifest = normalize_manifest(dict(MANIFEST, categories = [{"table": "liwc_a", "value": "PRONOUN", "tag": "a"},
+                                                               {"table": "liwc_b", "value": "PRONOUN", "tag": "b"}]))
+    plan_df = plan_manifest(manifest)
+    assert plan_df.groupby("category_table")["basetable"].nunique().to_dict() == {"liwc_a": 2, "liwc_b": 2}
+    assert plan_df["basetable"].nunique() == 4
+
+
+def test_plan_shares_basetables_and_transformed_tables_across_lexicons():
+    plan_df = plan_manifest(normalize_manifest(MANIFEST))
+
+    assert len(plan_df) == 4
+    per_swap = plan_df.groupby("swap_type")
+    assert (per_swap["basetable"].nunique() == 1).all()
+    assert (per_swap["transformed_ngram_table"].nunique() == 1).all()
+    assert plan_df["new_score_table"].nunique() == 4
+    assert plan_df.loc[plan_df["swap_type"] == "f2m", "transformed_ngram_table"].iloc[0] == "feat$1gram$twitter_sc_pronoun_f2m$16to16"
+
+
+def test_run_manifest_uploads_once_and_scores_per_lexicon(tmp_path, monkeypatch):
+    engine = sqlalchemy.create_engine("sqlite:///" + str(tmp_path / "pipeline.db"))
+    ngram_df = pd.DataFrame({"id": range(6), "group_id": [1, 1, 2, 2, 3, 3],
+                             "feat": ["her", "love", "he", "thanks", "they", "hate"], "value": 1, "group_norm": 0.5})
+    with engine.begin() as conn:
+        ngram_df.to_sql("feat$1gram$twitter$16to16", conn, index = False)
+    monkeypatch.setattr("pronoun_transformation.pronoun_transformation_pipeline.engine_from_config",
+                        lambda database: engine)
+
+    basetables = []
+    def create_base_table(basetable_name, category_table, category_col, category_name, db):
+        basetables.append(basetable_name)
+        with engine.begin() as conn:
+            pd.DataFrame({"sid": [1, 2, 3]}).to_sql(basetable_name, conn, index = False, if_exists = "replace")
+    stored = []
+    scored = []
+    def run_lexicon_scoring(transformed_ngram_table_name, basetable_name, lexicon_table_name, weighted_lexicon_flag, db):
+        scored.append((transformed_ngram_table_name, lexicon_table_name, weighted_lexicon_flag))
+    def compare_transform_scores(old_score_table, new_score_table, db):
+        offset = 1.0 if "lexicon_a" in old_score_table else 2.0
+        return pd.DataFrame({"id": [1, 2, 3], "original_score": offset, "transformed_score": [offset + 0.1, offset + 0.2, offset]})
+    monkeypatch.setattr(manifest_runner, "create_base_table", create_base_table)
+    monkeypatch.setattr(manifest_runner, "store_table", lambda df, table_name, db: stored.append(table_name))
+    monkeypatch.setattr(manifest_runner, "run_lexicon_scoring", run_lexicon_scoring)
+    monkeypatch.setattr(manifest_runner, "compare_transform_scores", compare_transform_scores)
+
+    manifest = normalize_manifest(dict(MANIFEST, plots_path = str(tmp_path / "plots"), include_messages = False))
+    result_df = run_manifest(manifest)
+
+    assert basetables == ["twitter_sc_pronoun_f2m", "twitter_sc_pronoun_m2f"]
+    # One upload per swap type, then the results table
+    assert stored == ["feat$1gram$twitter_sc_pronoun_f2m$16to16", "feat$1gram$twitter_sc_pronoun_m2f$16to16",
+                      "twitter_sc_manifest_gender_swap"]
+    assert scored == [("feat$1gram$twitter_sc_pronoun_f2m$16to16", "lexicon_a", True),
+                      ("feat$1gram$twitter_sc_pronoun_f2m$16to16", "lexicon_b", False),
+                      ("feat$1gram$twitter_sc_pronoun_m2f$16to16", "lexicon_a", True),
+                      ("feat$1gram$twitter_sc_pronoun_m2f$16to16", "lexicon_b", False)]
+
+    # "her" is swapped by f2m in message 1, "he" by m2f in message 2
+    result_df = result_df.set_index(["lexicon", "id"]).sort_index()
+    assert list(result_df.columns[:2]) == ["category_value", "category_tag"]
+    assert result_df.loc[("lexicon_b", 1), "f2m_score"] == pytest.approx(2.1)
+    assert pd.isna(result_df.loc[("lexicon_b", 1), "m2f_score"])
+    assert result_df.loc[("lexicon_a", 2), "m2f_score"] == pytest.approx(1.2)
+    assert len(result_df) == 4
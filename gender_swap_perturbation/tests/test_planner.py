@@ -0,0 +1,52 @@
+import json
+import pandas as pd
+import pronoun_transformation.planner as planner
+from helpers import PIPELINE_ARGS
+
+
+def fake_statistics(engine, table_names):
+    existing = [PIPELINE_ARGS["message_table"], PIPELINE_ARGS["category_table"], PIPELINE_ARGS["ngram_table_name"],
+                PIPELINE_ARGS["old_score_table"], PIPELINE_ARGS["lexicon_table_name"]]
+    return pd.DataFrame({"table_rows": 1000, "avg_row_length": 50, "data_length": 50000},
+                        index = pd.Index([table for table in existing if table in table_names], name = "table_name"))
+
+
+def plan(monkeypatch, tmp_path, **options):
+    monkeypatch.setattr(planner, "engine_from_config", lambda database: None)
+    monkeypatch.setattr(planner, "table_statistics", fake_statistics)
+    monkeypatch.setattr(planner, "explain_rows", lambda engine, sql: 100.0)
+    throughput_log = tmp_path / "throughput.jsonl"
+    with open(throughput_log, "w") as fh:
+        for stage in planner.PIPELINE_STAGES:
+            fh.write(json.dumps({"run": "earlier", "stage": stage, "busy_seconds": 10.0, "chunks": 1, "rows": 1000}) + "\n")
+    arguments = {key: value for key, value in PIPELINE_ARGS.items() if key not in ["features_used", "weighted_lexicon_flag"]}
+    return planner.plan_pipeline(throughput_log = str(throughput_log), **arguments, **options)
+
+
+def test_async_plan_overlaps_read_remap_and_upload(monkeypatch, tmp_path):
+    _, plain_stages, _ = plan(monkeypatch, tmp_path)
+    _, async_stages, _ = plan(monkeypatch, tmp_path, async_mode = True)
+
+    assert not plain_stages["overlap"].any()
+    assert set(async_stages.loc[async_stages["overlap"], "stage"]) == set(planner.ASYNC_OVERLAPPED_STAGES)
+    # Same tables and rows, but the overlapped stages only count with the slowest of them
+    assert (async_stages["rows_pulled"] == plain_stages["rows_pulled"]).all()
+    assert planner._total_seconds(async_stages) < planner._total_seconds(plain_stages)
+
+
+def test_local_lexicon_plan_uploads_nothing(monkeypatch, tmp_path):
+    tables_df, stages_df, problems = plan(monkeypatch, tmp_path, lexicon_workers = 4)
+    assert stages_df["rows_uploaded"].sum() == 0
+    # The logged upload and dlatk score times don't apply to local scoring
+    assert (stages_df.loc[stages_df["stage"] == "upload", "est_seconds"] == 0).all()
+    assert stages_df.loc[stages_df["stage"] == "score", "est_seconds"].isna().all()
+    assert stages_df.loc[stages_df["stage"] == "read", "est_seconds"].notna().all()
+    assert "lexicon table" in set(tables_df["role"])
+    assert "transformed ngram table" not in set(tables_df["role"])
+    assert problems == []
+
+
+def test_print_plan_reports_the_overlapped_total(monkeypatch, tmp_path, capsys):
+    tables_df, stages_df, problems = plan(monkeypatch, tmp_path, async_mode = True)
+    planner.print_plan(tables_df, stages_df, problems)
+    assert "{:.0f} s".format(planner._total_seconds(stages_df)) in capsys.readouterr().out
@@ -0,0 +1,77 @@
+import numpy as np
+from scipy import sparse
+from pronoun_transformation.scorers import Scorer, LexiconScorer, build_feature_matrix
+from helpers import LEXICON_DF, random_ngrams
+
+
+class CountingScorer(Scorer):
+    """
+    Scores a row as the sum of its values, and records the size of every batch.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.batches = []
+
+    def predict_batch(self, batch):
+        self.batches.append(batch.shape[0])
+        return np.asarray(batch.sum(axis = 1)).ravel()
+
+
+def test_score_predicts_each_distinct_row_once():
+    matrix = sparse.csr_matrix(np.array([[1.0, 0.0], [0.0, 2.0], [1.0, 0.0], [3.0, 1.0], [0.0, 2.0]]))
+    scorer = CountingScorer(batch_size = 2)
+
+    assert np.allclose(scorer.score(matrix), [1.0, 2.0, 1.0, 4.0, 2.0])
+    assert scorer.batches == [2, 1]
+
+    # Scoring again is served from the cache
+    assert np.allclose(scorer.score(matrix[::-1]), [2.0, 4.0, 1.0, 2.0, 1.0])
+    assert scorer.batches == [2, 1]
+
+
+def test_score_without_cache_predicts_every_row():
+    matrix = sparse.csr_matrix(np.array([[1.0, 0.0], [1.0, 0.0], [1.0, 0.0]]))
+    scorer = CountingScorer(batch_size = 2, cache = False)
+    assert np.allclose(scorer.score(matrix), [1.0, 1.0, 1.0])
+    assert scorer.batches == [2, 1]
+
+
+def test_lexicon_scorer_is_the_weighted_sum_of_feature_values():
+    ngram_df = random_ngrams()
+    scorer = LexiconScorer(LEXICON_DF, weighted = True)
+    matrix, group_ids = build_feature_matrix(ngram_df, scorer.vocabulary)
+
+    weights = LEXICON_DF.set_index("term")["weight"]
+    expected = (ngram_df["feat"].map(weights).fillna(0.0) * ngram_df["group_norm"]).groupby(ngram_df["group_id"]).sum()
+    assert np.allclose(scorer.score(matrix), expected.reindex(group_ids).values)
+
+    # Threads give the same scores
+    threaded = LexiconScorer(LEXICON_DF, weighted = True, batch_size = 16, n_jobs = 3, cache = False)
+    assert np.allclose(threaded.score(matrix), scorer.score(matrix))
+
+
+class PickleCountingTextScorer(Scorer):
+    """
+    Scores a text by its length, and counts how often the scorer is pickled.
+    """
+
+    input_type = "texts"
+    pickles = 0
+
+    def __getstate__(self):
+        PickleCountingTextScorer.pickles += 1
+        return super().__getstate__()
+
+    def predict_batch(self, batch):
+        return np.array([len(text) for text in batch], dtype = np.float64)
+
+
+def test_process_executor_sends_a_text_scorer_once_per_worker():
+    texts = ["a" * length for length in range(1, 31)]
+    scorer = PickleCountingTextScorer(batch_size = 5, n_jobs = 2, executor = "process", cache = False)
+    PickleCountingTextScorer.pickles = 0
+
+    assert np.allclose(scorer.score(texts), np.arange(1, 31))
+    # Six batches, but at most one copy of the scorer per worker
+    assert PickleCountingTextScorer.pickles <= 2
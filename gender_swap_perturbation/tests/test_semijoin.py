@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+import sqlalchemy
+import pronoun_transformation.pronoun_transformation_pipeline as pipeline
+
+
+def test_semijoin_reads_only_the_category_messages(tmp_path, monkeypatch):
+    engine = sqlalchemy.create_engine("sqlite:///" + str(tmp_path / "pipeline.db"))
+    ngram_df = pd.DataFrame({"group_id": np.repeat(np.arange(100), 2), "feat": ["her", "love"] * 100,
+                             "value": 1, "group_norm": 0.5})
+    with engine.begin() as conn:
+        ngram_df.to_sql("ngrams", conn, index = False)
+
+    queries = []
+    read_sql = pd.read_sql
+    def recording_read_sql(sql, *args, **kwargs):
+        queries.append(sql)
+        return read_sql(sql, *args, **kwargs)
+    monkeypatch.setattr(pipeline, "engine_from_config", lambda database: engine)
+    monkeypatch.setattr(pipeline.pd, "read_sql", recording_read_sql)
+
+    category_ids = np.array([3, 4, 50, 98])
+    df = pipeline.read_ngrams_semijoin("ngrams", category_ids, batch_size = 3)
+
+    assert sorted(df["group_id"].unique()) == [3, 4, 50, 98]
+    assert len(df) == 8
+    # The ids are filtered by the server, in batches
+    assert len(queries) == 2 and all("IN (" in sql for sql in queries)
+
+    empty_df = pipeline.read_ngrams_semijoin("ngrams", np.array([], dtype = np.int64))
+    assert empty_df.empty and list(empty_df.columns) == list(ngram_df.columns)
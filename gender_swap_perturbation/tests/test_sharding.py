@@ -0,0 +1,64 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+import sqlalchemy
+import pronoun_transformation.sharding as sharding
+from pronoun_transformation.sharding import shard_statistics, merge_shard_statistics
+from pronoun_transformation.sharding import shard_run_fingerprint, claim_shard_dir
+from helpers import PIPELINE_ARGS
+
+
+def test_merged_statistics_match_the_unsharded_results():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({"id": np.arange(100), "original_score": rng.random(100),
+                       "f2m_score": np.where(rng.random(100) < 0.7, rng.random(100), np.nan)})
+    # Reversed shard order must not change the merge
+    stats_df = merge_shard_statistics([shard_statistics(df.iloc[start:start + 25]) for start in range(0, 100, 25)][::-1])
+
+    delta = (df["f2m_score"] - df["original_score"]).dropna()
+    assert stats_df.loc["f2m", "count"] == len(delta)
+    assert stats_df.loc["f2m", "mean_delta"] == pytest.approx(delta.mean())
+    assert stats_df.loc["f2m", "std_delta"] == pytest.approx(delta.std(ddof = 0))
+
+
+def test_shard_dir_is_reused_only_by_the_same_run(tmp_path):
+    output_dir = str(tmp_path / "shards")
+    fingerprint = shard_run_fingerprint(PIPELINE_ARGS, 4, "hash", dedup = False)
+    claim_shard_dir(output_dir, fingerprint)
+    # The same run, e.g. a retry or another host, may reuse the directory
+    claim_shard_dir(output_dir, shard_run_fingerprint(dict(PIPELINE_ARGS), 4, "hash", dedup = False))
+    with open(str(tmp_path / "shards" / "run.json")) as fh:
+        assert json.load(fh)["fingerprint"] == fingerprint
+
+    other_lexicon = dict(PIPELINE_ARGS, lexicon_table_name = "lexicon_b")
+    with pytest.raises(ValueError, match = "lexicon_table_name"):
+        claim_shard_dir(output_dir, shard_run_fingerprint(other_lexicon, 4, "hash", dedup = False))
+    with pytest.raises(ValueError, match = "num_shards"):
+        claim_shard_dir(output_dir, shard_run_fingerprint(PIPELINE_ARGS, 8, "hash", dedup = False))
+
+
+def test_range_bounds_are_computed_once_per_run(tmp_path, monkeypatch):
+    engine = sqlalchemy.create_engine("sqlite:///" + str(tmp_path / "category.db"))
+    with engine.begin() as conn:
+        pd.DataFrame({"group_id": range(100), "feat": "PRONOUN"}).to_sql("category", conn, index = False)
+    monkeypatch.setattr(sharding, "engine_from_config", lambda database: engine)
+    pipeline_args = dict(PIPELINE_ARGS, category_table = "category")
+    fingerprint = shard_run_fingerprint(pipeline_args, 4, "range", dedup = False)
+    output_dir = str(tmp_path / "shards")
+
+    bounds = claim_shard_dir(output_dir, fingerprint, sharding._range_bounds_function(pipeline_args, 4, "range"))
+    assert bounds == [[0, 25], [25, 50], [50, 75], [75, None]]
+
+    # Messages added later don't move the bounds of a worker starting afterwards
+    with engine.begin() as conn:
+        pd.DataFrame({"group_id": range(100, 200), "feat": "PRONOUN"}).to_sql("category", conn, index = False,
+                                                                             if_exists = "append")
+    def recompute():
+        raise AssertionError("the bounds were recomputed")
+    assert claim_shard_dir(output_dir, fingerprint, recompute) == bounds
+
+
+def test_range_shards_need_the_recorded_bounds():
+    with pytest.raises(ValueError, match = "range bounds"):
+        sharding.create_shard_base_table("base", "category", "feat", "PRONOUN", 0, 4, "range")
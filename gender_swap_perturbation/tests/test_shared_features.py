@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pronoun_transformation.shared_features import parallel_lexicon_effect
+from pronoun_transformation.pronoun_transformation_pipeline import remap_swap_type, create_tranformation_metadata_table
+from pronoun_transformation.scorers import LexiconScorer, score_transform_effect
+from helpers import LEXICON_DF, random_ngrams
+
+
+@pytest.mark.parametrize("backend", ["shm", "memmap"])
+def test_parallel_lexicon_effect_matches_scoring_the_remapped_ngrams(backend):
+    ngram_df = random_ngrams()
+    lexicon_weights = LEXICON_DF.set_index("term")["weight"]
+    scorer = LexiconScorer(LEXICON_DF, weighted = True)
+
+    effect_df = parallel_lexicon_effect(ngram_df, lexicon_weights, ["f2m", "m2f"], workers = 2, rows_per_task = 37,
+                                        backend = backend)
+
+    for swap_type in ["f2m", "m2f"]:
+        transformed_df = remap_swap_type(ngram_df, swap_type)
+        transformed_ids = create_tranformation_metadata_table(transformed_df)["group_id"].unique()
+        expected = score_transform_effect(scorer, ngram_df, transformed_df)
+        expected = expected[expected["id"].isin(transformed_ids)].reset_index(drop = True)
+
+        actual = effect_df[effect_df["swap_type"] == swap_type].sort_values("id").reset_index(drop = True)
+        assert actual["id"].tolist() == expected["id"].tolist()
+        for column in ["original_score", "transformed_score", "score_difference"]:
+            assert np.allclose(actual[column], expected[column])
+
+
+def test_shared_transformations_read_and_score_once_for_all_swap_types(monkeypatch):
+    import pronoun_transformation.pronoun_transformation_pipeline as pipeline
+    ngram_df = random_ngrams()
+    lexicon_weights = LEXICON_DF.set_index("term")["weight"]
+    calls = {"read": 0, "score": 0}
+
+    def read_swap_ngrams(*args):
+        calls["read"] += 1
+        return ngram_df, None
+    def counting_effect(*args, **kwargs):
+        calls["score"] += 1
+        return parallel_lexicon_effect(*args, **kwargs)
+    monkeypatch.setattr(pipeline, "read_swap_ngrams", read_swap_ngrams)
+    monkeypatch.setattr(pipeline, "parallel_lexicon_effect", counting_effect)
+    monkeypatch.setattr(pipeline, "attach_messages", lambda df, message_table, db: df)
+
+    swap_types = ["f2m", "f2n", "m2f", "m2n"]
+    final_tables = pipeline.run_swap_transformations_shared(swap_types, "twitter_sc_f2m", "twitter", "ngrams",
+                                                            lexicon_weights, 2)
+    assert calls == {"read": 1, "score": 1}
+
+    scorer = LexiconScorer(LEXICON_DF, weighted = True)
+    for swap_type, swap_df in zip(swap_types, final_tables):
+        expected = pipeline.run_swap_transformation_with_scorer(swap_type, ngram_df, "twitter", scorer)
+        assert list(swap_df.columns) == ["id", "original_score", swap_type + "_score"]
+        pd.testing.assert_frame_equal(swap_df.sort_values("id").reset_index(drop = True),
+                                      expected.sort_values("id").reset_index(drop = True), check_dtype = False)
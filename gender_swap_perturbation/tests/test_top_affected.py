@@ -0,0 +1,25 @@
+import pandas as pd
+import sqlalchemy
+import pronoun_transformation.pronoun_transformation_pipeline as pipeline
+
+
+def test_top_affected_messages_reads_the_text_of_k_messages(tmp_path, monkeypatch):
+    engine = sqlalchemy.create_engine("sqlite:///" + str(tmp_path / "pipeline.db"))
+    with engine.begin() as conn:
+        pd.DataFrame({"group_id": range(6), "group_norm": [0.1, 0.2, 0.3, 0.4, 0.5, 0.6]}).to_sql("old_scores", conn, index = False)
+        pd.DataFrame({"group_id": range(6), "group_norm": [0.1, 0.9, 0.2, 0.4, -0.5, 0.7]}).to_sql("new_scores", conn, index = False)
+        pd.DataFrame({"sid": range(6), "message": ["m{}".format(i) for i in range(6)]}).to_sql("messages", conn, index = False)
+    monkeypatch.setattr(pipeline, "engine_from_config", lambda database: engine)
+
+    fetched = []
+    fetch_messages = pipeline.fetch_messages
+    def recording_fetch_messages(ids, *args, **kwargs):
+        fetched.extend(ids)
+        return fetch_messages(ids, *args, **kwargs)
+    monkeypatch.setattr(pipeline, "fetch_messages", recording_fetch_messages)
+
+    top_df = pipeline.top_affected_messages("old_scores", "new_scores", "messages", 2)
+
+    assert list(top_df["id"]) == [4, 1]
+    assert list(top_df["message"]) == ["m4", "m1"]
+    assert sorted(fetched) == [1, 4]